@@ -3,110 +3,2529 @@ A1111 Metadata Editor - Professional Web UI
 Clean, modern light theme with resizable panels
 """
 import os
+import sys
+import errno
 import struct
 import zlib
 import shutil
-from flask import Flask, render_template_string, request, jsonify, send_file
+import tempfile
+import sqlite3
+import threading
+import itertools
+import json
+import time
+import uuid
+import contextlib
+import hashlib
+import base64
+import bisect
+import fnmatch
+import glob
+import re
+import operator
+import select
+import selectors
+import ctypes
+import signal
+import socket
+import argparse
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import fcntl  # POSIX only: reflink backups
+except ImportError:
+    fcntl = None
+try:
+    from PIL import Image  # optional: without Pillow /api/thumb serves the original file
+except ImportError:
+    Image = None
+from flask import Flask, Response, render_template_string, request, jsonify, send_file, stream_with_context
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 
 app = Flask(__name__)
+SHUTDOWN = threading.Event()  # set by serve() on SIGTERM/SIGINT: streams end, synchronous batches stop
+
+# ============== File Functions ==============
+COPY_BLOCK = 1 << 20
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def kernel_copy(src_fd, dst_fd, offset, count):
+    # In-kernel copy to the current position of dst_fd; returns 0 when unsupported here
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, offset)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF): raise
+    if sys.platform.startswith('linux'):
+        try:
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP): raise
+    return 0
+
+def copy_range(src_fd, dst_fd, offset, count):
+    while count > 0:
+        n = kernel_copy(src_fd, dst_fd, offset, count)
+        if n <= 0: break
+        offset, count = offset + n, count - n
+    if count > 0:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        while count > 0:
+            block = os.read(src_fd, min(count, COPY_BLOCK))
+            if not block: raise ValueError("Unexpected end of file")
+            write_all(dst_fd, block)
+            count -= len(block)
+
+FICLONE = 0x40049409  # Linux ioctl: share all extents of one file with another (btrfs, XFS, ...)
+WRITE_BLOCK = 4096  # in-place patches stay inside one filesystem block, so a crash cannot tear them across blocks
+WRITE_GROUP = 256  # batch writes made durable together
+WRITE_GROUP_SECONDS = 1.0
+WRITE_GROUP_BYTES = 256 << 20  # temp copies a group may hold on disk before it is committed
+SETTLED_FLUSH = 256  # results decided from the index that wait for a flush of their own
+SETTLED_SECONDS = 0.5
+WRITE_CONFLICT = 'File changed during the batch'
+
+def load_syncfs():
+    # syncfs(2) flushes a whole filesystem in one call; Linux only. Before 5.8 it does not report
+    # writeback errors, so a failed flush of a renamed-in temp file would go unnoticed: older
+    # kernels fsync every file instead.
+    if not sys.platform.startswith('linux'): return None
+    version = re.match(r'(\d+)\.(\d+)', os.uname().release)
+    if not version or (int(version.group(1)), int(version.group(2))) < (5, 8): return None
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+SYNCFS = load_syncfs()
+
+def sync_filesystem(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        if SYNCFS(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), directory)
+    finally:
+        os.close(fd)
+
+def fsync_path(path):
+    # Windows fsync (_commit) needs a writable descriptor; directories can only be opened read-only
+    fd = os.open(path, os.O_RDONLY if os.path.isdir(path) else os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_dir(directory):
+    # Makes renames and new names in directory durable; Windows has no directory handles for this
+    if os.name != 'nt': fsync_path(directory)
+
+def in_one_block(offset, length):
+    return offset // WRITE_BLOCK == (offset + length - 1) // WRITE_BLOCK
+
+def clone_file(src, dst, sync=True):
+    # Copy of src that costs no space where the filesystem can reflink it
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            try:
+                if fcntl is None: raise OSError(errno.ENOSYS, 'no reflinks here')
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except OSError:
+                copy_range(s.fileno(), d.fileno(), 0, os.fstat(s.fileno()).st_size)
+            if sync: os.fsync(d.fileno())
+        shutil.copystat(src, dst)
+    except BaseException:
+        if os.path.exists(dst): os.remove(dst)
+        raise
+
+def make_backup(path, mode='copy', sync=True):
+    # Whole-file backup of the original, made once. 'link' hard-links it: the writers never
+    # patch a file that has other links, so the backup keeps the old bytes.
+    backup = path + '.backup'
+    if os.path.exists(backup): return
+    if mode == 'link':
+        try:
+            os.link(path, backup)
+            if sync: fsync_dir(os.path.dirname(os.path.abspath(path)))
+            return
+        except OSError:
+            pass  # e.g. FAT/exFAT
+    clone_file(path, backup, sync)
+
+def write_in_place(path, offset, data, sync=True):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+        f.flush()
+        if sync: os.fsync(f.fileno())
+    forget_stats(os.path.dirname(os.path.abspath(path)))
+
+class PathLocks:
+    # Exclusive, reentrant per-file locks: an RLock within the process and, where fcntl exists, an
+    # advisory lockf on one byte of the directory's lock file in LOCK_DIR for other processes, e.g.
+    # the CLI next to a running server. The lock files live in the app's data directory, never in
+    # the image folders. The byte is picked by a hash of the file name; files whose hashes
+    # collide share the lock (RLock included, so one thread's unlock never drops another's lock).
+    # POSIX drops all of a process's locks on a file as soon as any of its descriptors is closed,
+    # so the lock file stays open while a lock in the directory is held.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = {}  # (directory, byte) -> [RLock, threads using it, depth]
+        self.files = {}  # directory -> [lock file descriptor or None, keys locked]
+
+    @staticmethod
+    def key(path):
+        directory, name = os.path.split(os.path.abspath(path))
+        return directory, zlib.crc32(os.fsencode(name)) & 0x3fffffff
+
+    def acquire(self, path):
+        key = self.key(path)
+        with self.lock:
+            entry = self.keys.setdefault(key, [threading.RLock(), 0, 0])
+            entry[1] += 1
+        entry[0].acquire()
+        entry[2] += 1
+        if entry[2] > 1: return
+        fd = self.open(key[0])
+        if fd is not None:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX, 1, key[1])
+            except OSError:
+                pass  # e.g. ENOLCK on a share without lock support: this process is still covered
+
+    def release(self, path):
+        key = self.key(path)
+        entry = self.keys[key]
+        entry[2] -= 1
+        if entry[2] == 0:
+            fd = self.files[key[0]][0]
+            try:
+                if fd is not None: fcntl.lockf(fd, fcntl.LOCK_UN, 1, key[1])
+            except OSError:
+                pass
+            self.close(key[0])
+        entry[0].release()
+        with self.lock:
+            entry[1] -= 1
+            if entry[1] == 0: del self.keys[key]
+
+    @contextlib.contextmanager
+    def hold(self, path):
+        self.acquire(path)
+        try:
+            yield
+        finally:
+            self.release(path)
+
+    def open(self, directory):
+        with self.lock:
+            held = self.files.get(directory)
+            if held is None:
+                fd = None
+                if fcntl is not None:
+                    # One lock file per image directory, named by a hash of its real path
+                    name = hashlib.sha1(os.fsencode(os.path.realpath(directory))).hexdigest() + '.lock'
+                    try:
+                        os.makedirs(LOCK_DIR, exist_ok=True)
+                        fd = os.open(os.path.join(LOCK_DIR, name), os.O_RDWR | os.O_CREAT, 0o666)
+                    except OSError:
+                        pass  # no usable data directory: this process is still covered
+                held = self.files[directory] = [fd, 0]
+            held[1] += 1
+            return held[0]
+
+    def close(self, directory):
+        with self.lock:
+            held = self.files[directory]
+            held[1] -= 1
+            if held[1] == 0:
+                del self.files[directory]
+                if held[0] is not None: os.close(held[0])
+
+PATH_LOCKS = PathLocks()
+
+def patch_file(path, offset, data, create_backup=True, group=None):
+    # Overwrites len(data) bytes at offset without touching the rest of the file.
+    # Callers keep patches inside one block (in_one_block); anything else goes through splice_file.
+    if create_backup: make_backup(path)
+    if group is not None: group.patch(path, offset, data, file_fingerprint(os.stat(path)))
+    else: write_in_place(path, offset, data)
+
+def splice_file(path, segments, create_backup=True, group=None):
+    # Rewrites path from segments: (offset, length) ranges copied from the current file, or bytes.
+    # The result is assembled and fsynced in a sibling temp file, swapped in with os.replace and
+    # the directory fsynced, so an interrupted write leaves either the old file or the new one.
+    # With a group the swap waits for its commit.
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        try:
+            with open(path, 'rb') as src:
+                st = os.fstat(src.fileno())
+                source = file_fingerprint(st)
+                for seg in segments:
+                    if isinstance(seg, tuple): copy_range(src.fileno(), fd, *seg)
+                    else: write_all(fd, seg)
+            if hasattr(os, 'fchown') and (st.st_uid, st.st_gid) != tuple(os.fstat(fd)[4:6]):
+                # Keep the owner and group; only root (or a member of the group) may hand them over
+                try:
+                    os.fchown(fd, st.st_uid, st.st_gid)
+                except OSError as e:
+                    if e.errno != errno.EPERM: raise
+            if group is None or group.sync_each: os.fsync(fd)
+        finally:
+            os.close(fd)
+        shutil.copymode(path, tmp_path)  # after fchown, which may clear setuid bits
+        if create_backup: make_backup(path)
+        if group is not None: return group.replace(tmp_path, path, source)
+        os.replace(tmp_path, path)
+        fsync_dir(directory)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+class WriteGroup:
+    # Lets a batch make many writes durable at once. Rewritten files wait as temp files, and in-place
+    # patches in memory, until commit(): that flushes the temp files, journal lines and backups (one
+    # syncfs per filesystem; without syncfs each was fsynced as written), swaps everything in and
+    # flushes again. Nothing is visible before its journal line and new contents are on disk, and
+    # a crash at any point leaves each file either old or new. A file changed by someone else since
+    # its new contents were planned (its fingerprint differs) is left alone: WRITE_CONFLICT.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []  # (path, temp path or None, offset, data, fingerprint planned from)
+        self.bytes = 0  # size of the pending temp files and patches
+        self.sync_each = SYNCFS is None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def replace(self, tmp_path, path, fingerprint):
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            self.pending.append((path, tmp_path, None, None, fingerprint))
+            self.bytes += size
+
+    def patch(self, path, offset, data, fingerprint):
+        with self.lock:
+            self.pending.append((path, None, offset, data, fingerprint))
+            self.bytes += len(data)
+
+    def apply(self, path, tmp_path, offset, data, fingerprint):
+        with PATH_LOCKS.hold(path):
+            if file_fingerprint(os.stat(path)) != fingerprint:
+                if tmp_path: os.remove(tmp_path)
+                return WRITE_CONFLICT
+            if tmp_path: os.replace(tmp_path, path)
+            else: write_in_place(path, offset, data, sync=False)
+
+    def flush(self, directories, paths):
+        if self.sync_each:
+            for path in paths: fsync_path(path)
+            for directory in directories: fsync_dir(directory)
+            return
+        devices = {}
+        for directory in directories: devices.setdefault(os.stat(directory).st_dev, directory)
+        for directory in devices.values(): sync_filesystem(directory)
+
+    def commit(self):
+        # {path: error message or None} for every pending write
+        with self.lock:
+            pending, self.pending, self.bytes = self.pending, [], 0
+        directories = {os.path.dirname(os.path.abspath(item[0])) for item in pending}
+        results, patched = {}, []
+        try:
+            if not self.sync_each: self.flush(directories, ())
+        except OSError as e:
+            for item in pending:
+                if item[1] and os.path.exists(item[1]): os.remove(item[1])
+            return {item[0]: str(e) for item in pending}
+        for item in pending:
+            path, tmp_path = item[0], item[1]
+            try:
+                results[path] = self.apply(*item)
+                if results[path] is None and not tmp_path: patched.append(path)
+            except OSError as e:
+                results[path] = str(e)
+                if tmp_path and os.path.exists(tmp_path): os.remove(tmp_path)
+        try:
+            self.flush(directories, patched)
+        except OSError as e:
+            results = {path: error or str(e) for path, error in results.items()}
+        return results
 
 # ============== PNG Functions ==============
-def read_png_chunks(data):
-    if data[:8] != b'\x89PNG\r\n\x1a\n':
-        raise ValueError("Not a valid PNG file")
-    chunks, pos = [], 8
-    while pos < len(data):
-        length = struct.unpack('>I', data[pos:pos+4])[0]
-        chunk_type = data[pos+4:pos+8].decode('ascii')
-        chunk_data = data[pos+8:pos+8+length]
-        crc = struct.unpack('>I', data[pos+8+length:pos+12+length])[0]
-        chunks.append((chunk_type, chunk_data, crc))
-        pos += 12 + length
-        if chunk_type == 'IEND': break
-    return chunks
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_PAD_CHUNK = 'paDd'  # ancillary, private, safe-to-copy: viewers and editors ignore or keep it
+PNG_PAD_SLACK = 256
 
 def make_chunk(chunk_type, data):
     chunk_type_bytes = chunk_type.encode('ascii')
     crc = zlib.crc32(chunk_type_bytes + data) & 0xffffffff
     return struct.pack('>I', len(data)) + chunk_type_bytes + data + struct.pack('>I', crc)
 
+def scan_png_chunks(f):
+    # Reads only the 8-byte chunk headers and seeks over the bodies.
+    # Yields (chunk_type, data_offset, length) for every chunk before IEND.
+    if f.read(8) != PNG_SIGNATURE:
+        raise ValueError("Not a valid PNG file")
+    pos = 8
+    while True:
+        header = f.read(8)
+        if len(header) < 8: return
+        length = struct.unpack('>I', header[:4])[0]
+        chunk_type = header[4:8].decode('ascii')
+        if chunk_type == 'IEND': return
+        yield chunk_type, pos + 8, length
+        pos += 12 + length
+        f.seek(pos)
+
+def parse_png_text_chunk(chunk_type, chunk_data):
+    # Returns the 'parameters' text of a tEXt/iTXt chunk, or None for any other chunk
+    if chunk_type not in ('tEXt', 'iTXt'): return None
+    chunk_data = bytes(chunk_data)
+    null_pos = chunk_data.find(b'\x00')
+    if null_pos == -1 or chunk_data[:null_pos].decode('latin-1') != 'parameters': return None
+    if chunk_type == 'tEXt':
+        return chunk_data[null_pos+1:].decode('latin-1')
+    # iTXt format: keyword\x00compression_flag\x00compression_method\x00language\x00translated_keyword\x00text
+    # Skip: keyword\x00 + compression_flag(1) + compression_method(1) + language\x00 + translated\x00
+    rest = chunk_data[null_pos+1:]
+    # compression_flag and compression_method are single bytes
+    compression_flag = rest[0]
+    # Skip compression_flag, compression_method, then find two more nulls (language, translated_keyword)
+    text_start = 2  # skip compression bytes
+    for _ in range(2):  # skip language and translated_keyword
+        next_null = rest.find(b'\x00', text_start)
+        if next_null != -1:
+            text_start = next_null + 1
+    text_data = rest[text_start:]
+    if compression_flag == 0:
+        return text_data.decode('utf-8')
+    return zlib.decompress(text_data).decode('utf-8')
+
 def extract_png_metadata(png_path):
+    # The first 'parameters' chunk wherever it is, as the writer replaces it. A1111 writes it
+    # before the pixel data, so the walk usually ends ahead of the first IDAT; only text chunk
+    # bodies are actually read.
     with open(png_path, 'rb') as f:
-        data = f.read()
-    for chunk_type, chunk_data, _ in read_png_chunks(data):
-        if chunk_type == 'tEXt':
-            null_pos = chunk_data.find(b'\x00')
-            if null_pos != -1 and chunk_data[:null_pos].decode('latin-1') == 'parameters':
-                return chunk_data[null_pos+1:].decode('latin-1')
-        elif chunk_type == 'iTXt':
-            # iTXt format: keyword\x00compression_flag\x00compression_method\x00language\x00translated_keyword\x00text
-            null_pos = chunk_data.find(b'\x00')
-            if null_pos != -1 and chunk_data[:null_pos].decode('latin-1') == 'parameters':
-                # Skip: keyword\x00 + compression_flag(1) + compression_method(1) + language\x00 + translated\x00
-                rest = chunk_data[null_pos+1:]
-                # compression_flag and compression_method are single bytes
-                compression_flag = rest[0]
-                # Skip compression_flag, compression_method, then find two more nulls (language, translated_keyword)
-                text_start = 2  # skip compression bytes
-                for _ in range(2):  # skip language and translated_keyword
-                    next_null = rest.find(b'\x00', text_start)
-                    if next_null != -1:
-                        text_start = next_null + 1
-                text_data = rest[text_start:]
-                if compression_flag == 0:
-                    return text_data.decode('utf-8')
-                else:
-                    import zlib
-                    return zlib.decompress(text_data).decode('utf-8')
+        for chunk_type, offset, length in scan_png_chunks(f):
+            if chunk_type not in ('tEXt', 'iTXt'): continue
+            f.seek(offset)
+            text = parse_png_text_chunk(chunk_type, f.read(length))
+            if text is not None: return text
     return ""
 
-def write_png_metadata(png_path, metadata_text, create_backup=True):
-    with open(png_path, 'rb') as f:
-        data = f.read()
-    chunks = read_png_chunks(data)
-    new_data = b'\x89PNG\r\n\x1a\n'
-    written = False
-    for chunk_type, chunk_data, _ in chunks:
-        # Handle both tEXt and iTXt chunks with 'parameters' keyword
-        if chunk_type in ('tEXt', 'iTXt'):
-            null_pos = chunk_data.find(b'\x00')
-            if null_pos != -1 and chunk_data[:null_pos].decode('latin-1') == 'parameters':
-                # Write as tEXt (simpler, works with A1111)
-                new_data += make_chunk('tEXt', b'parameters\x00' + metadata_text.encode('latin-1', errors='replace'))
-                written = True
+def make_pad_chunk(size):
+    # Filler chunk occupying exactly size bytes (header and CRC included, so size >= 12)
+    return make_chunk(PNG_PAD_CHUNK, b'\x00' * (size - 12))
+
+def plan_png_splice(f, new_chunk):
+    # Builds the output as (offset, length) ranges of the source plus the new 'parameters' chunk.
+    # Only chunk headers (and the keyword of text chunks) are read; every other chunk,
+    # IDAT included, is copied verbatim with its original CRC. The new chunk replaces the first
+    # 'parameters' chunk wherever it is (the one extract_png_metadata reads); without one it
+    # goes before the first IDAT.
+    # Also returns the (offset, length) region held by the old 'parameters' chunk and the
+    # padding right after it, or None when there is no single such chunk to overwrite.
+    segments, copy_from, written, region, found, before_idat = [], 0, False, None, 0, None
+    for chunk_type, offset, length in scan_png_chunks(f):
+        start, end = offset - 8, offset + length + 4
+        if chunk_type == PNG_PAD_CHUNK:
+            # Old padding is dropped, or absorbed into the region when it directly follows it
+            if region and region[0] + region[1] == start: region = (region[0], end - region[0])
+            segments.append((copy_from, start - copy_from))
+            copy_from = end
+            continue
+        if chunk_type in ('tEXt', 'iTXt') and length >= 11:
+            f.seek(offset)
+            if f.read(11) == b'parameters\x00':
+                # Replace the first 'parameters' chunk in place, drop any duplicates
+                segments.append((copy_from, start - copy_from))
+                if not written: segments.append(new_chunk)
+                if not found: region = (start, end - start)
+                copy_from, written, found = end, True, found + 1
                 continue
-        if chunk_type == 'IDAT' and not written:
-            new_data += make_chunk('tEXt', b'parameters\x00' + metadata_text.encode('latin-1', errors='replace'))
-            written = True
-        new_data += make_chunk(chunk_type, chunk_data)
-    if create_backup:
-        backup = png_path + '.backup'
-        if not os.path.exists(backup): shutil.copy2(png_path, backup)
-    with open(png_path, 'wb') as f:
-        f.write(new_data)
+        if chunk_type == 'IDAT' and before_idat is None:
+            segments.append((copy_from, start - copy_from))
+            copy_from, before_idat = start, len(segments)
+    if not written and before_idat is not None:
+        segments.insert(before_idat, new_chunk)
+        written = True
+    size = os.fstat(f.fileno()).st_size
+    # Whatever follows the last visited chunk (IDAT run, IEND) is one contiguous range
+    tail = [(copy_from, size - copy_from)]
+    if not written:
+        # No IDAT before IEND: put the chunk right before IEND
+        tail = [(copy_from, size - copy_from - 12), new_chunk, (size - 12, 12)]
+    segments = [seg for seg in segments + tail if not isinstance(seg, tuple) or seg[1] > 0]
+    return segments, (region if found == 1 else None)
+
+def fit_png_region(region_length, chunk):
+    # The new chunk fits if it fills the region exactly or leaves room for a filler chunk
+    spare = region_length - len(chunk)
+    if spare == 0: return chunk
+    if spare >= 12: return chunk + make_pad_chunk(spare)
+    return None
+
+def png_parameters_type(f):
+    # Chunk type of the file's 'parameters' chunk ('tEXt' or 'iTXt'), or None
+    for chunk_type, offset, length in scan_png_chunks(f):
+        if chunk_type in ('tEXt', 'iTXt') and length >= 11:
+            f.seek(offset)
+            if f.read(11) == b'parameters\x00': return chunk_type
+    return None
+
+def make_parameters_chunk(metadata_text, chunk_type='tEXt'):
+    # tEXt (simpler, works with A1111) when asked for and the text is Latin-1; otherwise
+    # uncompressed iTXt with empty language and translated keyword, as A1111 writes it
+    if chunk_type == 'tEXt':
+        try:
+            return make_chunk('tEXt', b'parameters\x00' + metadata_text.encode('latin-1'))
+        except UnicodeEncodeError:
+            pass
+    return make_chunk('iTXt', b'parameters\x00\x00\x00\x00\x00' + metadata_text.encode('utf-8'))
+
+def write_png_metadata(png_path, metadata_text, create_backup=True, group=None):
+    # Keeps the chunk type the file already uses. Returns the text as extract_png_metadata
+    # will read it back.
+    with open(png_path, 'rb') as f:
+        new_chunk = make_parameters_chunk(metadata_text, png_parameters_type(f) or 'tEXt')
+        f.seek(0)
+        # A full rewrite leaves PNG_PAD_SLACK bytes of padding so the next small edit fits in place
+        segments, region = plan_png_splice(f, new_chunk + make_pad_chunk(12 + PNG_PAD_SLACK))
+        # Patching in place would also change every other hard link to this inode
+        fits = region and os.fstat(f.fileno()).st_nlink == 1 and in_one_block(*region)
+        patch = fit_png_region(region[1], new_chunk) if fits else None
+    if patch is not None:
+        patch_file(png_path, region[0], patch, create_backup, group)
+    else:
+        splice_file(png_path, segments, create_backup, group)
+    return metadata_text
 
 # ============== JPG Functions ==============
+JPEG_SOI = b'\xff\xd8'
+JPEG_APP0, JPEG_APP1, JPEG_SOS, JPEG_EOI = 0xE0, 0xE1, 0xDA, 0xD9
+EXIF_HEADER = b'Exif\x00\x00'
+EXIF_IFD_POINTER, EXIF_USER_COMMENT = 0x8769, 0x9286
+USER_COMMENT_UNICODE = b'UNICODE\x00'
+
+def scan_jpeg_segments(f):
+    # Walks the marker segments ahead of the entropy-coded data, seeking over their bodies.
+    # Yields (marker, offset, length): offset is the 0xFF of the marker, length the segment's
+    # own length field (it counts itself), so the payload is length - 2 bytes at offset + 4.
+    if f.read(2) != JPEG_SOI:
+        raise ValueError("Not a valid JPEG file")
+    pos = 2
+    while True:
+        f.seek(pos)
+        head = f.read(4)
+        if len(head) < 2 or head[0] != 0xFF:
+            raise ValueError("Corrupt JPEG marker at offset %d" % pos)
+        marker = head[1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in (JPEG_SOS, JPEG_EOI): return
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # standalone markers have no length
+            pos += 2
+            continue
+        if len(head) < 4:
+            raise ValueError("Corrupt JPEG marker at offset %d" % pos)
+        length = struct.unpack('>H', head[2:4])[0]
+        yield marker, pos, length
+        pos += 2 + length
+
+def find_exif_segment(f):
+    # Returns (offset, length, tiff_bytes) of the APP1 Exif segment, or None
+    for marker, pos, length in scan_jpeg_segments(f):
+        if marker != JPEG_APP1: continue
+        f.seek(pos + 4)
+        payload = f.read(length - 2)
+        if payload[:6] == EXIF_HEADER:
+            return pos, length, payload[6:]
+    return None
+
+def find_ifd_entry(tiff, endian, ifd_offset, tag):
+    # Returns the offset of the 12-byte IFD entry for tag, or None
+    count = struct.unpack_from(endian + 'H', tiff, ifd_offset)[0]
+    for i in range(count):
+        entry = ifd_offset + 2 + 12 * i
+        if struct.unpack_from(endian + 'H', tiff, entry)[0] == tag:
+            return entry
+    return None
+
+def find_user_comment(tiff):
+    # Follows IFD0 -> Exif IFD -> UserComment. Returns (endian, entry_offset, count, value_offset) or None
+    if tiff[:4] not in (b'II*\x00', b'MM\x00*'):
+        raise ValueError("Invalid TIFF header in EXIF")
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd0 = struct.unpack_from(endian + 'I', tiff, 4)[0]
+    pointer = find_ifd_entry(tiff, endian, ifd0, EXIF_IFD_POINTER)
+    if pointer is None: return None
+    exif_ifd = struct.unpack_from(endian + 'I', tiff, pointer + 8)[0]
+    entry = find_ifd_entry(tiff, endian, exif_ifd, EXIF_USER_COMMENT)
+    if entry is None: return None
+    count = struct.unpack_from(endian + 'I', tiff, entry + 4)[0]
+    # Values of up to 4 bytes live in the entry itself
+    value_offset = entry + 8 if count <= 4 else struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+    if value_offset + count > len(tiff):
+        raise ValueError("UserComment points outside the EXIF segment")
+    return endian, entry, count, value_offset
+
+def decode_user_comment(value):
+    # The first 8 bytes name the character set; A1111 (piexif) writes UNICODE as UTF-16BE
+    prefix, text = value[:8], value[8:]
+    if prefix == USER_COMMENT_UNICODE:
+        if text[:2] in (b'\xff\xfe', b'\xfe\xff'): return text.decode('utf-16').rstrip('\x00')
+        return text.decode('utf-16be', errors='replace').rstrip('\x00')
+    if prefix == b'ASCII\x00\x00\x00':
+        return text.decode('latin-1').rstrip('\x00')
+    return text.decode('utf-8', errors='replace').rstrip('\x00')
+
+def set_user_comment(tiff, value):
+    # Returns the TIFF block with UserComment set to value. Offsets of every other
+    # field stay valid: the value is overwritten in place when it fits, else appended.
+    found = find_user_comment(tiff)
+    if found is None:
+        raise ValueError("Cannot find metadata section")
+    endian, entry, count, value_offset = found
+    tiff = bytearray(tiff)
+    if count > 4 and len(value) <= count:
+        tiff[value_offset:value_offset+count] = value + b'\x00' * (count - len(value))
+        new_offset = value_offset
+    elif count > 4 and value_offset + count == len(tiff):
+        tiff[value_offset:] = value
+        new_offset = value_offset
+    else:
+        if count > 4: tiff[value_offset:value_offset+count] = b'\x00' * count
+        if len(tiff) % 2: tiff.append(0)  # TIFF offsets are word aligned
+        new_offset = len(tiff)
+        tiff += value
+    struct.pack_into(endian + 'HII', tiff, entry + 2, 7, len(value), new_offset)
+    return bytes(tiff)
+
+def make_exif_tiff(value):
+    # Minimal big-endian TIFF: IFD0 with only the Exif IFD pointer, Exif IFD with only UserComment
+    ifd0 = struct.pack('>HHHII', 1, EXIF_IFD_POINTER, 4, 1, 26) + struct.pack('>I', 0)
+    exif_ifd = struct.pack('>HHHII', 1, EXIF_USER_COMMENT, 7, len(value), 44) + struct.pack('>I', 0)
+    return b'MM\x00*' + struct.pack('>I', 8) + ifd0 + exif_ifd + value
+
+def make_jpeg_segment(marker, payload):
+    if len(payload) + 2 > 0xFFFF:
+        raise ValueError("Metadata too large for a JPEG segment")
+    return bytes((0xFF, marker)) + struct.pack('>H', len(payload) + 2) + payload
+
 def extract_jpg_metadata(jpg_path):
+    # Only the header segments before SOS are read, never the image data
     with open(jpg_path, 'rb') as f:
-        data = f.read()
-    try:
-        start, end = data.find(b'\x00<'), data.find(b'\xff\xdb')
-        if start == -1 or end == -1: return ""
-        return data[start:end].decode('utf-16be')
-    except: return ""
+        try:
+            exif = find_exif_segment(f)
+            found = find_user_comment(exif[2]) if exif else None
+        except (ValueError, struct.error):
+            return ""
+    if found is None: return ""
+    _, _, count, value_offset = found
+    return decode_user_comment(exif[2][value_offset:value_offset+count])
 
-def write_jpg_metadata(jpg_path, metadata_text, create_backup=True):
+def write_jpg_metadata(jpg_path, metadata_text, create_backup=True, group=None):
+    # Returns the text as extract_jpg_metadata will read it back (trailing NULs are padding there)
+    value = USER_COMMENT_UNICODE + metadata_text.encode('utf-16be')
     with open(jpg_path, 'rb') as f:
-        data = f.read()
-    start, end = data.find(b'\x00<'), data.find(b'\xff\xdb')
-    if start == -1 or end == -1:
-        raise ValueError("Cannot find metadata section")
-    new_data = data[:start] + metadata_text.encode('utf-16be') + data[end:]
-    if create_backup:
-        backup = jpg_path + '.backup'
-        if not os.path.exists(backup): shutil.copy2(jpg_path, backup)
-    with open(jpg_path, 'wb') as f:
-        f.write(new_data)
+        exif = find_exif_segment(f)
+        if exif is None:
+            # No EXIF at all: add a fresh APP1 after SOI and any JFIF APP0 segments
+            f.seek(0)
+            insert_at = 2
+            for marker, pos, length in scan_jpeg_segments(f):
+                if marker != JPEG_APP0: break
+                insert_at = pos + 2 + length
+            start, end = insert_at, insert_at
+            segment = make_jpeg_segment(JPEG_APP1, EXIF_HEADER + make_exif_tiff(value))
+        else:
+            start, length, tiff = exif
+            end = start + 2 + length
+            segment = make_jpeg_segment(JPEG_APP1, EXIF_HEADER + set_user_comment(tiff, value))
+        size, nlink = os.fstat(f.fileno()).st_size, os.fstat(f.fileno()).st_nlink
+    if end - start == len(segment) and nlink == 1 and in_one_block(start, len(segment)):
+        # Same-size segment (the comment shrank or kept its length): overwrite it in place
+        patch_file(jpg_path, start, segment, create_backup, group)
+    else:
+        splice_file(jpg_path, [seg for seg in [(0, start), segment, (end, size - end)]
+                               if not isinstance(seg, tuple) or seg[1] > 0], create_backup, group)
+    return metadata_text.rstrip('\x00')
+
+# ============== Worker Pool ==============
+BATCH_WORKERS = int(os.environ.get('METADATA_EDITOR_WORKERS', 0)) or min(32, (os.cpu_count() or 1) * 4)
+
+def run_parallel(fn, items, workers=None, window=None):
+    # Runs fn over items on a thread pool (the work is file I/O, which releases the GIL) and
+    # yields (item, result, error) as tasks finish. At most window tasks are in flight, so
+    # memory stays bounded however many items there are. Filling the window stops at the first
+    # finished task, so a slow items source doesn't hold back results.
+    workers = workers or BATCH_WORKERS
+    window = window or workers * 4
+    items, end = iter(items), object()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        try:
+            while True:
+                while items is not None and len(pending) < window and not any(f.done() for f in pending):
+                    item = next(items, end)
+                    if item is end: items = None
+                    else: pending[pool.submit(fn, item)] = item
+                if not pending: return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        yield item, future.result(), None
+                    except Exception as e:
+                        yield item, None, e
+        finally:
+            # Stopped early (consumer gave up): don't start what hasn't started yet
+            for future in pending: future.cancel()
+
+# ============== Metadata Index ==============
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+DATA_DIR = os.path.join(os.path.expanduser('~'), '.a1111-metadata-editor')
+INDEX_PATH = os.environ.get('METADATA_EDITOR_INDEX') or os.path.join(DATA_DIR, 'index.sqlite3')
+LOCK_DIR = os.environ.get('METADATA_EDITOR_LOCKS') or os.path.join(DATA_DIR, 'locks')  # see PathLocks
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+def extract_metadata(path):
+    return extract_png_metadata(path) if path.lower().endswith('.png') else extract_jpg_metadata(path)
+
+def write_metadata(path, metadata_text, create_backup=True, previous=None, group=None):
+    # create_backup is False, True (BACKUP_MODE) or one of BACKUP_MODES. A journal backup
+    # records previous, the text being replaced (read from the file when not given). Whole-file
+    # backups are made first, so a hard-linked one already keeps the writer from patching in place.
+    # With a WriteGroup the write becomes visible and durable at the group's commit.
+    # Returns the text as it will be read back, which is what caches and the index must hold.
+    # A failed write takes its backup back (see edit_landed), so it doesn't pose as an edit.
+    mode, sync = backup_mode(create_backup), group is None or group.sync_each
+    with PATH_LOCKS.hold(path):
+        fresh = mode in ('copy', 'link') and not os.path.exists(path + '.backup')
+        if mode == 'journal':
+            journal_record(path, extract_metadata(path) if previous is None else previous, sync)
+        elif mode:
+            make_backup(path, mode, sync)
+        try:
+            return (write_png_metadata if path.lower().endswith('.png') else write_jpg_metadata)(path, metadata_text, False, group)
+        except Exception:
+            if not edit_landed(path, metadata_text):
+                if mode == 'journal': JOURNAL.append(path, {'undo': 1, 'time': time.time()}, sync)
+                elif fresh: os.remove(path + '.backup')
+            raise
+
+def file_fingerprint(st):
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+MEMORY_CACHE_ENTRIES = int(os.environ.get('METADATA_EDITOR_MEMCACHE_ENTRIES', 20000))
+MEMORY_CACHE_BYTES = int(os.environ.get('METADATA_EDITOR_MEMCACHE_MB', 64)) << 20
+
+class MetadataCache:
+    # Extracted text held in memory in front of the index, least recently used evicted first.
+    # An entry only answers for the (size, mtime_ns) it was read at, so a rewritten file
+    # misses without any invalidation.
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries, self.max_bytes = max_entries, max_bytes
+        self.entries = OrderedDict()  # path -> (size, mtime_ns, metadata, cost in bytes)
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, st):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[:2] == (st.st_size, st.st_mtime_ns):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, path, st, metadata):
+        cost = sys.getsizeof(path) + sys.getsizeof(metadata)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old: self.bytes -= old[3]
+            if cost > self.max_bytes: return
+            self.entries[path] = (st.st_size, st.st_mtime_ns, metadata, cost)
+            self.bytes += cost
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.bytes -= self.entries.popitem(last=False)[1][3]
+
+    def discard(self, path):
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old: self.bytes -= old[3]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+class MetadataIndex:
+    # Extracted 'parameters' text cached on disk, keyed by absolute path and validated
+    # against (size, mtime_ns, inode) so only files that changed are parsed again.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, folder TEXT NOT NULL, name TEXT NOT NULL,
+            size INTEGER, mtime_ns INTEGER, inode INTEGER, metadata TEXT, error TEXT);
+        CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+        CREATE TABLE IF NOT EXISTS dirs (path TEXT, scope TEXT, mtime_ns INTEGER, PRIMARY KEY (path, scope));
+        CREATE TABLE IF NOT EXISTS library_roots (path TEXT PRIMARY KEY, include TEXT, exclude TEXT);
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(metadata, content='files', content_rowid='rowid');
+        CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, metadata) VALUES (new.rowid, new.metadata);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, metadata) VALUES ('delete', old.rowid, old.metadata);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, metadata) VALUES ('delete', old.rowid, old.metadata);
+            INSERT INTO files_fts (rowid, metadata) VALUES (new.rowid, new.metadata);
+        END;
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.memory = MetadataCache(MEMORY_CACHE_ENTRIES, MEMORY_CACHE_BYTES)
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self.conn()
+        has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_fts'").fetchone()
+        dir_columns = [row[1] for row in conn.execute('PRAGMA table_info(dirs)')]
+        if dir_columns and 'scope' not in dir_columns:
+            with conn: conn.execute('DROP TABLE dirs')  # marks without their scope: rescan once
+        conn.executescript(self.SCHEMA)
+        if not has_fts:
+            # Index created before full-text search existed: fill the FTS table from it once
+            with conn: conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+
+    def conn(self):
+        # sqlite3 connections can't be shared between threads, Flask serves requests on several
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # INSERT OR REPLACE must fire the delete trigger too, or the FTS table keeps stale rows
+            conn.execute('PRAGMA recursive_triggers=ON')
+        return conn
+
+    def upsert(self, conn, path, st, metadata, error=None):
+        conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (path, os.path.dirname(path), os.path.basename(path)) + file_fingerprint(st) + (metadata, error))
+        # Write-through: saves and batch rewrites are served from memory right away
+        if error is None: self.memory.put(path, st, metadata)
+        else: self.memory.discard(path)
+
+    def get(self, path):
+        # Metadata of one file, parsed only if the stored fingerprint is stale
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        metadata = self.memory.get(path, st)
+        if metadata is not None: return metadata
+        conn = self.conn()
+        row = conn.execute('SELECT size, mtime_ns, inode, metadata, error FROM files WHERE path = ?', (path,)).fetchone()
+        if row and tuple(row[:3]) == file_fingerprint(st) and row[4] is None:
+            self.memory.put(path, st, row[3])
+            return row[3]
+        metadata = extract_metadata(path)
+        with conn: self.upsert(conn, path, st, metadata)
+        return metadata
+
+    def update(self, path, metadata):
+        # Write-through after this process rewrote the file
+        path = os.path.abspath(path)
+        conn = self.conn()
+        with conn: self.upsert(conn, path, os.stat(path), metadata)
+
+    def store(self, path, st, metadata, error=None):
+        conn = self.conn()
+        with conn: self.upsert(conn, os.path.abspath(path), st, metadata, error)
+
+    def lookup(self, paths):
+        # {path: (fingerprint, metadata, error)} for the stored rows among absolute paths
+        conn, rows = self.conn(), {}
+        for i in range(0, len(paths), 500):  # stays under SQLite's bound parameter limit
+            chunk = paths[i:i + 500]
+            for row in conn.execute('SELECT path, size, mtime_ns, inode, metadata, error FROM files WHERE path IN (%s)'
+                                    % ','.join('?' * len(chunk)), chunk):
+                rows[row[0]] = (tuple(row[1:4]), row[4], row[5])
+        return rows
+
+    def store_many(self, rows):
+        # [(absolute path, stat, metadata)] in one transaction
+        conn = self.conn()
+        with conn:
+            for path, st, metadata in rows: self.upsert(conn, path, st, metadata)
+
+    def fingerprint(self, path):
+        # (size, mtime_ns) the stored row was parsed at, or None
+        row = self.conn().execute('SELECT size, mtime_ns FROM files WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        return tuple(row) if row else None
+
+    def forget(self, path):
+        # Drops the row of a deleted file; returns its fingerprint like fingerprint()
+        path = os.path.abspath(path)
+        self.memory.discard(path)
+        old = self.fingerprint(path)
+        if old:
+            conn = self.conn()
+            with conn: conn.execute('DELETE FROM files WHERE path = ?', (path,))
+        return old
+
+    def scan(self, folder):
+        # One scandir pass over folder, matched against the stored fingerprints. Rows of vanished
+        # files are dropped. Returns [(name, stat, cached)], cached being (metadata, error) for
+        # unchanged files and None for new or modified ones.
+        folder = os.path.abspath(folder)
+        conn = self.conn()
+        known = {row[0]: (tuple(row[1:4]), row[4], row[5]) for row in conn.execute(
+            'SELECT name, size, mtime_ns, inode, metadata, error FROM files WHERE folder = ?', (folder,))}
+        entries = []
+        for entry in os.scandir(folder):
+            if not is_image(entry.name) or not entry.is_file(): continue
+            st = entry.stat()
+            cached = known.pop(entry.name, None)
+            fresh = cached and cached[0] == file_fingerprint(st)
+            entries.append((entry.name, st, cached[1:] if fresh else None))
+        if known:
+            with conn: conn.executemany('DELETE FROM files WHERE path = ?', [(os.path.join(folder, name),) for name in known])
+        return entries
+
+    def parse_changed(self, folder, changed, workers=None):
+        # Parses [(name, stat)] of folder on the pool and stores the rows from this thread's
+        # connection. Yields (name, metadata, error) as files finish.
+        folder = os.path.abspath(folder)
+        conn = self.conn()
+        with conn:
+            for (name, st), metadata, error in run_parallel(lambda item: extract_metadata(os.path.join(folder, item[0])), changed, workers):
+                error = str(error) if error else None
+                self.upsert(conn, os.path.join(folder, name), st, metadata or '', error)
+                yield name, metadata or '', error
+
+    def refresh(self, folder, workers=None):
+        # Re-parses new or changed images only. Returns [(name, metadata, error)] sorted by name.
+        entries = self.scan(folder)
+        result = [(name,) + cached for name, _, cached in entries if cached]
+        result += self.parse_changed(folder, [(name, st) for name, st, cached in entries if not cached], workers)
+        return sorted(result)
+
+    def dir_indexed(self, path, scope, mtime_ns):
+        # True when path's images selected by scope (see scan_library) were all indexed while its
+        # mtime was mtime_ns
+        row = self.conn().execute('SELECT mtime_ns FROM dirs WHERE path = ? AND scope = ?', (path, scope)).fetchone()
+        return bool(row) and row[0] == mtime_ns
+
+    def mark_dir(self, path, scope, mtime_ns):
+        conn = self.conn()
+        with conn: conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (path, scope, mtime_ns))
+
+    def stale(self, folder, names):
+        # [(name, stat)] of the named images in folder whose stored fingerprint is missing or out of
+        # date: a stat per file and no directory listing. Files rewritten in place are found here.
+        folder = os.path.abspath(folder)
+        known = {row[0]: tuple(row[1:]) for row in self.conn().execute(
+            'SELECT name, size, mtime_ns, inode FROM files WHERE folder = ?', (folder,))}
+        changed = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(folder, name))
+            except FileNotFoundError:
+                continue
+            if known.get(name) != file_fingerprint(st): changed.append((name, st))
+        return changed
+
+    def prune(self, root, seen):
+        # Drops rows of directories below root (inclusive) that a complete walk no longer found
+        conn = self.conn()
+        prefix = os.path.join(root, '')
+        under = '(folder = ? OR substr(folder, 1, ?) = ?)'
+        gone = [row[0] for row in conn.execute('SELECT DISTINCT folder FROM files WHERE ' + under,
+                                               (root, len(prefix), prefix)) if row[0] not in seen]
+        gone_dirs = [row[0] for row in conn.execute('SELECT DISTINCT path FROM dirs WHERE ' + under.replace('folder', 'path'),
+                                                    (root, len(prefix), prefix)) if row[0] not in seen]
+        with conn:
+            conn.executemany('DELETE FROM files WHERE folder = ?', [(d,) for d in gone])
+            conn.executemany('DELETE FROM dirs WHERE path = ?', [(d,) for d in gone_dirs])
+
+    def under(self, folder, recursive):
+        # WHERE clause and parameters for the rows of folder, or of folder and everything below it
+        if not recursive: return 'folder = ?', [folder]
+        prefix = os.path.join(folder, '')
+        return '(folder = ? OR substr(folder, 1, ?) = ?)', [folder, len(prefix), prefix]
+
+    def rows(self, folder, recursive=False):
+        # [(path, metadata)] of the parsed images, ordered by path
+        where, params = self.under(folder, recursive)
+        return self.conn().execute('SELECT path, metadata FROM files WHERE error IS NULL AND ' + where
+                                   + ' ORDER BY path', params).fetchall()
+
+    def signature(self, folder, recursive=False):
+        # Changes whenever a row of the folder is added, replaced or deleted
+        where, params = self.under(folder, recursive)
+        return tuple(self.conn().execute('SELECT count(*), max(rowid), total(mtime_ns) FROM files WHERE ' + where,
+                                         params).fetchone())
+
+    def roots(self):
+        rows = self.conn().execute('SELECT r.path, r.include, r.exclude, (SELECT count(*) FROM files f WHERE '
+                                   'f.folder = r.path OR substr(f.folder, 1, length(r.path) + 1) = r.path || ?) '
+                                   'FROM library_roots r ORDER BY r.path', (os.sep,)).fetchall()
+        return [{'path': path, 'include': json.loads(include) if include else None,
+                 'exclude': json.loads(exclude) if exclude else None, 'files': files}
+                for path, include, exclude, files in rows]
+
+    def set_root(self, path, include=None, exclude=None):
+        conn = self.conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO library_roots VALUES (?, ?, ?)', (os.path.abspath(path),
+                         json.dumps(include) if include else None, json.dumps(exclude) if exclude else None))
+
+    def remove_root(self, path):
+        conn = self.conn()
+        with conn: conn.execute('DELETE FROM library_roots WHERE path = ?', (os.path.abspath(path),))
+
+    def search(self, query, folder=None, offset=0, limit=50):
+        # FTS5 query syntax ("phrase", prefix*, AND/OR/NOT); anything FTS5 can't parse is
+        # searched as a sequence of quoted terms. Returns ([(path, snippet)], has_more).
+        sql = ("SELECT f.path, snippet(files_fts, 0, '[', ']', '…', 16) FROM files_fts "
+               "JOIN files f ON f.rowid = files_fts.rowid WHERE files_fts MATCH ?")
+        params = []
+        if folder:
+            # The folder itself and everything below it
+            folder = os.path.abspath(folder)
+            sql += ' AND (f.folder = ? OR substr(f.folder, 1, ?) = ?)'
+            prefix = os.path.join(folder, '')
+            params = [folder, len(prefix), prefix]
+        sql += ' ORDER BY rank LIMIT ? OFFSET ?'
+        params += [limit + 1, offset]
+        try:
+            rows = self.conn().execute(sql, [query] + params).fetchall()
+        except sqlite3.OperationalError:
+            quoted = ' '.join('"%s"' % term.replace('"', '""') for term in query.split())
+            rows = self.conn().execute(sql, [quoted] + params).fetchall()
+        return rows[:limit], len(rows) > limit
+
+INDEX = MetadataIndex(INDEX_PATH)
+BULK_FLUSH = 256  # parsed rows stored per transaction
+
+def iter_metadata(paths, workers=None):
+    # Yields (path, metadata, error) for many files in completion order. Index rows are fetched
+    # in one pass; workers only stat unchanged files and parse stale ones, whose rows are stored
+    # from this thread in batches.
+    items = [(path, os.path.abspath(path)) for path in paths]
+    cached = INDEX.lookup([full for _, full in items])
+
+    def load(item):
+        full = item[1]
+        st = os.stat(full)
+        metadata = INDEX.memory.get(full, st)
+        if metadata is not None: return st, metadata, False
+        row = cached.get(full)
+        if row and row[0] == file_fingerprint(st) and row[2] is None:
+            return st, row[1], False
+        return st, extract_metadata(full), True
+
+    parsed = []
+    try:
+        for (path, full), result, error in run_parallel(load, items, workers):
+            if error:
+                yield path, None, error
+                continue
+            st, metadata, fresh = result
+            if fresh:
+                parsed.append((full, st, metadata))
+                if len(parsed) >= BULK_FLUSH:
+                    INDEX.store_many(parsed)
+                    parsed = []
+            yield path, metadata, None
+    finally:
+        if parsed: INDEX.store_many(parsed)
+
+# ============== Folder Listing ==============
+LIST_SORTS = ('name', 'mtime', 'size')
+LIST_PAGE = 500
+LIST_PAGE_MAX = 5000
+
+LISTING_SNAPSHOTS = OrderedDict()  # folder -> [directory mtime_ns, [(name, has_backup)], [subdirectory], stats]
+LISTING_SNAPSHOTS_MAX = 4096  # directories, so a whole dated output tree stays cached
+LISTING_LOCK = threading.Lock()
+MTIME_GRANULARITY_NS = 2 * 10**9  # coarsest timestamps in use (FAT); SMB and ext3 are finer
+
+def scan_dir(folder):
+    # ([(name, has_backup)] sorted by name, [subdirectory names]) from one scandir pass: backup
+    # presence comes from the same directory snapshot instead of a stat per image. Reused while
+    # the directory's mtime is unchanged (adding, removing or renaming files in it bumps it),
+    # so later pages and rescans of untouched directories cost one stat. An mtime within the
+    # timestamp granularity of now could still be bumped to the same value by another change:
+    # such a snapshot is kept for scan_stats but not reused.
+    folder = os.path.abspath(folder)
+    dir_mtime = os.stat(folder).st_mtime_ns
+    scanned = time.time_ns()
+    with LISTING_LOCK:
+        cached = LISTING_SNAPSHOTS.get(folder)
+        if cached and cached[0] == dir_mtime:
+            LISTING_SNAPSHOTS.move_to_end(folder)
+            return cached[1], cached[2]
+    names, backups, subdirs = [], set(), []
+    for entry in os.scandir(folder):
+        name = entry.name
+        if name == JOURNAL_NAME:
+            backups.update(JOURNAL.names(folder))
+        elif name.endswith('.backup'):
+            backups.add(name[:-7])
+        elif is_image(name):
+            if entry.is_file(): names.append(name)
+        elif entry.is_dir(follow_symlinks=False):
+            subdirs.append(name)
+    names.sort()
+    subdirs.sort()
+    images = [(name, name in backups) for name in names]
+    if scanned - dir_mtime < MTIME_GRANULARITY_NS: dir_mtime = None
+    with LISTING_LOCK:
+        LISTING_SNAPSHOTS[folder] = [dir_mtime, images, subdirs, None]
+        if len(LISTING_SNAPSHOTS) > LISTING_SNAPSHOTS_MAX: LISTING_SNAPSHOTS.popitem(last=False)
+    return images, subdirs
+
+def scan_images(folder):
+    return scan_dir(folder)[0]
+
+def forget_listing(folder):
+    # For changes the directory mtime may not reveal (coarse timestamps, several in one tick)
+    with LISTING_LOCK: LISTING_SNAPSHOTS.pop(os.path.abspath(folder), None)
+
+def scan_stats(folder):
+    # {name: (mtime_ns, size)} of the images in folder, kept with its listing snapshot: the mtime
+    # and size sorts stat each file once per snapshot, not once per page
+    images, _ = scan_dir(folder)
+    folder = os.path.abspath(folder)
+    with LISTING_LOCK:
+        cached = LISTING_SNAPSHOTS.get(folder)
+        if cached and cached[1] is images and cached[3] is not None: return cached[3]
+    stats = {}
+    for name, _ in images:
+        try:
+            st = os.stat(os.path.join(folder, name))
+        except FileNotFoundError:
+            continue
+        stats[name] = (st.st_mtime_ns, st.st_size)
+    with LISTING_LOCK:
+        cached = LISTING_SNAPSHOTS.get(folder)
+        if cached and cached[1] is images: cached[3] = stats
+    return stats
+
+def forget_stats(folder):
+    # A file rewritten in place keeps the directory's mtime, so its cached stat is dropped here
+    with LISTING_LOCK:
+        cached = LISTING_SNAPSHOTS.get(os.path.abspath(folder))
+        if cached: cached[3] = None
+
+def glob_match(rel_path, patterns):
+    # A pattern matches the path relative to the root ('/'-separated) or just the last component,
+    # so 'grids' and '*.jpg' work at any depth and '2024-05-*/*' anchors at the root
+    base = rel_path.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(base, p) for p in patterns)
+
+def path_selected(rel_path, include=None, exclude=None):
+    if exclude and glob_match(rel_path, exclude): return False
+    return not include or glob_match(rel_path, include)
+
+def parse_globs(value):
+    # Glob list from a JSON list or a comma-separated string
+    if not value: return None
+    if isinstance(value, str): value = value.split(',')
+    return [p.strip() for p in value if p and p.strip()] or None
+
+def walk_images(root, include=None, exclude=None, workers=None, recursive=True):
+    # Yields (directory, rel_dir, [(name, has_backup)]) for root and, if recursive, every directory
+    # below it. Directories are scanned in parallel on a thread pool (I/O concurrency matters on
+    # network shares) and come out in completion order. include/exclude are glob lists: excluded
+    # directories are not descended into, images must match include (when given).
+    root = os.path.abspath(root)
+    with ThreadPoolExecutor(max_workers=workers or BATCH_WORKERS) as pool:
+        pending = {pool.submit(scan_dir, root): (root, '')}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory, rel_dir = pending.pop(future)
+                    try:
+                        images, subdirs = future.result()
+                    except OSError:
+                        continue  # vanished or unreadable
+                    prefix = rel_dir + '/' if rel_dir else ''
+                    if recursive:
+                        for sub in subdirs:
+                            if exclude and glob_match(prefix + sub, exclude): continue
+                            pending[pool.submit(scan_dir, os.path.join(directory, sub))] = (os.path.join(directory, sub), prefix + sub)
+                    yield directory, rel_dir, [(n, b) for n, b in images if path_selected(prefix + n, include, exclude)]
+        finally:
+            for future in pending: future.cancel()
+
+def collect_images(folder, recursive=False, include=None, exclude=None):
+    # [(relative path, has_backup)] sorted by relative path; '/'-separated below folder
+    if not recursive and not include and not exclude:
+        return scan_images(folder)
+    images = []
+    for _, rel_dir, found in walk_images(folder, include, exclude, recursive=recursive):
+        prefix = rel_dir + '/' if rel_dir else ''
+        images += [(prefix + n, b) for n, b in found]
+    images.sort()
+    return images
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    if not isinstance(key, list) or len(key) != 2: raise ValueError("Bad cursor")
+    return tuple(key)
+
+def list_folder(folder, sort='name', descending=False, ext=None, backup=None, cursor=None, limit=LIST_PAGE,
+                recursive=False, include=None, exclude=None):
+    # A page of images in (sort key, name) order after cursor, the key of the last item seen
+    # (keyset pagination: files appearing or vanishing between pages don't shift the rest).
+    # Returns (page [(name, has_backup)], total matching, next cursor or None); with recursive
+    # or globs, names are '/'-separated paths relative to folder.
+    images = collect_images(folder, recursive, include, exclude)
+    if ext: images = [(n, b) for n, b in images if n.lower().rsplit('.', 1)[-1] in ext]
+    if backup is not None: images = [(n, b) for n, b in images if b == backup]
+    if sort == 'name':
+        keys = [(n, n) for n, _ in images]
+    else:
+        # Only these sorts need a stat per file (scandir alone has no size on POSIX); the stats
+        # are cached per directory with its snapshot. Files gone since the scan sort first.
+        field, stats = 0 if sort == 'mtime' else 1, {}
+        keys = []
+        for n, _ in images:
+            directory, _, name = n.rpartition('/')
+            if directory not in stats: stats[directory] = scan_stats(os.path.join(folder, directory))
+            st = stats[directory].get(name)
+            keys.append((st[field] if st else 0, n))
+        order = sorted(range(len(images)), key=keys.__getitem__)
+        images, keys = [images[i] for i in order], [keys[i] for i in order]
+    if descending:
+        end = bisect.bisect_left(keys, cursor) if cursor else len(images)
+        start = max(0, end - limit)
+        page, page_keys, more = images[start:end][::-1], keys[start:end][::-1], start > 0
+    else:
+        start = bisect.bisect_right(keys, cursor) if cursor else 0
+        page, page_keys, more = images[start:start + limit], keys[start:start + limit], start + limit < len(images)
+    next_cursor = encode_cursor(list(page_keys[-1])) if page and more else None
+    return page, len(images), next_cursor
+
+# ============== Backups ==============
+BACKUP_MODES = ('journal', 'copy', 'link')
+BACKUP_MODE = os.environ.get('METADATA_EDITOR_BACKUP', 'journal')
+JOURNAL_NAME = '.metadata-journal.jsonl'
+JOURNALS_MAX = 256  # directories whose replayed journal is kept
+
+def backup_mode(value):
+    if value is True: return BACKUP_MODE
+    if not value: return None
+    if value not in BACKUP_MODES: raise ValueError("Unknown backup mode: " + str(value))
+    return value
+
+class BackupJournal:
+    # Per-directory append-only sidecar of the text each edit replaced: a JSON line per edit
+    # ({name, metadata, size, mtime_ns, time} with the file's fingerprint before the edit), per
+    # undo ({name, undo: steps}) and per restore ({name, restore: true}). Replaying it gives each
+    # file a stack of earlier versions; only their line offsets are kept in memory, and a grown
+    # journal is replayed from where the last replay stopped.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = OrderedDict()  # directory -> [bytes replayed, {name: [line offsets]}]
+
+    def state(self, directory):
+        # Caller holds self.lock
+        path = os.path.join(directory, JOURNAL_NAME)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = 0
+        state = self.states.get(directory)
+        if state is None or state[0] > size: state = [0, {}]
+        if state[0] < size:
+            with open(path, 'rb') as f:
+                f.seek(state[0])
+                offset = state[0]
+                for line in f:
+                    if not line.endswith(b'\n'): break  # torn tail of an interrupted append
+                    try:
+                        self.replay(state[1], json.loads(line), offset)
+                    except (ValueError, KeyError, TypeError):
+                        pass
+                    offset += len(line)
+            state[0] = offset
+        self.states[directory] = state
+        self.states.move_to_end(directory)
+        if len(self.states) > JOURNALS_MAX: self.states.popitem(last=False)
+        return state
+
+    @staticmethod
+    def replay(stacks, record, offset):
+        stack = stacks.setdefault(record['name'], [])
+        if 'undo' in record:
+            del stack[max(0, len(stack) - record['undo']):]
+        elif record.get('restore'):
+            del stack[:]
+        else:
+            stack.append(offset)
+        if not stack: del stacks[record['name']]
+
+    def append(self, path, record, sync=True):
+        # With sync the line is on disk before the edit it records; otherwise a WriteGroup commit
+        # flushes it first
+        directory, name = os.path.split(os.path.abspath(path))
+        line = (json.dumps(dict(record, name=name), ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            replayed = self.state(directory)[0]
+            with open(os.path.join(directory, JOURNAL_NAME), 'ab') as f:
+                if f.tell() > replayed: line = b'\n' + line  # close off a torn line
+                created = f.tell() == 0
+                f.write(line)
+                f.flush()
+                if sync: os.fsync(f.fileno())
+            if sync and created: fsync_dir(directory)
+        forget_listing(directory)
+
+    def entries(self, path):
+        # Earlier versions of path, oldest first
+        directory, name = os.path.split(os.path.abspath(path))
+        with self.lock:
+            offsets = list(self.state(directory)[1].get(name, ()))
+        if not offsets: return []
+        records = []
+        with open(os.path.join(directory, JOURNAL_NAME), 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                records.append(json.loads(f.readline()))
+        return records
+
+    def depth(self, path):
+        # Number of journaled edits that can be undone
+        directory, name = os.path.split(os.path.abspath(path))
+        with self.lock:
+            return len(self.state(directory)[1].get(name, ()))
+
+    def names(self, directory):
+        # Names in directory with something to undo
+        with self.lock:
+            return set(self.state(os.path.abspath(directory))[1])
+
+JOURNAL = BackupJournal()
+
+def journal_record(path, metadata, sync=True):
+    st = os.stat(path)
+    JOURNAL.append(path, {'metadata': metadata, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'time': time.time()},
+                   sync)
+
+def edit_landed(path, metadata):
+    # Whether a write that reported an error got its text onto disk anyway (e.g. only the final
+    # fsync failed); if not, the journal line made for it must be cancelled with an undo record
+    try:
+        return extract_metadata(path) == metadata
+    except Exception:
+        return False
+
+def has_backup(path):
+    return os.path.exists(path + '.backup') or JOURNAL.depth(path) > 0
+
+def undo_metadata(path, steps=1):
+    # Writes back the text from steps edits ago; None when the journal has nothing for path
+    entries = JOURNAL.entries(path)
+    if not entries: return None
+    steps = min(steps, len(entries))
+    metadata = write_metadata(path, entries[-steps]['metadata'], False)
+    JOURNAL.append(path, {'undo': steps, 'time': time.time()})
+    return metadata
+
+def restore_original(path):
+    # Puts back the original: the whole file from a .backup copy, otherwise the text from
+    # before the first journaled edit. Returns the restored text, or None without a backup.
+    backup, entries = path + '.backup', JOURNAL.entries(path)
+    if os.path.exists(backup):
+        if os.path.samefile(backup, path): os.remove(backup)  # rename would be a no-op
+        else: os.replace(backup, path)
+        fsync_dir(os.path.dirname(os.path.abspath(path)))
+        metadata = extract_metadata(path)
+    elif entries:
+        metadata = write_metadata(path, entries[0]['metadata'], False)
+    else:
+        return None
+    if entries: JOURNAL.append(path, {'restore': True, 'time': time.time()})
+    return metadata
+
+class SaveConflict(Exception):
+    # The file no longer holds the text a save was based on; metadata is what it holds now
+    def __init__(self, metadata):
+        Exception.__init__(self, "Metadata changed since it was loaded")
+        self.metadata = metadata
+
+SAVES = {}  # path -> save waiting for the file's lock, which later saves may join
+SAVES_LOCK = threading.Lock()
+SAVED = {}  # path -> when it was last rewritten by a save (monotonic), for SAVE_DEBOUNCE
+SAVE_DEBOUNCE = 0.25  # seconds a save right after another one to the same file holds its text
+
+def save_metadata_text(path, metadata, backup=True, base=None):
+    # Read-check-write under the file's lock. With base, the text the editor started from, a save
+    # over someone else's change raises SaveConflict instead of losing it. A save arriving while an
+    # earlier one still waits for the lock joins it when it continues it (no base, or based on its
+    # text): the file is rewritten once, with the newest text. A save within SAVE_DEBOUNCE of the
+    # file's last rewrite waits out the window first, so a burst of autosaves lands once per
+    # window. Unchanged text is not rewritten.
+    path = os.path.abspath(path)
+    with SAVES_LOCK:
+        pending = SAVES.get(path)
+        joined = pending is not None and (base is None or base == pending['metadata'])
+        if joined:
+            pending['metadata'] = metadata
+        else:
+            pending = {'metadata': metadata, 'done': threading.Event(), 'error': None}
+            SAVES.setdefault(path, pending)
+            delay = SAVED.get(path, float('-inf')) + SAVE_DEBOUNCE - time.monotonic()
+    if joined:
+        pending['done'].wait()
+        if pending['error']: raise pending['error']
+        return
+    try:
+        if delay > 0: time.sleep(delay)  # still in SAVES: saves arriving meanwhile join this one
+        with PATH_LOCKS.hold(path):
+            with SAVES_LOCK:
+                if SAVES.get(path) is pending: del SAVES[path]
+                metadata = pending['metadata']
+            current = extract_metadata(path)
+            if base is not None and current != base: raise SaveConflict(current)
+            if metadata != current:
+                st = os.stat(path)
+                INDEX.update(path, write_metadata(path, metadata, backup, current))
+                discard_renditions(path, st.st_size, st.st_mtime_ns)
+                with SAVES_LOCK:
+                    now = time.monotonic()
+                    for stale in [p for p, t in SAVED.items() if now - t > SAVE_DEBOUNCE]: del SAVED[stale]
+                    SAVED[path] = now
+    except Exception as e:
+        pending['error'] = e
+        raise
+    finally:
+        pending['done'].set()
+
+# ============== Batch Operations ==============
+def iter_index_entries(folder, recursive=False, include=None, exclude=None):
+    # (directory, rel_name, name, stat, cached) for every selected image, as MetadataIndex.scan
+    # sees it; rel_name is the '/'-separated path below folder
+    for directory, rel_dir, images in walk_images(folder, include, exclude, recursive=recursive):
+        wanted = {name for name, _ in images}
+        prefix = rel_dir + '/' if rel_dir else ''
+        for name, st, cached in INDEX.scan(directory):
+            if name in wanted: yield directory, prefix + name, name, st, cached
+
+def iter_batch(folder, plan, backup=True, workers=None, cancelled=None, recursive=False, include=None, exclude=None,
+               entries=None, dry_run=None):
+    # Yields (name, modified, error) per image as it is done; name is relative to folder.
+    # plan(metadata) returns the new metadata, or None to leave the file alone. entries replaces
+    # the folder's images with a given list (see iter_plan_entries). With dry_run nothing is
+    # written: dry_run(path, name, metadata, new_metadata) gets each file that would change,
+    # which is then reported as modified. Files unchanged
+    # since they were indexed are planned right away from the index, and only those that change
+    # go to the worker pool; new or modified files are read, planned and rewritten there, so
+    # every file is read and planned once and results stream from the first directory on.
+    # Once cancelled (a threading.Event) is set no new file is started, but files already in
+    # flight still finish and are reported. Writes are committed in WriteGroups and reported
+    # once durable.
+    cancelled = cancelled or threading.Event()
+    settled = deque()  # results decided from the index alone
+    group = WriteGroup() if dry_run is None else None
+    written = []  # (rel_name, path, new_metadata) awaiting the group commit
+    first_write = 0
+
+    def commit():
+        results, done = group.commit(), []
+        for rel_name, path, new_metadata in written:
+            error = results.get(path)
+            if error is None: INDEX.update(path, new_metadata)
+            # The journal entry of an edit that never landed would pose as a backup, or undo the other save
+            if error is not None and backup_mode(backup) == 'journal' and (
+                    error == WRITE_CONFLICT or not edit_landed(path, new_metadata)):
+                JOURNAL.append(path, {'undo': 1, 'time': time.time()})
+            done.append((rel_name, error is None, error))
+        del written[:]
+        return done
+
+    def todo():
+        # Yields None to flush settled: the no-op task comes back through the pool right away,
+        # so their progress shows even while no file needs work
+        source = entries if entries is not None else iter_index_entries(folder, recursive, include, exclude)
+        flushed = time.monotonic()
+        for directory, rel_name, name, st, cached in source:
+            if cancelled.is_set(): return
+            if settled and (len(settled) >= SETTLED_FLUSH or time.monotonic() - flushed > SETTLED_SECONDS):
+                flushed = time.monotonic()
+                yield None
+            if cached is None:
+                yield directory, rel_name, name, st, None, None
+            elif cached[1]:
+                settled.append((rel_name, False, cached[1]))
+            else:
+                new_metadata = plan(cached[0])
+                if new_metadata is None or new_metadata == cached[0]:
+                    settled.append((rel_name, False, None))
+                else:
+                    yield directory, rel_name, name, st, cached, new_metadata
+
+    def process(item):
+        # Returns (metadata, parse_error, new_metadata); write errors propagate
+        if item is None: return None
+        directory, _, name, st, cached, new_metadata = item
+        path = os.path.join(directory, name)
+        with PATH_LOCKS.hold(path) if dry_run is None else contextlib.nullcontext():
+            if cached is not None and dry_run is None and file_fingerprint(os.stat(path)) != file_fingerprint(st):
+                cached = None  # saved by someone else since it was listed: plan from the file
+            if cached is None:
+                try:
+                    metadata = extract_metadata(path)
+                except Exception as e:
+                    return '', str(e), None
+                new_metadata = plan(metadata)
+                if new_metadata is None or new_metadata == metadata:
+                    return metadata, None, None
+            else:
+                metadata = cached[0]
+            if dry_run is None: new_metadata = write_metadata(path, new_metadata, backup, metadata, group)
+            return metadata, None, new_metadata
+
+    try:
+        for item, result, error in run_parallel(process, todo(), workers):
+            while settled: yield settled.popleft()
+            if item is None: continue  # only the flush
+            directory, rel_name, name, st, cached, _ = item
+            path = os.path.join(directory, name)
+            if error:
+                yield rel_name, False, str(error)
+            elif result[2] is not None and dry_run is None:
+                if not written: first_write = time.monotonic()
+                written.append((rel_name, path, result[2]))
+            elif result[2] is not None:
+                # Parsed files are indexed anyway, so the real run reads nothing but what it rewrites
+                if cached is None: INDEX.store(path, st, result[0])
+                dry_run(path, rel_name, result[0], result[2])
+                yield rel_name, True, None
+            else:
+                if cached is None: INDEX.store(path, st, result[0], result[1])
+                yield rel_name, False, result[1]
+            if written and (len(written) >= WRITE_GROUP or group.bytes >= WRITE_GROUP_BYTES
+                            or time.monotonic() - first_write > WRITE_GROUP_SECONDS):
+                for done in commit(): yield done
+        if written:
+            for done in commit(): yield done
+        while settled: yield settled.popleft()
+    finally:
+        if written: commit()  # abandoned early: what was written still lands
+
+def iter_batch_replace(folder, find_text, replace_text, backup=True, workers=None, cancelled=None,
+                       recursive=False, include=None, exclude=None, entries=None, dry_run=None):
+    # Literal find/replace over the whole metadata text
+    plan = lambda metadata: metadata.replace(find_text, replace_text) if find_text in metadata else None
+    return iter_batch(folder, plan, backup, workers, cancelled, recursive, include, exclude, entries, dry_run)
+
+def iter_batch_edit(folder, operations, where=None, backup=True, workers=None, cancelled=None,
+                    recursive=False, include=None, exclude=None, entries=None, dry_run=None):
+    # Field operations (see apply_edit) on the images whose fields match where; a file is only
+    # rewritten when its formatted parameters actually differ
+    def plan(metadata):
+        parsed = parse_parameters(metadata)
+        if where and not fields_match(parameter_fields(parsed), where): return None
+        for edit in operations: apply_edit(parsed, edit)
+        return format_parameters(parsed)
+
+    return iter_batch(folder, plan, backup, workers, cancelled, recursive, include, exclude, entries, dry_run)
+
+SNIPPET_CONTEXT = 40  # characters shown on each side of the first match
+
+def snippet(text, start, end):
+    return ('…' if start > 0 else '') + text[max(0, start):end] + ('…' if end < len(text) else '')
+
+def preview_replace(find_text, replace_text, metadata, new_metadata):
+    # (match count, before, after) around the first match
+    at = metadata.find(find_text)
+    start, end = at - SNIPPET_CONTEXT, at + len(find_text) + SNIPPET_CONTEXT
+    return (metadata.count(find_text), snippet(metadata, start, end),
+            snippet(new_metadata, start, end + len(replace_text) - len(find_text)))
+
+def preview_edit(metadata, new_metadata):
+    # (changed field count, {field: old value}, {field: new value})
+    old, new = parameter_fields(parse_parameters(metadata)), parameter_fields(parse_parameters(new_metadata))
+    changed = [key for key in dict.fromkeys(list(old) + list(new)) if old.get(key) != new.get(key)]
+    plain = lambda value: sorted(value) if isinstance(value, frozenset) else value
+    return len(changed), {key: plain(old.get(key)) for key in changed}, {key: plain(new.get(key)) for key in changed}
+
+# Dry runs leave a plan: their parameters and the files that would change, so the real run
+# skips the scan and only revisits those files
+PLAN_RETENTION = 3600
+PLANS_MAX = 16
+PLANS = OrderedDict()  # id -> {'kind', 'params', 'entries': [(directory, rel_name, name)], 'created'}
+PLANS_LOCK = threading.Lock()
+
+def save_plan(kind, params, entries):
+    plan_id = uuid.uuid4().hex
+    with PLANS_LOCK:
+        now = time.time()
+        for old in [i for i, plan in PLANS.items() if now - plan['created'] > PLAN_RETENTION]:
+            del PLANS[old]
+        PLANS[plan_id] = {'kind': kind, 'params': params, 'entries': entries, 'created': now}
+        if len(PLANS) > PLANS_MAX: PLANS.popitem(last=False)
+    return plan_id
+
+def get_plan(plan_id):
+    with PLANS_LOCK:
+        return PLANS.get(plan_id)
+
+def iter_plan_entries(entries):
+    # iter_batch entries for a plan's files, with index rows used while still current;
+    # files deleted since the dry run are skipped
+    for i in range(0, len(entries), 500):
+        chunk = entries[i:i + 500]
+        rows = INDEX.lookup([os.path.join(directory, name) for directory, _, name in chunk])
+        for directory, rel_name, name in chunk:
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            row = rows.get(path)
+            yield directory, rel_name, name, st, row[1:] if row and row[0] == file_fingerprint(st) else None
+
+# ============== Jobs ==============
+JOB_RETENTION = 3600  # seconds a finished job stays queryable
+
+class Job:
+    # A background batch operation: counters are updated by the worker thread and
+    # watched by any number of event streams through the condition.
+    def __init__(self, kind, total=0):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = 'running'
+        self.total, self.scanned, self.modified, self.failed = total, 0, 0, 0
+        self.errors = []
+        self.started, self.finished = time.time(), None
+        self.cancelled = threading.Event()
+        self.changed = threading.Condition()
+        self.version = 0
+
+    def record(self, name, modified, error):
+        with self.changed:
+            self.scanned += 1
+            if error:
+                self.failed += 1
+                self.errors.append(f'{name}: {error}')
+            elif modified:
+                self.modified += 1
+            self.version += 1
+            self.changed.notify_all()
+
+    def advance(self, scanned=0, modified=0):
+        # Bulk progress for files settled without per-file work
+        if not scanned and not modified: return
+        with self.changed:
+            self.scanned += scanned
+            self.modified += modified
+            self.version += 1
+            self.changed.notify_all()
+
+    def finish(self, state, error=None):
+        with self.changed:
+            if error: self.errors.append(error)
+            self.state, self.finished = state, time.time()
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait(self, version, timeout):
+        # Blocks until something changed since version (or timeout); returns the current version
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def snapshot(self):
+        with self.changed:
+            elapsed = (self.finished or time.time()) - self.started
+            eta = None
+            if self.state == 'running' and self.scanned and self.total > self.scanned:
+                eta = round(elapsed / self.scanned * (self.total - self.scanned), 1)
+            snap = {'id': self.id, 'kind': self.kind, 'state': self.state, 'total': self.total,
+                    'scanned': self.scanned, 'modified': self.modified, 'failed': self.failed,
+                    'elapsed': round(elapsed, 1), 'eta': eta}
+            # The error list can be long: only sent once the job is over
+            if self.state != 'running': snap['errors'] = list(self.errors)
+            return snap
+
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+
+def start_job(kind, total, work):
+    # Runs work(job) on a daemon thread; work should check job.cancelled between files
+    job = Job(kind, total)
+    with JOBS_LOCK:
+        now = time.time()
+        for job_id in [i for i, j in JOBS.items() if j.finished and now - j.finished > JOB_RETENTION]:
+            del JOBS[job_id]
+        JOBS[job.id] = job
+
+    def run():
+        try:
+            work(job)
+            job.finish('cancelled' if job.cancelled.is_set() else 'done')
+        except Exception as e:
+            job.finish('failed', str(e))
+
+    threading.Thread(target=run, name='job-' + job.id[:8], daemon=True).start()
+    return job
+
+def get_job(job_id):
+    with JOBS_LOCK:
+        return JOBS.get(job_id)
+
+def job_events(job):
+    # Server-Sent Events: one 'data:' message per progress change (at most ~4/s),
+    # a comment line as keep-alive, and the stream ends with the final state
+    version = None
+    while True:
+        current = job.wait(version, 15)
+        if current == version:
+            if SHUTDOWN.is_set(): return
+            yield ': keep-alive\n\n'
+            continue
+        version = current
+        snap = job.snapshot()
+        yield 'data: ' + json.dumps(snap) + '\n\n'
+        if snap['state'] != 'running': return
+        time.sleep(0.25)
+
+def count_images(folder, recursive=False, include=None, exclude=None):
+    return len(collect_images(folder, recursive, include, exclude))
+
+# ============== Library ==============
+def scan_library(job, roots, workers=None, full=False):
+    # Indexes every image below the given (path, include, exclude) roots. Directories are walked
+    # in parallel. A directory whose mtime matches the one recorded after it was last indexed with
+    # the same root and globs (unless full) is not listed again: only its images are stat'ed, so
+    # files rewritten in place are still picked up, and a cancelled or interrupted scan resumes
+    # where it stopped.
+    for root, include, exclude in roots:
+        seen = set()
+        scope = json.dumps([os.path.abspath(root), include or [], exclude or []])
+        for directory, _, images in walk_images(root, include, exclude, workers):
+            if job.cancelled.is_set(): return
+            seen.add(directory)
+            try:
+                dir_mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            wanted = {name for name, _ in images}
+            if not full and INDEX.dir_indexed(directory, scope, dir_mtime):
+                changed = INDEX.stale(directory, wanted)
+                job.advance(scanned=len(wanted) - len(changed))
+            else:
+                entries = [(name, st, cached) for name, st, cached in INDEX.scan(directory) if name in wanted]
+                job.advance(scanned=sum(1 for _, _, cached in entries if cached))
+                changed = [(name, st) for name, st, cached in entries if not cached]
+            for name, _, error in INDEX.parse_changed(directory, changed, workers):
+                job.record(name, error is None, error)
+            INDEX.mark_dir(directory, scope, dir_mtime)
+        # Only a complete walk may tell which directories are gone
+        if not job.cancelled.is_set(): INDEX.prune(os.path.abspath(root), seen)
+
+# ============== Parameters ==============
+# The A1111 'parameters' text: prompt lines, an optional 'Negative prompt: ...' (may span lines)
+# and a last line of 'Key: value' pairs, values with commas JSON-quoted
+PARAM_RE = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+NEGATIVE_PREFIX = 'Negative prompt: '
+NUMBER_RE = re.compile(r'-?\d+(\.\d+)?$')
+SIZE_RE = re.compile(r'(\d+)x(\d+)$')
+LORA_TAG_RE = re.compile(r'<lora:([^:>]+)[^>]*>')
+
+def parse_parameters(text):
+    # {'prompt', 'negative_prompt' (None when absent), 'params': {key: raw value}};
+    # format_parameters turns it back into the same text
+    lines = text.split('\n')
+    params, params_line = {}, None
+    found = PARAM_RE.findall(lines[-1])
+    if len(found) >= 3:  # as A1111 decides whether the last line holds parameters
+        params, params_line = dict(found), lines.pop()
+    negative = None
+    for i, line in enumerate(lines):
+        if line.startswith(NEGATIVE_PREFIX):
+            negative = '\n'.join([line[len(NEGATIVE_PREFIX):]] + lines[i + 1:])
+            lines = lines[:i]
+            break
+    parsed = {'prompt': '\n'.join(lines), 'negative_prompt': negative, 'params': params}
+    # An empty prompt still has its (empty) line, as in '\nSteps: ...'; some tools leave it out
+    if not lines: parsed['no_prompt_line'] = True
+    # Unchanged parameters are written back byte for byte even if spaced unlike A1111
+    if params_line is not None and format_params(params) != params_line:
+        parsed['raw'] = (dict(params), params_line)
+    return parsed
+
+def format_params(params):
+    return ', '.join('%s: %s' % item for item in params.items())
+
+def format_parameters(parsed):
+    params = parsed['params']
+    raw = parsed.get('raw')
+    lines = [parsed['prompt']] if parsed['prompt'] or not parsed.get('no_prompt_line') else []
+    if parsed['negative_prompt'] is not None: lines.append(NEGATIVE_PREFIX + parsed['negative_prompt'])
+    if params: lines.append(raw[1] if raw and raw[0] == params else format_params(params))
+    return '\n'.join(lines)
+
+def quote_param(value):
+    # Raw form of a value, quoted the way A1111 does when it would break the line apart
+    value = str(value)
+    return json.dumps(value, ensure_ascii=False) if ',' in value or ':' in value or '\n' in value else value
+
+def param_value(raw):
+    # Typed value of a raw parameter: int, float or (unquoted) string
+    if len(raw) > 1 and raw[0] == raw[-1] == '"':
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return raw[1:-1]
+    if NUMBER_RE.match(raw):
+        return float(raw) if '.' in raw else int(raw)
+    return raw
+
+def parameter_fields(parsed):
+    # Flat typed fields of one image: the A1111 keys as written, plus prompt, negative_prompt,
+    # width/height (from Size) and loras (tags in the prompt and names in Lora hashes)
+    fields = {key: param_value(raw) for key, raw in parsed['params'].items()}
+    fields['prompt'] = parsed['prompt']
+    fields['negative_prompt'] = parsed['negative_prompt'] or ''
+    size = SIZE_RE.match(str(fields.get('Size', '')))
+    if size: fields['width'], fields['height'] = int(size.group(1)), int(size.group(2))
+    loras = set(LORA_TAG_RE.findall(parsed['prompt']))
+    hashes = fields.get('Lora hashes')
+    if isinstance(hashes, str):
+        loras.update(name.strip() for name, _, _ in (item.partition(':') for item in hashes.split(',')) if name.strip())
+    fields['loras'] = frozenset(loras)
+    return fields
+
+COMPARE = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+INT64 = 1 << 63
+
+class Column:
+    # One field over all rows of a ColumnStore. 'int'/'float': an array('q'/'d') with a presence
+    # bytearray; 'category': array('l') codes into the distinct strings (-1 = missing), so equality
+    # is an integer test and substrings are searched once per distinct prompt; 'set': a frozenset
+    # per row. mask() evaluates one predicate over the whole column into a 0/1 byte string.
+    def __init__(self, kind, values):
+        self.kind = kind
+        if kind in ('int', 'float'):
+            self.present = bytearray(v is not None for v in values)
+            self.values = array('q' if kind == 'int' else 'd', (0 if v is None else v for v in values))
+        elif kind == 'category':
+            self.distinct, self.index = [], {}
+            for v in values:
+                if v is not None and v not in self.index:
+                    self.index[v] = len(self.distinct)
+                    self.distinct.append(v)
+            self.values = array('l', (-1 if v is None else self.index[v] for v in values))
+        else:
+            self.values = values
+
+    @classmethod
+    def build(cls, values):
+        # Narrowest kind that holds every value
+        kinds = {type(v) for v in values if v is not None}
+        if kinds <= {int} and all(v is None or -INT64 <= v < INT64 for v in values):
+            return cls('int', values)
+        if kinds <= {int, float}:
+            return cls('float', [None if v is None else float(v) for v in values])
+        if kinds == {frozenset}:
+            return cls('set', [v or frozenset() for v in values])
+        # Anything else, prompts included, is dictionary-encoded
+        return cls('category', [None if v is None else str(v) for v in values])
+
+    def value(self, i):
+        if self.kind in ('int', 'float'):
+            return self.values[i] if self.present[i] else None
+        if self.kind == 'category':
+            return self.distinct[self.values[i]] if self.values[i] >= 0 else None
+        return sorted(self.values[i])
+
+    def mask(self, op, value):
+        values = self.values
+        if self.kind in ('int', 'float'):
+            if op == 'in':
+                wanted = {float(v) for v in value}
+                hits = bytearray(map(wanted.__contains__, values))
+            elif op in COMPARE:
+                hits = bytearray(map(COMPARE[op], values, itertools.repeat(float(value))))
+            else:
+                raise ValueError('Operator %s not supported for numbers' % op)
+            return bytes(map(operator.and_, hits, self.present))
+        if self.kind == 'category':
+            if op == '=':
+                codes = {self.index.get(str(value))}
+            elif op == '!=':
+                codes = set(range(len(self.distinct))) - {self.index.get(str(value))}
+            elif op == 'in':
+                codes = {self.index[v] for v in map(str, value) if v in self.index}
+            elif op == 'contains':
+                codes = {i for i, v in enumerate(self.distinct) if str(value) in v}
+            else:
+                raise ValueError('Operator %s not supported for text' % op)
+            return bytearray(map(codes.__contains__, values))
+        if op == 'contains':
+            return bytearray(map(operator.contains, values, itertools.repeat(str(value))))
+        if op == 'in':
+            wanted = set(map(str, value))
+            return bytearray(not wanted.isdisjoint(v) for v in values)
+        raise ValueError('Operator %s not supported for lists' % op)
+
+class ColumnStore:
+    # Parsed fields of many images in typed columns, for queries over whole folders or libraries
+    def __init__(self, names, texts):
+        self.names = names
+        rows = [parameter_fields(parse_parameters(text)) for text in texts]
+        keys = dict.fromkeys(key for row in rows for key in row)  # first-seen order
+        self.columns = {key: Column.build([row.get(key) for row in rows]) for key in keys}
+
+    def __len__(self):
+        return len(self.names)
+
+    def column(self, field):
+        if field not in self.columns: raise ValueError('Unknown field: %s' % field)
+        return self.columns[field]
+
+    def select(self, where):
+        # Row numbers matching every (field, op, value), in store order
+        mask = None
+        for field, op, value in where:
+            hits = self.column(field).mask(op, value)
+            mask = hits if mask is None else bytes(map(operator.and_, mask, hits))
+        rows = range(len(self.names))
+        return list(rows) if mask is None else list(itertools.compress(rows, mask))
+
+    def order(self, rows, field, descending=False):
+        # Missing values go last either way
+        column = self.column(field)
+        present = [i for i in rows if column.value(i) is not None]
+        present.sort(key=column.value, reverse=descending)
+        return present + [i for i in rows if column.value(i) is None]
+
+    def row(self, i, fields=None):
+        return {key: self.columns[key].value(i) for key in (fields or self.columns) if key in self.columns
+                and self.columns[key].value(i) not in (None, '', [])}
+
+QUERY_OPS = tuple(COMPARE) + ('in', 'contains')
+
+def parse_where(conditions):
+    # [(field, op, value)] from [{field, op, value}] (op defaults to '='); ValueError if malformed
+    where = []
+    for condition in conditions or []:
+        if not isinstance(condition, dict) or not isinstance(condition.get('field'), str):
+            raise ValueError('Condition needs a field')
+        op = condition.get('op', '=')
+        if op not in QUERY_OPS: raise ValueError('Unknown operator: %s' % op)
+        if op == 'in' and not isinstance(condition.get('value'), list): raise ValueError('"in" needs a list')
+        where.append((condition['field'], op, condition.get('value')))
+    return where
+
+def fields_match(fields, where):
+    # ColumnStore.select semantics for a single image
+    try:
+        return all(Column.build([fields.get(field)]).mask(op, value)[0] for field, op, value in where)
+    except (TypeError, ValueError):
+        return False  # e.g. '>' on a text field: such an image doesn't match
+
+TEXT_FIELDS = ('prompt', 'negative_prompt')
+DERIVED_FIELDS = ('width', 'height', 'loras')
+EDIT_OPS = ('set', 'remove', 'replace', 'remove_lora')
+
+def parse_edits(operations):
+    # Validated field operations; ValueError names the first bad one
+    if not isinstance(operations, list) or not operations: raise ValueError('No operations')
+    for edit in operations:
+        op = edit.get('op') if isinstance(edit, dict) else None
+        if op not in EDIT_OPS: raise ValueError('Unknown operation: %s' % op)
+        field = edit.get('field', 'prompt' if op == 'remove_lora' else None)
+        if not isinstance(field, str) or not field: raise ValueError('%s needs a field' % op)
+        if field in DERIVED_FIELDS: raise ValueError('%s is derived from other fields' % field)
+        if op == 'set' and edit.get('value') is None: raise ValueError('set needs a value')
+        if op == 'replace' and not (isinstance(edit.get('find'), str) and edit['find'] and isinstance(edit.get('replace'), str)):
+            raise ValueError('replace needs find and replace strings')
+        if op == 'remove_lora' and field not in TEXT_FIELDS: raise ValueError('remove_lora works on prompts only')
+    return operations
+
+def remove_lora_tags(text, name=None):
+    # Drops <lora:name:...> tags (every LoRA tag without a name). The separators around removed
+    # tags collapse into one, ', ' if there was a comma and ' ' otherwise, and into nothing at
+    # the start or end of a line, so no double spaces or dangling commas are left behind.
+    pattern = r'<lora:%s(?::[^>]*)?>' % (re.escape(name) if name else '[^:>]+')
+    marked = re.sub(pattern, '\x00', text)
+    if marked == text: return text
+
+    def join(m):
+        if m.start() == 0 or m.end() == len(marked) or '\n' in (marked[m.start() - 1], marked[m.end()]): return ''
+        return ', ' if ',' in m.group() else ' '
+
+    return re.sub(r'[ \t,]*\x00[ \t,\x00]*', join, marked)
+
+def apply_edit(parsed, edit):
+    # One operation on parse_parameters output:
+    #   set         field = value (adds the parameter if missing)
+    #   remove      drop the field
+    #   replace     literal find -> replace inside the field's value
+    #   remove_lora drop <lora:name:...> tags from a prompt (all without name), and the
+    #               Lora hashes entries of LoRAs no longer referenced by either prompt
+    # With 'match', only applies while the field's current value equals it.
+    op = edit['op']
+    field = edit.get('field', 'prompt' if op == 'remove_lora' else None)
+    params = parsed['params']
+    used = lambda: set(LORA_TAG_RE.findall(parsed['prompt'] + '\n' + (parsed['negative_prompt'] or '')))
+    before = used() if op == 'remove_lora' else None
+    if field in TEXT_FIELDS:
+        current = parsed[field]
+    else:
+        current = param_value(params[field]) if field in params else None
+    if 'match' in edit and (current is None or str(current) != str(edit['match'])): return
+    if op == 'set':
+        new = edit['value']
+    elif op == 'remove':
+        new = None
+    elif op == 'replace':
+        if current is None: return
+        new = str(current).replace(edit['find'], edit['replace'])
+    else:
+        new = remove_lora_tags(current or '', edit.get('name'))
+    if field == 'prompt':
+        parsed['prompt'] = '' if new is None else str(new)
+    elif field == 'negative_prompt':
+        parsed['negative_prompt'] = str(new) if new not in (None, '') else None
+    elif new is None:
+        params.pop(field, None)
+    elif current is None or str(new) != str(current):
+        params[field] = quote_param(new)  # unchanged values keep their raw form
+    if op == 'remove_lora' and 'Lora hashes' in params:
+        gone = before - used()
+        entries = [item.strip() for item in str(param_value(params['Lora hashes'])).split(',')]
+        kept = [item for item in entries if item.partition(':')[0].strip() not in gone]
+        if not kept: del params['Lora hashes']
+        elif kept != entries: params['Lora hashes'] = quote_param(', '.join(kept))
+
+COLUMN_STORES = OrderedDict()  # (folder, recursive) -> (index signature, ColumnStore)
+COLUMN_STORES_MAX = 8
+COLUMN_STORES_LOCK = threading.Lock()
+
+def column_store(folder, recursive=False):
+    # The ColumnStore of a folder (or tree), rebuilt only when its index rows changed.
+    # Names are '/'-separated paths relative to folder.
+    folder = os.path.abspath(folder)
+    if recursive:
+        for directory, _, _ in walk_images(folder):
+            INDEX.refresh(directory)
+    else:
+        INDEX.refresh(folder)
+    signature = INDEX.signature(folder, recursive)
+    key = (folder, recursive)
+    with COLUMN_STORES_LOCK:
+        cached = COLUMN_STORES.get(key)
+        if cached and cached[0] == signature:
+            COLUMN_STORES.move_to_end(key)
+            return cached[1]
+    rows = INDEX.rows(folder, recursive)
+    store = ColumnStore([os.path.relpath(path, folder).replace(os.sep, '/') for path, _ in rows],
+                        [metadata for _, metadata in rows])
+    with COLUMN_STORES_LOCK:
+        COLUMN_STORES[key] = (signature, store)
+        if len(COLUMN_STORES) > COLUMN_STORES_MAX: COLUMN_STORES.popitem(last=False)
+    return store
+
+# ============== Thumbnails ==============
+CACHE_DIR = os.environ.get('METADATA_EDITOR_CACHE') or os.path.join(DATA_DIR, 'cache')
+CACHE_BUDGET = int(os.environ.get('METADATA_EDITOR_CACHE_MB', 512)) << 20
+THUMB_SIZE = 96  # 2x the 48px list tiles
+PREVIEW_SIZES = (640, 960, 1280, 1600, 2048, 2560)  # requested widths are rounded up to one of these
+PREWARM = os.environ.get('METADATA_EDITOR_PREWARM', '1') != '0'
+
+class RenditionCache:
+    # Downscaled renditions on disk, content-addressed by (path, size, mtime_ns, spec), so a
+    # rewritten image simply misses. A hit refreshes the file's mtime; once the total passes
+    # the budget the least recently used files are deleted down to 90% of it.
+    def __init__(self, root, budget):
+        self.root, self.budget = root, budget
+        self.lock = threading.Lock()
+        self.total = None  # bytes on disk, measured on first use
+        self.evicting = False
+
+    def key(self, path, size, mtime_ns, spec):
+        raw = '\0'.join((os.path.abspath(path), str(size), str(mtime_ns), spec))
+        return hashlib.sha1(raw.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def get(self, path, spec, ext, render):
+        # Path of the cached rendition; render(src, dst) produces it on a miss
+        st = os.stat(path)
+        digest = self.key(path, st.st_size, st.st_mtime_ns, spec)
+        target = os.path.join(self.root, digest[:2], digest + ext)
+        try:
+            os.utime(target)
+            return target
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        os.close(fd)
+        try:
+            render(path, tmp_path)
+            size = os.path.getsize(tmp_path)
+            # Renders of the same rendition may race: only the bytes a replace adds are counted
+            with self.lock:
+                try:
+                    replaced = os.path.getsize(target)
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        self.added(size - replaced)
+        return target
+
+    def files(self):
+        for sub in os.scandir(self.root):
+            if sub.is_dir():
+                yield from (entry for entry in os.scandir(sub.path) if entry.is_file())
+
+    def added(self, size):
+        with self.lock:
+            if self.total is None:
+                self.total = sum(entry.stat().st_size for entry in self.files())
+            else:
+                self.total += size
+            if self.total <= self.budget or self.evicting: return
+            self.evicting = True
+        threading.Thread(target=self.evict, name='cache-evict', daemon=True).start()
+
+    def evict(self):
+        try:
+            entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in self.files()))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.budget * 0.9: break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            with self.lock: self.total = total
+        finally:
+            self.evicting = False
+
+    def discard(self, path, size, mtime_ns, spec, ext):
+        digest = self.key(path, size, mtime_ns, spec)
+        target = os.path.join(self.root, digest[:2], digest + ext)
+        with self.lock:
+            try:
+                removed = os.path.getsize(target)
+                os.remove(target)
+            except OSError:
+                return
+            if self.total is not None: self.total -= removed
+
+RENDITIONS = RenditionCache(CACHE_DIR, CACHE_BUDGET)
+
+def thumbnail_format():
+    # WebP when this Pillow build can encode it, JPEG otherwise
+    if Image is None: return 'JPEG'
+    Image.init()
+    return 'WEBP' if 'WEBP' in Image.SAVE else 'JPEG'
+
+def render_downscaled(src, dst, size, fmt, **options):
+    with Image.open(src) as im:
+        im.draft('RGB', (size, size))  # JPEG: let the decoder downscale by up to 8x
+        im.thumbnail((size, size), Image.LANCZOS)
+        if fmt == 'WEBP' and im.mode in ('RGBA', 'LA', 'P'):
+            im = im.convert('RGBA')
+        elif im.mode in ('RGBA', 'LA', 'P') and fmt == 'JPEG':
+            # JPEG has no alpha: flatten onto white instead of letting transparent pixels go black
+            im = im.convert('RGBA')
+            flat = Image.new('RGB', im.size, (255, 255, 255))
+            flat.paste(im, mask=im.getchannel('A'))
+            im = flat
+        elif im.mode != 'RGB':
+            im = im.convert('RGB')
+        im.save(dst, fmt, **options)
+
+def get_thumbnail(path):
+    fmt = thumbnail_format()
+    return RENDITIONS.get(path, 'thumb:%d' % THUMB_SIZE, '.' + fmt.lower(),
+                          lambda src, dst: render_downscaled(src, dst, THUMB_SIZE, fmt, quality=80))
+
+def preview_size(requested):
+    for size in PREVIEW_SIZES:
+        if requested <= size: return size
+    return PREVIEW_SIZES[-1]
+
+def get_preview(path, size):
+    # Progressive JPEG: the browser paints a coarse version after the first few KB
+    return RENDITIONS.get(path, 'preview:%d' % size, '.jpg', lambda src, dst: render_downscaled(
+        src, dst, size, 'JPEG', quality=85, progressive=True, optimize=True))
+
+def discard_renditions(path, size, mtime_ns):
+    # Renditions of an outdated version of path, instead of leaving them to the LRU eviction
+    RENDITIONS.discard(path, size, mtime_ns, 'thumb:%d' % THUMB_SIZE, '.' + thumbnail_format().lower())
+    for preview in PREVIEW_SIZES:
+        RENDITIONS.discard(path, size, mtime_ns, 'preview:%d' % preview, '.jpg')
+
+PREWARM_STATE = {'generation': 0}
+PREWARM_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='thumb-prewarm')
+
+def prewarm_thumbnails(paths):
+    # Renders missing thumbnails in the background; listing another folder abandons the previous run
+    PREWARM_STATE['generation'] += 1
+    generation = PREWARM_STATE['generation']
+
+    def warm(path):
+        if PREWARM_STATE['generation'] != generation: return
+        try:
+            get_thumbnail(path)
+        except Exception:
+            pass
+
+    for path in paths: PREWARM_POOL.submit(warm, path)
+
+# ============== Watcher ==============
+WATCH_MODE = os.environ.get('METADATA_EDITOR_WATCH', 'auto')  # 'poll' skips inotify, e.g. for network shares
+WATCH_POLL = float(os.environ.get('METADATA_EDITOR_POLL', 2))  # seconds between polls
+WATCH_SETTLE = 0.3  # inotify events of one file closer than this are merged
+WATCH_BACKLOG = 10000  # undelivered events per stream before it is told to reload instead
+
+class Inotify:
+    # Minimal inotify(7) binding over ctypes: one non-blocking descriptor, a watch per directory
+    IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_ONLYDIR = 0x400, 0x800, 0x4000, 0x1000000
+    IN_NONBLOCK, IN_CLOEXEC = 0x800, 0x80000
+    # Files count once closed after writing or renamed into place; IN_CREATE only matters for directories
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def remove(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        # [(wd, mask, name)] that arrived within timeout seconds
+        if not select.select([self.fd], [], [], timeout)[0]: return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events, pos = [], 0
+        while pos < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, pos)
+            events.append((wd, mask, os.fsdecode(data[pos + 16:pos + 16 + length].rstrip(b'\0'))))
+            pos += 16 + length
+        return events
+
+class WatchStream:
+    # One /api/watch client: the folders it watches below root and its undelivered events
+    def __init__(self, folder, recursive=False, include=None, exclude=None):
+        self.folder, self.root = folder, os.path.abspath(folder)
+        self.recursive, self.include, self.exclude = recursive, include, exclude
+        self.folders = set()
+        self.events = deque()
+        self.changed = threading.Condition()
+
+    def relative(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def push(self, event):
+        with self.changed:
+            if self.events and self.events[-1] == event: return  # e.g. an image and its new backup
+            if len(self.events) >= WATCH_BACKLOG:
+                # The client fell too far behind: a reload is cheaper than the backlog
+                self.events.clear()
+                event = {'type': 'rescan'}
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def pull(self, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.events or SHUTDOWN.is_set(), timeout)
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+class FolderWatcher:
+    # Folders opened by any stream are reference-counted and watched by one background thread,
+    # through inotify where available and by polling otherwise (also for folders inotify refuses,
+    # e.g. past max_user_watches). A changed file updates the index, drops renditions of its old
+    # version and the folder's listing snapshot, then goes out to the streams as one
+    # created/modified/deleted event, so nothing is rescanned.
+    def __init__(self, mode='auto', poll_interval=WATCH_POLL):
+        self.poll_interval = poll_interval
+        self.inotify = None
+        if mode != 'poll':
+            try:
+                self.inotify = Inotify()
+            except Exception:
+                pass  # not Linux: polling only
+        self.backend = 'inotify' if self.inotify else 'poll'
+        self.lock = threading.Lock()
+        self.folders = {}  # folder -> {'refs', 'wd', 'names', 'stats', 'subdirs'}
+        self.watches = {}  # inotify wd -> folder
+        self.streams = set()
+        self.thread = None
+
+    def snapshot(self, folder):
+        # ({name: (size, mtime_ns)} of images and backups, {subdirectory}) for polling
+        stats, subdirs = {}, set()
+        for entry in os.scandir(folder):
+            try:
+                if is_image(entry.name) or entry.name.endswith('.backup'):
+                    if entry.is_file():
+                        st = entry.stat()
+                        stats[entry.name] = (st.st_size, st.st_mtime_ns)
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirs.add(entry.name)
+            except OSError:
+                pass  # vanished between listing and stat
+        return stats, subdirs
+
+    def open(self, folder):
+        # State of a folder about to be watched, or None if it is gone
+        state = {'refs': 0, 'wd': None, 'stats': None, 'subdirs': None}
+        try:
+            if self.inotify:
+                try:
+                    state['wd'] = self.inotify.add(folder)
+                except OSError as e:
+                    if e.errno != errno.ENOSPC: raise
+            if state['wd'] is None:
+                state['stats'], state['subdirs'] = self.snapshot(folder)
+                state['names'] = {name for name in state['stats'] if is_image(name)}
+            else:
+                state['names'] = {name for name, _ in scan_images(folder)}
+        except OSError:
+            return None
+        return state
+
+    def attach(self, stream, folders):
+        opened = {folder: self.open(folder) for folder in folders if folder not in self.folders}
+        with self.lock:
+            for folder in folders:
+                state = self.folders.get(folder) or opened.get(folder)
+                if state is None: continue
+                if folder not in self.folders:
+                    self.folders[folder] = state
+                    if state['wd'] is not None: self.watches[state['wd']] = folder
+                state['refs'] += 1
+                stream.folders.add(folder)
+            if self.thread is None and self.folders:
+                self.thread = threading.Thread(target=self.run, name='folder-watcher', daemon=True)
+                self.thread.start()
+
+    def subscribe(self, folder, recursive=False, include=None, exclude=None):
+        stream = WatchStream(folder, recursive, include, exclude)
+        if recursive:
+            folders = [directory for directory, _, _ in walk_images(stream.root, include, exclude)]
+        else:
+            folders = [stream.root]
+        self.attach(stream, folders)
+        with self.lock: self.streams.add(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        closed = []
+        with self.lock:
+            self.streams.discard(stream)
+            for folder in stream.folders:
+                state = self.folders.get(folder)
+                if state is None: continue
+                state['refs'] -= 1
+                if state['refs'] <= 0:
+                    del self.folders[folder]
+                    if state['wd'] is not None:
+                        self.watches.pop(state['wd'], None)
+                        closed.append(state['wd'])
+            stream.folders = set()
+        for wd in closed: self.inotify.remove(wd)
+
+    def poll(self, folder, state):
+        # Names in folder that appeared, vanished or changed size or mtime since the last poll;
+        # '' when the folder itself is gone
+        try:
+            stats, subdirs = self.snapshot(folder)
+        except OSError:
+            return ['']
+        old = state['stats']
+        changed = [name for name in set(stats) | set(old) if stats.get(name) != old.get(name)]
+        changed += sorted(subdirs ^ state['subdirs'])
+        state['stats'], state['subdirs'] = stats, subdirs
+        return changed
+
+    def run(self):
+        pending, last_poll = {}, 0  # (folder, name) -> time of the latest event
+        while True:
+            with self.lock:
+                if not self.folders:
+                    self.thread = None
+                    return
+                polled = [(folder, state) for folder, state in self.folders.items() if state['wd'] is None]
+            if self.inotify:
+                for wd, mask, name in self.inotify.read(WATCH_SETTLE):
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        self.broadcast({'type': 'rescan'})
+                    elif wd in self.watches:
+                        pending[(self.watches[wd], name)] = time.time()
+            else:
+                time.sleep(WATCH_SETTLE)
+            if polled and time.time() - last_poll >= self.poll_interval:
+                last_poll = time.time()
+                for folder, state in polled:
+                    for name in self.poll(folder, state): pending[(folder, name)] = 0
+            now = time.time()
+            for key in [key for key, at in pending.items() if now - at >= WATCH_SETTLE]:
+                del pending[key]
+                try:
+                    self.apply(*key)
+                except Exception:
+                    pass  # one unreadable file must not stop the watcher
+
+    def apply(self, folder, name):
+        if not name:
+            if not os.path.isdir(folder): self.drop(folder)
+            return
+        path = os.path.join(folder, name)
+        if name.endswith('.backup'):
+            if is_image(name[:-7]) and os.path.isfile(path[:-7]): self.changed(folder, name[:-7], backup_only=True)
+        elif is_image(name):
+            self.changed(folder, name)
+        elif os.path.isdir(path):
+            self.grow(folder, name)
+        elif path in self.folders:
+            self.drop(path)
+
+    def changed(self, folder, name, backup_only=False):
+        state = self.folders.get(folder)
+        if state is None: return
+        path = os.path.join(folder, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is None:
+            if name not in state['names']: return
+            state['names'].discard(name)
+            old = INDEX.forget(path)
+            if old: discard_renditions(path, *old)
+            event = {'type': 'deleted'}
+        else:
+            kind = 'modified' if name in state['names'] else 'created'
+            state['names'].add(name)
+            if not backup_only:
+                old = INDEX.fingerprint(path)
+                if old and old != (st.st_size, st.st_mtime_ns): discard_renditions(path, *old)
+                try:
+                    INDEX.get(path)  # parsed now, so search sees it
+                except Exception:
+                    pass
+            event = self.describe(kind, path, st)
+        forget_listing(folder)
+        self.emit(folder, name, event)
+
+    def describe(self, kind, path, st):
+        return {'type': kind, 'has_backup': has_backup(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+    def emit(self, folder, name, event):
+        path = os.path.join(folder, name)
+        with self.lock: streams = [stream for stream in self.streams if folder in stream.folders]
+        for stream in streams:
+            rel_name = stream.relative(path)
+            if path_selected(rel_name, stream.include, stream.exclude):
+                stream.push(dict(event, name=rel_name, path=os.path.join(stream.folder, rel_name)))
+
+    def broadcast(self, event):
+        with self.lock: streams = list(self.streams)
+        for stream in streams: stream.push(event)
+
+    def grow(self, folder, name):
+        # A directory appeared in a watched folder: recursive streams watch it (and anything
+        # below it) too, and get its images as created
+        path = os.path.join(folder, name)
+        with self.lock:
+            streams = [stream for stream in self.streams
+                       if stream.recursive and folder in stream.folders and path not in stream.folders]
+        for stream in streams:
+            if stream.exclude and glob_match(stream.relative(path), stream.exclude): continue
+            found = list(walk_images(path, stream.include, stream.exclude))
+            self.attach(stream, [directory for directory, _, _ in found])
+            for directory, _, images in found:
+                for image, _ in images:
+                    image_path = os.path.join(directory, image)
+                    try:
+                        event = self.describe('created', image_path, os.stat(image_path))
+                    except OSError:
+                        continue
+                    rel_name = stream.relative(image_path)
+                    stream.push(dict(event, name=rel_name, path=os.path.join(stream.folder, rel_name)))
+
+    def drop(self, folder):
+        # folder was deleted or moved away: stop watching it and everything below it, report
+        # its images as deleted and drop their index rows
+        prefix = os.path.join(folder, '')
+        with self.lock:
+            gone = [(path, state) for path, state in self.folders.items() if path == folder or path.startswith(prefix)]
+        for path, state in gone:
+            for name in sorted(state['names']): self.emit(path, name, {'type': 'deleted'})
+        with self.lock:
+            for path, state in gone:
+                self.folders.pop(path, None)
+                if state['wd'] is not None: self.watches.pop(state['wd'], None)
+            for stream in self.streams: stream.folders.difference_update(path for path, _ in gone)
+        for _, state in gone:
+            if state['wd'] is not None: self.inotify.remove(state['wd'])
+        INDEX.prune(folder, set())
+        forget_listing(folder)
+
+WATCHER = FolderWatcher(WATCH_MODE)
+
+def watch_events(folder, recursive=False, include=None, exclude=None):
+    # Server-Sent Events: {"events": [...]} batches at most ~4 times a second, a comment line as
+    # keep-alive; the folders are released once the client goes away
+    stream = None
+    try:
+        stream = WATCHER.subscribe(folder, recursive, include, exclude)
+        yield 'data: ' + json.dumps({'backend': WATCHER.backend, 'events': []}) + '\n\n'
+        while not SHUTDOWN.is_set():
+            events = stream.pull(15)
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            yield 'data: ' + json.dumps({'events': events}) + '\n\n'
+            time.sleep(0.25)
+    finally:
+        if stream: WATCHER.unsubscribe(stream)
 
 # ============== HTML Template ==============
 HTML_TEMPLATE = '''<!DOCTYPE html>
@@ -251,6 +2670,19 @@ body {
 }
 .list-title { font-size: 12px; font-weight: 600; color: var(--text-secondary); text-transform: uppercase; letter-spacing: 0.5px; }
 .list-count { font-size: 12px; color: var(--text-muted); background: var(--bg-subtle); padding: 2px 8px; border-radius: 10px; }
+.list-sort {
+    margin-left: auto;
+    margin-right: 8px;
+    padding: 2px 4px;
+    font-size: 12px;
+    color: var(--text-secondary);
+    background: transparent;
+    border: 1px solid transparent;
+    border-radius: var(--radius-sm);
+    cursor: pointer;
+    outline: none;
+}
+.list-sort:hover, .list-sort:focus { border-color: var(--border-default); }
 
 .image-list {
     flex: 1;
@@ -377,6 +2809,8 @@ body {
 }
 .panel-icon { font-size: 16px; }
 .panel-title { font-size: 13px; font-weight: 600; color: var(--text-secondary); }
+.panel-link { margin-left: auto; font-size: 12px; color: var(--accent); text-decoration: none; }
+.panel-link:hover { color: var(--accent-hover); text-decoration: underline; }
 
 /* Preview Panel */
 .preview-panel { flex: 1; min-width: 280px; }
@@ -480,6 +2914,7 @@ body {
     border: 1px solid var(--border-default);
 }
 .btn-secondary:hover { background: var(--bg-subtle); border-color: var(--text-muted); }
+.btn:disabled { opacity: 0.5; cursor: default; pointer-events: none; }
 
 .checkbox-label {
     display: flex;
@@ -565,6 +3000,40 @@ body {
     gap: 12px;
 }
 
+/* Progress */
+.progress { display: none; margin-top: 4px; }
+.progress.show { display: block; }
+.progress-track {
+    height: 8px;
+    background: var(--bg-subtle);
+    border-radius: 4px;
+    overflow: hidden;
+}
+.progress-fill {
+    height: 100%;
+    width: 0;
+    background: var(--accent);
+    border-radius: 4px;
+    transition: width 0.25s ease;
+}
+.progress-text { margin-top: 8px; font-size: 12px; color: var(--text-secondary); }
+
+/* Dry run preview */
+.preview-list {
+    display: none;
+    max-height: 240px;
+    overflow-y: auto;
+    margin-top: 12px;
+    font-family: 'JetBrains Mono', monospace;
+    font-size: 11px;
+}
+.preview-list.show { display: block; }
+.preview-item { padding: 6px 0; border-bottom: 1px solid var(--border-muted); }
+.preview-name { color: var(--text-secondary); margin-bottom: 4px; }
+.preview-before, .preview-after { padding: 2px 6px; border-radius: 4px; white-space: pre-wrap; word-break: break-all; }
+.preview-before { background: var(--error-subtle); }
+.preview-after { background: var(--success-subtle); margin-top: 2px; }
+
 /* Toast */
 .toast {
     position: fixed;
@@ -617,12 +3086,22 @@ body {
                 <span class="input-icon">📁</span>
                 <input type="text" class="folder-input" id="folderPath" placeholder="Путь к папке...">
             </div>
+            <label class="checkbox-label" style="margin: 12px 0 0;">
+                <input type="checkbox" class="checkbox-input" id="recursive" onchange="if (currentFolder) loadFolder()">
+                С подпапками
+            </label>
             <button class="load-btn" onclick="loadFolder()">
                 <span>↻</span> Загрузить изображения
             </button>
         </header>
         <div class="list-header">
             <span class="list-title">Изображения</span>
+            <select class="list-sort" id="listSort" onchange="loadFolder()">
+                <option value="name">По имени</option>
+                <option value="mtime:desc">Сначала новые</option>
+                <option value="mtime">Сначала старые</option>
+                <option value="size:desc">По размеру</option>
+            </select>
             <span class="list-count" id="imageCount">0</span>
         </div>
         <div class="image-list" id="imageList"></div>
@@ -635,6 +3114,7 @@ body {
                 <header class="panel-header">
                     <span class="panel-icon">🖼</span>
                     <span class="panel-title">Превью</span>
+                    <a class="panel-link" id="originalLink" target="_blank" hidden>Оригинал ↗</a>
                 </header>
                 <div class="preview-content" id="preview">
                     <div class="empty-state">
@@ -660,6 +3140,9 @@ body {
                     <button class="btn" onclick="saveMetadata()">
                         <span>💾</span> Сохранить
                     </button>
+                    <button class="btn btn-secondary" onclick="undoMetadata()">
+                        <span>↩️</span> Отменить
+                    </button>
                     <button class="btn btn-secondary" onclick="openBatchModal()">
                         <span>🔄</span> Пакетная замена
                     </button>
@@ -695,10 +3178,16 @@ body {
                     Создавать бэкапы
                 </label>
             </div>
+            <div class="progress" id="batchProgress">
+                <div class="progress-track"><div class="progress-fill" id="batchProgressFill"></div></div>
+                <div class="progress-text" id="batchProgressText"></div>
+            </div>
+            <div class="preview-list" id="batchPreview"></div>
         </div>
         <div class="modal-footer">
-            <button class="btn btn-secondary" onclick="closeBatchModal()">Отмена</button>
-            <button class="btn" onclick="executeBatchReplace()">Заменить во всех</button>
+            <button class="btn btn-secondary" id="batchCancel" onclick="cancelBatchReplace()">Отмена</button>
+            <button class="btn btn-secondary" id="batchCheck" onclick="previewBatchReplace()">Проверить</button>
+            <button class="btn" id="batchRun" onclick="executeBatchReplace()">Заменить во всех</button>
         </div>
     </div>
 </div>
@@ -762,48 +3251,166 @@ document.onmouseup = () => {
     document.body.style.userSelect = '';
 };
 
+let nextCursor = null;
+let loadingPage = false;
+
+function listQuery(folder, cursor) {
+    const [sort, order] = document.getElementById('listSort').value.split(':');
+    let query = '/api/list?path=' + encodeURIComponent(folder) + '&sort=' + sort;
+    if (order) query += '&order=' + order;
+    if (document.getElementById('recursive').checked) query += '&recursive=1';
+    if (cursor) query += '&cursor=' + encodeURIComponent(cursor);
+    return query;
+}
+
+function thumbUrl(img) {
+    // mtime in the URL: a rewritten file gets a fresh thumbnail despite max-age
+    return '/api/thumb?path=' + encodeURIComponent(img.path) + '&v=' + img.mtime;
+}
+
+function createImageItem(img) {
+    const ext = img.name.split('.').pop().toUpperCase();
+    const div = document.createElement('div');
+    div.className = 'image-item';
+    div.dataset.path = img.path;
+    div.dataset.name = img.name;
+    div.dataset.mtime = img.mtime;
+    div.dataset.size = img.size;
+    
+    // Status: pristine (нетронутый), saved (сохранён/есть бэкап), modified (изменён, не сохранён)
+    const status = img.has_backup ? 'saved' : 'pristine';
+    const statusIcon = img.has_backup ? '✓' : '○';
+    const statusTitle = img.has_backup ? 'Редактировался' : 'Оригинал';
+    
+    imageStates[img.path] = { hasBackup: img.has_backup, modified: false };
+    
+    div.innerHTML = `
+        <div class="thumb-wrapper">
+            <img class="item-thumb" src="${thumbUrl(img)}" loading="lazy">
+            <span class="status-badge ${status}" title="${statusTitle}">${statusIcon}</span>
+        </div>
+        <div class="item-info">
+            <div class="item-name">${img.name}</div>
+            <div class="item-type">${ext}</div>
+        </div>`;
+    div.onclick = () => selectImage(img.path, div);
+    if (img.path === currentImage) div.classList.add('active');
+    return div;
+}
+
+function appendImageItem(img) {
+    document.getElementById('imageList').appendChild(createImageItem(img));
+}
+
+// A new file goes where the current sort puts it among the loaded items; past the last one
+// it is left to a later page
+function insertImageItem(img) {
+    const [sort, order] = document.getElementById('listSort').value.split(':');
+    const key = (x) => sort === 'name' ? x.name : +x[sort];
+    const before = (a, b) => {
+        const ka = key(a), kb = key(b);
+        if (ka !== kb) return (ka < kb) !== (order === 'desc');
+        return (a.name < b.name) !== (order === 'desc');
+    };
+    const list = document.getElementById('imageList');
+    const next = Array.from(list.children).find(el => before(img, el.dataset));
+    if (next) list.insertBefore(createImageItem(img), next);
+    else if (!nextCursor) list.appendChild(createImageItem(img));
+}
+
 async function loadFolder() {
     const path = document.getElementById('folderPath').value;
     if (!path) return showToast('Введите путь к папке', 'error');
     
-    const res = await fetch('/api/list?path=' + encodeURIComponent(path));
+    const res = await fetch(listQuery(path, null));
     const data = await res.json();
     if (data.error) return showToast(data.error, 'error');
     
     currentFolder = data.folder;
     imageStates = {};
+    nextCursor = data.next_cursor;
     
-    const list = document.getElementById('imageList');
-    list.innerHTML = '';
-    data.images.forEach(img => {
-        const ext = img.name.split('.').pop().toUpperCase();
-        const div = document.createElement('div');
-        div.className = 'image-item';
-        div.dataset.path = img.path;
-        
-        // Status: pristine (нетронутый), saved (сохранён/есть бэкап), modified (изменён, не сохранён)
-        const status = img.has_backup ? 'saved' : 'pristine';
-        const statusIcon = img.has_backup ? '✓' : '○';
-        const statusTitle = img.has_backup ? 'Редактировался' : 'Оригинал';
-        
-        imageStates[img.path] = { hasBackup: img.has_backup, modified: false };
-        
-        div.innerHTML = `
-            <div class="thumb-wrapper">
-                <img class="item-thumb" src="/api/thumb?path=${encodeURIComponent(img.path)}" loading="lazy">
-                <span class="status-badge ${status}" title="${statusTitle}">${statusIcon}</span>
-            </div>
-            <div class="item-info">
-                <div class="item-name">${img.name}</div>
-                <div class="item-type">${ext}</div>
-            </div>`;
-        div.onclick = () => selectImage(img.path, div);
-        list.appendChild(div);
-    });
-    document.getElementById('imageCount').textContent = data.images.length;
-    showToast(`Загружено ${data.images.length} изображений`, 'success');
+    document.getElementById('imageList').innerHTML = '';
+    data.images.forEach(appendImageItem);
+    document.getElementById('imageCount').textContent = data.total;
+    showToast(`Загружено ${data.total} изображений`, 'success');
+    watchFolder(currentFolder);
+}
+
+// Live updates: files written into the open folder show up without reloading it
+let watchEvents = null;
+
+function watchFolder(folder) {
+    if (watchEvents) watchEvents.close();
+    let query = '/api/watch?path=' + encodeURIComponent(folder);
+    if (document.getElementById('recursive').checked) query += '&recursive=1';
+    watchEvents = new EventSource(query);
+    watchEvents.onmessage = (e) => JSON.parse(e.data).events.forEach(applyFolderEvent);
 }
 
+function applyFolderEvent(ev) {
+    if (ev.type === 'rescan') return loadFolder();
+    const item = document.querySelector(`.image-item[data-path="${CSS.escape(ev.path)}"]`);
+    const count = document.getElementById('imageCount');
+    if (ev.type === 'deleted') {
+        count.textContent = Math.max(0, +count.textContent - 1);
+        if (!item) return;
+        item.remove();
+        delete imageStates[ev.path];
+        if (ev.path === currentImage) showToast('Файл удалён: ' + ev.name, 'error');
+        return;
+    }
+    if (!item) {
+        if (ev.type === 'created') count.textContent = +count.textContent + 1;
+        return insertImageItem(ev);
+    }
+    item.dataset.mtime = ev.mtime;
+    item.dataset.size = ev.size;
+    item.querySelector('.item-thumb').src = thumbUrl(ev);
+    const state = imageStates[ev.path];
+    if (state) {
+        state.hasBackup = ev.has_backup;
+        if (!state.modified) updateItemStatus(ev.path, ev.has_backup ? 'saved' : 'pristine');
+    }
+    if (ev.path === currentImage) refreshCurrentImage();
+}
+
+// The selected file changed on disk: reload the preview and, unless edited here, the metadata
+async function refreshCurrentImage() {
+    const path = currentImage;
+    const img = document.querySelector('#preview img');
+    if (img) img.src = img.src.replace(/&v=\\d+$/, '') + '&v=' + Date.now();
+    const res = await fetch('/api/metadata?path=' + encodeURIComponent(path));
+    const data = await res.json();
+    const metadata = data.metadata || '';
+    if (path !== currentImage || metadata === originalMetadata) return;
+    if (imageStates[path]?.modified) return showToast('Метаданные файла изменены на диске', 'error');
+    document.getElementById('metadata').value = metadata;
+    originalMetadata = metadata;
+    if (imageStates[path]) imageStates[path].original = metadata;
+}
+
+// Next page once the list is scrolled close to its end
+async function loadNextPage() {
+    if (!nextCursor || loadingPage) return;
+    loadingPage = true;
+    try {
+        const res = await fetch(listQuery(currentFolder, nextCursor));
+        const data = await res.json();
+        if (data.error) return showToast(data.error, 'error');
+        nextCursor = data.next_cursor;
+        data.images.forEach(appendImageItem);
+        document.getElementById('imageCount').textContent = data.total;
+    } finally {
+        loadingPage = false;
+    }
+}
+
+document.getElementById('imageList').addEventListener('scroll', (e) => {
+    const list = e.target;
+    if (list.scrollTop + list.clientHeight > list.scrollHeight - 600) loadNextPage();
+});
+
 async function selectImage(path, el) {
     // Check if current has unsaved changes
     if (currentImage && imageStates[currentImage]?.modified) {
@@ -813,7 +3420,15 @@ async function selectImage(path, el) {
     document.querySelectorAll('.image-item').forEach(e => e.classList.remove('active'));
     el.classList.add('active');
     currentImage = path;
-    document.getElementById('preview').innerHTML = `<img src="/api/image?path=${encodeURIComponent(path)}">`;
+    // Downscaled rendition sized to the panel; the original stays one click away
+    const preview = document.getElementById('preview');
+    const width = Math.ceil(Math.max(preview.clientWidth, preview.clientHeight) * (window.devicePixelRatio || 1));
+    const original = '/api/image?path=' + encodeURIComponent(path);
+    preview.innerHTML = `<img src="/api/preview?path=${encodeURIComponent(path)}&w=${width}">`;
+    preview.querySelector('img').onerror = (e) => { e.target.onerror = null; e.target.src = original; };
+    const link = document.getElementById('originalLink');
+    link.href = original;
+    link.hidden = false;
     const res = await fetch('/api/metadata?path=' + encodeURIComponent(path));
     const data = await res.json();
     const metadata = data.metadata || '';
@@ -863,11 +3478,16 @@ async function saveMetadata() {
         body: JSON.stringify({
             path: currentImage,
             metadata: document.getElementById('metadata').value,
+            base: originalMetadata,
             backup: document.getElementById('createBackup').checked
         })
     });
     const data = await res.json();
-    if (data.error) {
+    if (data.conflict) {
+        // The next save overwrites the other change on purpose
+        originalMetadata = data.metadata;
+        showToast(data.error + ' — сохраните ещё раз, чтобы перезаписать', 'error');
+    } else if (data.error) {
         showToast(data.error, 'error');
     } else {
         showToast('Сохранено!', 'success');
@@ -880,6 +3500,25 @@ async function saveMetadata() {
     }
 }
 
+async function undoMetadata() {
+    if (!currentImage) return showToast('Сначала выберите изображение', 'error');
+    const res = await fetch('/api/undo', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({ path: currentImage })
+    });
+    const data = await res.json();
+    if (data.error) return showToast(data.error, 'error');
+    showToast('Изменение отменено', 'success');
+    document.getElementById('metadata').value = data.metadata;
+    originalMetadata = data.metadata;
+    if (imageStates[currentImage]) {
+        imageStates[currentImage].modified = false;
+        imageStates[currentImage].hasBackup = data.has_backup;
+    }
+    updateItemStatus(currentImage, data.has_backup ? 'saved' : 'pristine');
+}
+
 // Batch replace modal
 function openBatchModal() {
     if (!currentFolder) return showToast('Сначала загрузите папку', 'error');
@@ -888,39 +3527,170 @@ function openBatchModal() {
 }
 
 function closeBatchModal() {
+    if (batchJob) return; // keep the progress visible until the job is over
     document.getElementById('batchModal').classList.remove('show');
     document.getElementById('findText').value = '';
     document.getElementById('replaceText').value = '';
+    document.getElementById('batchProgress').classList.remove('show');
+    resetBatchPreview();
+}
+
+let batchJob = null;
+let batchEvents = null;
+let batchPlan = null; // last dry run: { id, find, replace, recursive }
+const PREVIEW_SHOWN = 50;
+
+function resetBatchPreview() {
+    batchPlan = null;
+    const list = document.getElementById('batchPreview');
+    list.innerHTML = '';
+    list.classList.remove('show');
+}
+
+function batchPreviewItem(entry) {
+    const item = document.createElement('div');
+    item.className = 'preview-item';
+    const name = document.createElement('div');
+    name.className = 'preview-name';
+    name.textContent = entry.error ? `${entry.name}: ${entry.error}` : `${entry.name} · совпадений ${entry.changes}`;
+    item.appendChild(name);
+    if (!entry.error) {
+        for (const side of ['before', 'after']) {
+            const line = document.createElement('div');
+            line.className = 'preview-' + side;
+            line.textContent = entry[side];
+            item.appendChild(line);
+        }
+    }
+    return item;
+}
+
+async function previewBatchReplace() {
+    if (batchJob) return;
+    const find = document.getElementById('findText').value;
+    const replace = document.getElementById('replaceText').value;
+    const recursive = document.getElementById('recursive').checked;
+    if (!find) return showToast('Введите текст для поиска', 'error');
+    
+    resetBatchPreview();
+    const res = await fetch('/api/batch-replace/dry-run', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({ folder: currentFolder, find, replace, recursive })
+    });
+    if (res.headers.get('Content-Type').startsWith('application/json')) {
+        return showToast((await res.json()).error, 'error');
+    }
+    
+    const list = document.getElementById('batchPreview');
+    const text = document.getElementById('batchProgressText');
+    document.getElementById('batchProgress').classList.add('show');
+    document.getElementById('batchProgressFill').style.width = '0';
+    list.classList.add('show');
+    let found = 0;
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    for (;;) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+            if (!line) continue;
+            const entry = JSON.parse(line);
+            if (entry.plan) {
+                batchPlan = { id: entry.plan, find, replace, recursive };
+                text.textContent = `Будет изменено ${entry.files} из ${entry.scanned} файлов` +
+                                   (entry.failed ? ` · ошибок ${entry.failed}` : '');
+                continue;
+            }
+            if (!entry.error) found++;
+            if (list.children.length < PREVIEW_SHOWN) list.appendChild(batchPreviewItem(entry));
+            text.textContent = `Найдено ${found} файлов…`;
+        }
+    }
+}
+
+function renderBatchProgress(job) {
+    const done = job.scanned;
+    const pct = job.total ? Math.min(100, Math.round(done * 100 / job.total)) : 0;
+    document.getElementById('batchProgressFill').style.width = pct + '%';
+    let text = `Обработано ${done} из ${job.total} · изменено ${job.modified} · ошибок ${job.failed}`;
+    if (job.eta !== null && job.eta !== undefined) text += ` · осталось ~${Math.ceil(job.eta)} с`;
+    document.getElementById('batchProgressText').textContent = text;
 }
 
 async function executeBatchReplace() {
+    if (batchJob) return;
     const find = document.getElementById('findText').value;
     const replace = document.getElementById('replaceText').value;
     const backup = document.getElementById('batchBackup').checked;
     
+    const recursive = document.getElementById('recursive').checked;
+    
     if (!find) return showToast('Введите текст для поиска', 'error');
     
-    const res = await fetch('/api/batch-replace', {
+    // A dry run of the same replacement already knows which files change
+    const plan = batchPlan && batchPlan.find === find && batchPlan.replace === replace &&
+                 batchPlan.recursive === recursive ? batchPlan.id : null;
+    const body = plan ? { plan, backup } : { folder: currentFolder, find, replace, backup, recursive };
+    const res = await fetch('/api/jobs/batch-replace', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({ folder: currentFolder, find, replace, backup })
+        body: JSON.stringify(body)
     });
     const data = await res.json();
+    if (data.error) return showToast(data.error, 'error');
     
-    if (data.error) {
-        showToast(data.error, 'error');
+    batchJob = data.job;
+    resetBatchPreview();
+    document.getElementById('batchRun').disabled = true;
+    document.getElementById('batchCheck').disabled = true;
+    document.getElementById('batchCancel').textContent = 'Остановить';
+    document.getElementById('batchProgress').classList.add('show');
+    renderBatchProgress({ scanned: 0, total: 0, modified: 0, failed: 0, eta: null });
+    
+    batchEvents = new EventSource('/api/jobs/' + batchJob + '/events');
+    batchEvents.onmessage = (e) => {
+        const job = JSON.parse(e.data);
+        renderBatchProgress(job);
+        if (job.state !== 'running') finishBatchReplace(job);
+    };
+}
+
+function cancelBatchReplace() {
+    if (!batchJob) return closeBatchModal();
+    fetch('/api/jobs/' + batchJob + '/cancel', { method: 'POST' });
+    document.getElementById('batchCancel').disabled = true;
+}
+
+async function finishBatchReplace(job) {
+    batchEvents.close();
+    batchEvents = null;
+    batchJob = null;
+    document.getElementById('batchRun').disabled = false;
+    document.getElementById('batchCheck').disabled = false;
+    document.getElementById('batchCancel').disabled = false;
+    document.getElementById('batchCancel').textContent = 'Отмена';
+    closeBatchModal();
+    
+    if (job.state === 'failed') {
+        showToast(job.errors[job.errors.length - 1] || 'Ошибка', 'error');
+    } else if (job.state === 'cancelled') {
+        showToast(`Остановлено, изменено ${job.modified} файлов`, 'success');
     } else {
-        closeBatchModal();
-        showToast(`Изменено ${data.modified} файлов`, 'success');
-        // Reload to update statuses
-        loadFolder();
-        // Reload current image metadata if it was modified
-        if (currentImage) {
-            const metaRes = await fetch('/api/metadata?path=' + encodeURIComponent(currentImage));
-            const metaData = await metaRes.json();
-            document.getElementById('metadata').value = metaData.metadata || '';
-            originalMetadata = metaData.metadata || '';
-        }
+        showToast(`Изменено ${job.modified} файлов`, 'success');
+    }
+    // Reload to update statuses
+    loadFolder();
+    // Reload current image metadata if it was modified
+    if (currentImage) {
+        const metaRes = await fetch('/api/metadata?path=' + encodeURIComponent(currentImage));
+        const metaData = await metaRes.json();
+        document.getElementById('metadata').value = metaData.metadata || '';
+        originalMetadata = metaData.metadata || '';
     }
 }
 
@@ -957,23 +3727,113 @@ def list_images():
     folder = request.args.get('path', '')
     if not folder or not os.path.isdir(folder):
         return jsonify({'error': 'Папка не найдена'})
+    sort = request.args.get('sort', 'name')
+    ext = request.args.get('ext', '')
+    ext = {e.strip().lower() for e in ext.split(',') if e.strip()} if ext else None
+    if ext and 'jpg' in ext: ext.add('jpeg')
+    backup = {'1': True, '0': False}.get(request.args.get('backup', ''))
+    recursive = request.args.get('recursive') == '1'
+    include, exclude = parse_globs(request.args.get('include')), parse_globs(request.args.get('exclude'))
+    try:
+        cursor = request.args.get('cursor')
+        cursor = decode_cursor(cursor) if cursor else None
+        limit = min(LIST_PAGE_MAX, max(1, int(request.args.get('limit', LIST_PAGE))))
+    except ValueError:
+        return jsonify({'error': 'Неверные параметры страницы'})
+    if sort not in LIST_SORTS:
+        return jsonify({'error': 'Неверная сортировка'})
+    try:
+        page, total, next_cursor = list_folder(folder, sort, request.args.get('order') == 'desc',
+                                               ext, backup, cursor, limit, recursive, include, exclude)
+    except TypeError:
+        # Cursor from a listing with another sort
+        return jsonify({'error': 'Неверные параметры страницы'})
     images = []
-    for f in sorted(os.listdir(folder)):
-        if f.lower().endswith(('.png', '.jpg', '.jpeg')):
-            full_path = os.path.join(folder, f)
-            has_backup = os.path.exists(full_path + '.backup')
-            images.append({'name': f, 'path': full_path, 'has_backup': has_backup})
-    return jsonify({'images': images, 'folder': folder})
+    for name, has_backup in page:
+        full_path = os.path.join(folder, name)
+        try:
+            st = os.stat(full_path)
+        except FileNotFoundError:
+            continue
+        images.append({'name': name, 'path': full_path, 'has_backup': has_backup,
+                       'size': st.st_size, 'mtime': st.st_mtime})
+    if PREWARM and Image is not None:
+        prewarm_thumbnails([img['path'] for img in images])
+    return jsonify({'images': images, 'folder': folder, 'total': total, 'next_cursor': next_cursor})
+
+IMAGE_CACHE_CONTROL = 'private, no-cache'  # always revalidate: saves rewrite the file in place
+THUMB_CACHE_CONTROL = 'private, max-age=600'
+
+def file_etag(st, spec=''):
+    # Strong validator: changes whenever a save rewrites (new inode) or patches (new mtime) the file
+    return '%x-%x-%x%s' % (st.st_size, st.st_mtime_ns, st.st_ino, spec)
+
+def send_validated(st, etag, cache_control, make_response):
+    # 304 when the client's copy is current (make_response isn't called then); otherwise the
+    # response from make_response, with send_file handling If-Modified-Since and Range itself
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+    else:
+        resp = make_response()
+    resp.set_etag(etag)
+    resp.last_modified = st.st_mtime
+    resp.headers['Cache-Control'] = cache_control
+    return resp
+
+def send_source(path, st, etag, cache_control):
+    return send_validated(st, etag, cache_control, lambda: send_file(
+        path, conditional=True, etag=etag, last_modified=st.st_mtime))
 
 @app.route('/api/thumb')
 def get_thumb():
     path = request.args.get('path', '')
-    return send_file(path) if os.path.exists(path) else ('', 404)
+    if not os.path.exists(path):
+        return '', 404
+    st = os.stat(path)
+    if Image is None:
+        return send_source(path, st, file_etag(st), THUMB_CACHE_CONTROL)
+    etag = file_etag(st, '-t%d' % THUMB_SIZE)
+
+    def make_thumb():
+        try:
+            return send_file(get_thumbnail(path), mimetype='image/' + thumbnail_format().lower(),
+                             conditional=True, etag=etag, last_modified=st.st_mtime)
+        except Exception:
+            # Pillow can't decode it: let the browser try the original
+            return send_file(path, conditional=True, etag=etag, last_modified=st.st_mtime)
+
+    return send_validated(st, etag, THUMB_CACHE_CONTROL, make_thumb)
 
 @app.route('/api/image')
 def get_image():
     path = request.args.get('path', '')
-    return send_file(path) if os.path.exists(path) else ('', 404)
+    if not os.path.exists(path):
+        return '', 404
+    st = os.stat(path)
+    return send_source(path, st, file_etag(st), IMAGE_CACHE_CONTROL)
+
+@app.route('/api/preview')
+def get_preview_image():
+    path = request.args.get('path', '')
+    if not os.path.exists(path):
+        return '', 404
+    st = os.stat(path)
+    try:
+        size = preview_size(int(request.args.get('w', PREVIEW_SIZES[2])))
+    except ValueError:
+        size = PREVIEW_SIZES[2]
+    if Image is None:
+        return send_source(path, st, file_etag(st), IMAGE_CACHE_CONTROL)
+    etag = file_etag(st, '-p%d' % size)
+
+    def make_preview():
+        try:
+            return send_file(get_preview(path, size), mimetype='image/jpeg',
+                             conditional=True, etag=etag, last_modified=st.st_mtime)
+        except Exception:
+            return send_file(path, conditional=True, etag=etag, last_modified=st.st_mtime)
+
+    return send_validated(st, etag, IMAGE_CACHE_CONTROL, make_preview)
 
 @app.route('/api/metadata')
 def get_metadata():
@@ -981,69 +3841,784 @@ def get_metadata():
     if not os.path.exists(path):
         return jsonify({'error': 'Файл не найден'})
     try:
-        ext = path.lower().split('.')[-1]
-        metadata = extract_png_metadata(path) if ext == 'png' else extract_jpg_metadata(path)
-        return jsonify({'metadata': metadata})
+        return jsonify({'metadata': INDEX.get(path)})
     except Exception as e:
         return jsonify({'metadata': '', 'error': str(e)})
 
+@app.route('/api/metadata/bulk', methods=['POST'])
+def get_metadata_bulk():
+    # NDJSON, one line per file as it is done: explicit paths, or a name-ordered range of a folder
+    data = request.json or {}
+    try:
+        workers = int(data.get('workers') or 0) or None
+        offset = max(0, int(data.get('offset') or 0))
+        limit = int(data['limit']) if data.get('limit') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Неверные параметры'})
+    folder, names = data.get('folder'), {}
+    if folder:
+        if not os.path.isdir(folder):
+            return jsonify({'error': 'Папка не найдена'})
+        images = collect_images(folder, bool(data.get('recursive')), parse_globs(data.get('include')),
+                                parse_globs(data.get('exclude')))
+        images = images[offset:] if limit is None else images[offset:offset + max(0, limit)]
+        names = {os.path.join(folder, name): name for name, _ in images}
+        paths = list(names)
+    else:
+        paths = data.get('paths')
+        if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+            return jsonify({'error': 'Укажите папку или список путей'})
+
+    def generate():
+        for path, metadata, error in iter_metadata(paths, workers):
+            line = {'path': path, 'metadata': metadata or ''}
+            if path in names: line['name'] = names[path]
+            if error: line['error'] = 'Файл не найден' if isinstance(error, FileNotFoundError) else str(error)
+            yield json.dumps(line, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
 @app.route('/api/save', methods=['POST'])
 def save_metadata():
     data = request.json
     path, metadata, backup = data.get('path', ''), data.get('metadata', ''), data.get('backup', True)
     if not os.path.exists(path):
         return jsonify({'error': 'Файл не найден'})
+    if backup not in (True, False, None) + BACKUP_MODES:
+        return jsonify({'error': 'Неизвестный режим бэкапа'})
     try:
-        ext = path.lower().split('.')[-1]
-        (write_png_metadata if ext == 'png' else write_jpg_metadata)(path, metadata, backup)
+        save_metadata_text(path, metadata, backup, data.get('base'))
         return jsonify({'success': True})
+    except SaveConflict as e:
+        return jsonify({'error': 'Файл изменён в другом окне', 'conflict': True, 'metadata': e.metadata})
     except Exception as e:
         return jsonify({'error': str(e)})
 
-@app.route('/api/batch-replace', methods=['POST'])
-def batch_replace():
+@app.route('/api/history')
+def get_history():
+    path = request.args.get('path', '')
+    if not os.path.exists(path):
+        return jsonify({'error': 'Файл не найден'})
+    entries = [{'metadata': e['metadata'], 'size': e['size'], 'mtime': e['mtime_ns'] / 1e9, 'time': e['time']}
+               for e in reversed(JOURNAL.entries(path))]
+    return jsonify({'entries': entries, 'backup_copy': os.path.exists(path + '.backup')})
+
+def revert_response(path, revert):
+    # Shared by undo and restore: rewrites path, then refreshes the caches like /api/save
+    if not os.path.exists(path):
+        return jsonify({'error': 'Файл не найден'})
+    try:
+        with PATH_LOCKS.hold(path):
+            st = os.stat(path)
+            metadata = revert()
+        if metadata is None:
+            return jsonify({'error': 'Нет сохранённых версий'})
+        INDEX.update(path, metadata)
+        discard_renditions(path, st.st_size, st.st_mtime_ns)
+        return jsonify({'metadata': metadata, 'has_backup': has_backup(path)})
+    except Exception as e:
+        return jsonify({'error': str(e)})
+
+@app.route('/api/undo', methods=['POST'])
+def undo():
     data = request.json
-    folder = data.get('folder', '')
-    find_text = data.get('find', '')
-    replace_text = data.get('replace', '')
+    path = data.get('path', '')
+    try:
+        steps = max(1, int(data.get('steps') or 1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Неверное число шагов'})
+    return revert_response(path, lambda: undo_metadata(path, steps))
+
+@app.route('/api/restore', methods=['POST'])
+def restore():
+    path = request.json.get('path', '')
+    return revert_response(path, lambda: restore_original(path))
+
+def parse_batch_target(data, kind):
+    # Keyword arguments every batch operation takes, or an error response. With the plan id
+    # of a dry run, its parameters and file list are used instead of the body's.
+    try:
+        workers = int(data.get('workers') or 0) or None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Неверное число потоков'})
     backup = data.get('backup', True)
-    
+    if backup not in (True, False, None) + BACKUP_MODES:
+        return jsonify({'error': 'Неизвестный режим бэкапа'})
+    if data.get('plan'):
+        plan = get_plan(data['plan'])
+        if not plan or plan['kind'] != kind:
+            return jsonify({'error': 'План не найден, повторите проверку'})
+        return dict(plan['params'], backup=backup, workers=workers,
+                    entries=list(iter_plan_entries(plan['entries'])))
+    folder = data.get('folder', '')
     if not folder or not os.path.isdir(folder):
         return jsonify({'error': 'Папка не найдена'})
-    if not find_text:
+    return {'folder': folder, 'backup': backup, 'workers': workers,
+            'recursive': bool(data.get('recursive')),
+            'include': parse_globs(data.get('include')), 'exclude': parse_globs(data.get('exclude'))}
+
+def parse_batch_replace(data):
+    # iter_batch_replace keyword arguments from a batch-replace body, or an error response
+    params = parse_batch_target(data, 'batch-replace')
+    if not isinstance(params, dict) or 'entries' in params: return params
+    if not data.get('find', ''):
         return jsonify({'error': 'Укажите текст для поиска'})
-    
+    params.update(find_text=data['find'], replace_text=data.get('replace', ''))
+    return params
+
+def parse_batch_edit(data):
+    # iter_batch_edit keyword arguments from a batch-edit body, or an error response
+    params = parse_batch_target(data, 'batch-edit')
+    if not isinstance(params, dict) or 'entries' in params: return params
+    try:
+        params.update(operations=parse_edits(data.get('operations')), where=parse_where(data.get('where')))
+    except ValueError as e:
+        return jsonify({'error': str(e)})
+    return params
+
+def batch_response(results):
+    # Synchronous batch routes: counts and errors once everything is done
     modified = 0
     errors = []
-    
-    for f in os.listdir(folder):
-        if not f.lower().endswith(('.png', '.jpg', '.jpeg')):
-            continue
-        path = os.path.join(folder, f)
-        try:
-            ext = f.lower().split('.')[-1]
-            metadata = extract_png_metadata(path) if ext == 'png' else extract_jpg_metadata(path)
-            if find_text in metadata:
-                new_metadata = metadata.replace(find_text, replace_text)
-                (write_png_metadata if ext == 'png' else write_jpg_metadata)(path, new_metadata, backup)
-                modified += 1
-        except Exception as e:
-            errors.append(f'{f}: {str(e)}')
-    
+    for f, ok, error in results:
+        if error:
+            errors.append(f'{f}: {error}')
+        elif ok:
+            modified += 1
     return jsonify({'modified': modified, 'errors': errors})
 
+def submit_batch(kind, iterate, params):
+    # Background batch routes: starts the job, progress via /api/jobs/<id>
+    def work(job):
+        for f, ok, error in iterate(cancelled=job.cancelled, **params):
+            job.record(f, ok, error)
+
+    if params.get('entries') is not None:
+        total = len(params['entries'])
+    else:
+        total = count_images(params['folder'], params['recursive'], params['include'], params['exclude'])
+    job = start_job(kind, total, work)
+    return jsonify({'job': job.id})
+
+def dry_run_response(kind, iterate, params, preview):
+    # NDJSON: a line per file that would change (or fails) as it is found, then a summary
+    # naming the plan the real run can reuse
+    def generate():
+        found, entries = deque(), []
+        scanned = failed = 0
+
+        def record(path, rel_name, metadata, new_metadata):
+            changes, before, after = preview(metadata, new_metadata)
+            entries.append((os.path.dirname(path), rel_name, os.path.basename(path)))
+            found.append({'name': rel_name, 'path': os.path.join(params['folder'], rel_name),
+                          'changes': changes, 'before': before, 'after': after})
+
+        for rel_name, _, error in iterate(dry_run=record, **params):
+            scanned += 1
+            while found: yield json.dumps(found.popleft(), ensure_ascii=False) + '\n'
+            if error:
+                failed += 1
+                yield json.dumps({'name': rel_name, 'path': os.path.join(params['folder'], rel_name),
+                                  'error': error}, ensure_ascii=False) + '\n'
+        kept = {key: value for key, value in params.items() if key not in ('backup', 'workers', 'entries')}
+        plan_id = save_plan(kind, kept, entries)
+        yield json.dumps({'plan': plan_id, 'files': len(entries), 'scanned': scanned, 'failed': failed}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/batch-replace', methods=['POST'])
+def batch_replace():
+    params = parse_batch_replace(request.json)
+    if not isinstance(params, dict): return params
+    return batch_response(iter_batch_replace(cancelled=SHUTDOWN, **params))
+
+@app.route('/api/jobs/batch-replace', methods=['POST'])
+def submit_batch_replace():
+    params = parse_batch_replace(request.json)
+    if not isinstance(params, dict): return params
+    return submit_batch('batch-replace', iter_batch_replace, params)
+
+@app.route('/api/batch-replace/dry-run', methods=['POST'])
+def batch_replace_dry_run():
+    params = parse_batch_replace(request.json)
+    if not isinstance(params, dict): return params
+    preview = lambda metadata, new_metadata: preview_replace(params['find_text'], params['replace_text'],
+                                                             metadata, new_metadata)
+    return dry_run_response('batch-replace', iter_batch_replace, params, preview)
+
+@app.route('/api/batch-edit', methods=['POST'])
+def batch_edit():
+    params = parse_batch_edit(request.json)
+    if not isinstance(params, dict): return params
+    return batch_response(iter_batch_edit(cancelled=SHUTDOWN, **params))
+
+@app.route('/api/jobs/batch-edit', methods=['POST'])
+def submit_batch_edit():
+    params = parse_batch_edit(request.json)
+    if not isinstance(params, dict): return params
+    return submit_batch('batch-edit', iter_batch_edit, params)
+
+@app.route('/api/batch-edit/dry-run', methods=['POST'])
+def batch_edit_dry_run():
+    params = parse_batch_edit(request.json)
+    if not isinstance(params, dict): return params
+    return dry_run_response('batch-edit', iter_batch_edit, params, preview_edit)
+
+@app.route('/api/library')
+def get_library():
+    return jsonify({'roots': INDEX.roots()})
+
+@app.route('/api/library', methods=['POST'])
+def add_library_root():
+    data = request.json
+    path = data.get('path', '')
+    if not path or not os.path.isdir(path):
+        return jsonify({'error': 'Папка не найдена'})
+    INDEX.set_root(path, parse_globs(data.get('include')), parse_globs(data.get('exclude')))
+    return jsonify({'roots': INDEX.roots()})
+
+@app.route('/api/library/remove', methods=['POST'])
+def remove_library_root():
+    INDEX.remove_root(request.json.get('path', ''))
+    return jsonify({'roots': INDEX.roots()})
+
+@app.route('/api/library/scan', methods=['POST'])
+def submit_library_scan():
+    data = request.json or {}
+    roots = [(r['path'], r['include'], r['exclude']) for r in INDEX.roots()]
+    if data.get('roots'):
+        wanted = {os.path.abspath(p) for p in data['roots']}
+        roots = [r for r in roots if r[0] in wanted]
+    roots = [r for r in roots if os.path.isdir(r[0])]
+    if not roots:
+        return jsonify({'error': 'Папка не найдена'})
+    try:
+        workers = int(data.get('workers') or 0) or None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Неверное число потоков'})
+    job = start_job('library-scan', 0, lambda job: scan_library(job, roots, workers, bool(data.get('full'))))
+    return jsonify({'job': job.id})
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    return jsonify(job.snapshot()) if job else (jsonify({'error': 'Задача не найдена'}), 404)
+
+@app.route('/api/jobs/<job_id>/events')
+def job_progress(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return Response(stream_with_context(job_events(job)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    job.cancelled.set()
+    return jsonify({'success': True})
+
+@app.route('/api/search')
+def search_metadata():
+    query = request.args.get('q', '').strip()
+    folder = request.args.get('folder', '')
+    if not query:
+        return jsonify({'error': 'Укажите текст для поиска'})
+    if folder and not os.path.isdir(folder):
+        return jsonify({'error': 'Папка не найдена'})
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(500, max(1, int(request.args.get('limit', 50))))
+    except ValueError:
+        return jsonify({'error': 'Неверные параметры страницы'})
+    if folder:
+        # Cheap when the folder is already indexed: one scandir pass, changed files only
+        INDEX.refresh(folder)
+    rows, has_more = INDEX.search(query, folder, offset, limit)
+    results = [{'path': path, 'name': os.path.basename(path), 'snippet': snippet} for path, snippet in rows]
+    return jsonify({'results': results, 'offset': offset, 'next_offset': offset + limit if has_more else None})
+
+@app.route('/api/watch')
+def watch_folder():
+    folder = request.args.get('path', '')
+    if not folder or not os.path.isdir(folder):
+        return jsonify({'error': 'Папка не найдена'}), 404
+    recursive = request.args.get('recursive') == '1'
+    include, exclude = parse_globs(request.args.get('include')), parse_globs(request.args.get('exclude'))
+    return Response(stream_with_context(watch_events(folder, recursive, include, exclude)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+QUERY_PAGE_MAX = 5000
+
+@app.route('/api/query', methods=['POST'])
+def query_parameters():
+    data = request.json or {}
+    folder = data.get('folder', '')
+    if not folder or not os.path.isdir(folder):
+        return jsonify({'error': 'Папка не найдена'})
+    try:
+        where = parse_where(data.get('where'))
+    except ValueError as e:
+        return jsonify({'error': str(e)})
+    try:
+        offset = max(0, int(data.get('offset') or 0))
+        limit = min(QUERY_PAGE_MAX, max(1, int(data.get('limit') or 100)))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Неверные параметры'})
+    store = column_store(folder, bool(data.get('recursive')))
+    try:
+        rows = store.select(where)
+        if data.get('sort'): rows = store.order(rows, data['sort'], data.get('order') == 'desc')
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)})
+    fields = data.get('fields')
+    results = [{'name': store.names[i], 'path': os.path.join(folder, store.names[i]), 'fields': store.row(i, fields)}
+               for i in rows[offset:offset + limit]]
+    return jsonify({'total': len(rows), 'results': results,
+                    'next_offset': offset + limit if offset + limit < len(rows) else None,
+                    'columns': {key: column.kind for key, column in store.columns.items()}})
+
+@app.route('/api/stats')
+def cache_stats():
+    return jsonify({'metadata_cache': INDEX.memory.stats(),
+                    'renditions': {'bytes': RENDITIONS.total, 'max_bytes': RENDITIONS.budget}})
+
 @app.route('/api/check-status')
 def check_status():
     path = request.args.get('path', '')
     if not os.path.exists(path):
         return jsonify({'status': 'unknown'})
-    backup_path = path + '.backup'
-    has_backup = os.path.exists(backup_path)
-    return jsonify({'has_backup': has_backup})
+    return jsonify({'has_backup': has_backup(path)})
 
-if __name__ == '__main__':
+# ============== Server ==============
+SERVER_THREADS = 16  # interactive requests: pages, thumbnails, metadata, saves
+SERVER_LONG_THREADS = 64  # event streams, synchronous batches, dry runs, bulk reads
+SERVER_TIMEOUT = 30  # seconds a connection may stall while reading the request or sending
+SERVER_GRACE = 30  # seconds given to running requests and jobs on shutdown
+SERVER_PEEK_INTERVAL = 0.02  # seconds between looks at request lines that arrived in pieces
+LONG_ROUTES = ('/api/watch', '/api/batch-replace', '/api/batch-edit', '/api/metadata/bulk')
+
+def long_request(path):
+    return path.startswith(LONG_ROUTES) or (path.startswith('/api/jobs/') and path.endswith('/events'))
+
+class PooledWSGIServer(BaseWSGIServer):
+    # Werkzeug's request handling on two bounded thread pools instead of a thread per connection.
+    # Long requests get their own pool, so however many event streams and batches are open,
+    # thumbnails and metadata are answered by the interactive pool. One request per connection
+    # (HTTP/1.0), so every request is routed by its own request line. Until that line has arrived
+    # a connection is parked with a selector in one dispatcher thread, so idle or slow clients
+    # hold no pool thread.
+    multithread = True
+
+    def __init__(self, host, port, app, threads=SERVER_THREADS, long_threads=SERVER_LONG_THREADS,
+                 timeout=SERVER_TIMEOUT):
+        handler = type('RequestHandler', (WSGIRequestHandler,), {'protocol_version': 'HTTP/1.0', 'timeout': timeout})
+        BaseWSGIServer.__init__(self, host, port, app, handler)
+        self.request_timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self.long_pool = ThreadPoolExecutor(max_workers=long_threads, thread_name_prefix='http-long')
+        self.running = 0  # requests shutdown waits for: all but event streams
+        self.idle = threading.Condition()
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        for end in (self.wake_r, self.wake_w): end.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.arrived = deque()  # (socket, client address) accepted, not yet parked
+        self.parked = {}  # socket -> (client address, deadline for its request line)
+        self.partial = set()  # parked sockets holding part of a request line, peeked on a timer
+        self.dispatching = True
+        threading.Thread(target=self.dispatch, name='http-dispatch', daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.arrived.append((request, client_address))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:
+            pass  # buffer full: the dispatcher is awake anyway
+
+    def dispatch(self):
+        # Parks new connections and peeks at each one whose socket turns readable. A connection
+        # goes to a pool once its request line is complete; one that stays silent for the
+        # request timeout is closed without ever using a pool thread.
+        while self.dispatching:
+            timeout = SERVER_PEEK_INTERVAL if self.partial else None
+            if self.parked and timeout is None:
+                timeout = max(0, min(deadline for _, deadline in self.parked.values()) - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is not self.wake_r:
+                    self.peek(key.fileobj)
+                    continue
+                try:
+                    while self.wake_r.recv(4096): pass
+                except OSError:
+                    pass
+                while self.arrived:
+                    request, client_address = self.arrived.popleft()
+                    request.setblocking(False)
+                    self.parked[request] = (client_address, time.monotonic() + self.request_timeout)
+                    self.selector.register(request, selectors.EVENT_READ)
+            for request in list(self.partial): self.peek(request)
+            now = time.monotonic()
+            for request, (_, deadline) in list(self.parked.items()):
+                if deadline <= now:
+                    self.unpark(request)
+                    self.shutdown_request(request)
+        for request in list(self.parked):
+            self.unpark(request)
+            self.shutdown_request(request)
+        self.selector.close()
+
+    def unpark(self, request):
+        if request in self.partial: self.partial.discard(request)
+        else: self.selector.unregister(request)
+        return self.parked.pop(request)[0]
+
+    def peek(self, request):
+        # Path from the request line, peeked so the handler still reads the whole request
+        try:
+            head = request.recv(2048, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            head = b''
+        if head and b'\n' not in head and len(head) < 2048:
+            # The data stays unread, so the selector would report it again at once
+            if request not in self.partial:
+                self.selector.unregister(request)
+                self.partial.add(request)
+            return
+        client_address = self.unpark(request)
+        if not head:
+            self.shutdown_request(request)  # closed or reset before sending anything
+            return
+        request.settimeout(self.request_timeout)
+        parts = head.split(b' ', 2)
+        self.route(request, client_address, parts[1].decode('latin-1') if len(parts) > 1 else '')
+
+    def route(self, request, client_address, path):
+        streaming = path.startswith('/api/watch') or path.endswith('/events')
+        if long_request(path):
+            self.long_pool.submit(self.handle, request, client_address, not streaming)
+        else:
+            self.pool.submit(self.handle, request, client_address, True)
+
+    def shutdown(self):
+        # Stops accepting; parked connections are closed, dispatched ones run on
+        BaseWSGIServer.shutdown(self)
+        self.dispatching = False
+        self.wake()
+
+    def handle(self, request, client_address, tracked):
+        if tracked:
+            with self.idle: self.running += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            if tracked:
+                with self.idle:
+                    self.running -= 1
+                    self.idle.notify_all()
+
+    def drain(self, timeout):
+        with self.idle:
+            return self.idle.wait_for(lambda: self.running == 0, timeout)
+
+def stop_streams():
+    # Wakes idle event streams so they see SHUTDOWN and end
+    with WATCHER.lock: streams = list(WATCHER.streams)
+    for stream in streams:
+        with stream.changed: stream.changed.notify_all()
+
+def serve(host='127.0.0.1', port=5000, threads=SERVER_THREADS, long_threads=SERVER_LONG_THREADS,
+          timeout=SERVER_TIMEOUT, grace=SERVER_GRACE):
+    # Runs until SIGTERM/SIGINT. Then: no new connections; synchronous batches and jobs stop
+    # starting files, and what they wrote is committed; event streams end; running requests get
+    # up to grace seconds.
+    server = PooledWSGIServer(host, port, app, threads, long_threads, timeout)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
     print("=" * 50)
     print("  Metadata Editor")
-    print("  http://localhost:5000")
+    print("  http://%s:%d" % ('localhost' if host in ('127.0.0.1', '0.0.0.0', '::') else host, port))
     print("=" * 50)
-    app.run(debug=True, port=5000)
+    if Image is None:
+        print("Pillow is not installed: thumbnails and previews are the full-size images (pip install pillow)")
+    server.serve_forever()
+
+    print("Stopping...")
+    deadline = time.monotonic() + grace
+    SHUTDOWN.set()
+    stop_streams()
+    with JOBS_LOCK: jobs = [job for job in JOBS.values() if job.state == 'running']
+    for job in jobs: job.cancelled.set()
+    for job in jobs:
+        version = None
+        while job.state == 'running' and time.monotonic() < deadline:
+            version = job.wait(version, deadline - time.monotonic())
+    drained = server.drain(max(0, deadline - time.monotonic()))
+    if not drained or any(job.state == 'running' for job in jobs):
+        print("Requests still running after %ds, exiting anyway" % grace)
+        os._exit(1)
+
+# ============== Command Line ==============
+# Bulk jobs straight on the files: the same readers, writers, index and batch engine as the
+# web UI, without HTTP in between. Results are NDJSON on stdout, progress goes to stderr.
+PROGRESS_INTERVAL = 5  # seconds between progress lines when stderr is not a terminal
+
+class Progress:
+    # One self-overwriting status line on a terminal, a plain line every PROGRESS_INTERVAL otherwise
+    def __init__(self, total, quiet=False):
+        self.total, self.quiet = total, quiet
+        self.done = self.modified = self.failed = 0
+        self.started = self.shown = time.monotonic()
+        self.tty = sys.stderr.isatty()
+
+    def step(self, modified=False, failed=False):
+        self.done += 1
+        self.modified += bool(modified)
+        self.failed += bool(failed)
+        now = time.monotonic()
+        if not self.quiet and now - self.shown >= (0.2 if self.tty else PROGRESS_INTERVAL):
+            self.shown = now
+            self.show()
+
+    def show(self, end=''):
+        rate = self.done / max(time.monotonic() - self.started, 1e-6)
+        line = '%d/%d  modified %d  failed %d  %.0f files/s' % (self.done, self.total, self.modified, self.failed, rate)
+        sys.stderr.write(('\r' + line + '\x1b[K' + end) if self.tty else line + '\n')
+        sys.stderr.flush()
+
+    def finish(self):
+        if not self.quiet and (self.tty or self.done): self.show('\n')
+        return round(time.monotonic() - self.started, 3)
+
+def expand_targets(targets, recursive=False, include=None, exclude=None, workers=None):
+    # (directory, shown path, name) per image, sorted and without duplicates. A target is a file,
+    # a glob ('**' crosses directories) or a folder, whose images are selected like a batch's.
+    # Returns (entries, [targets that matched nothing]).
+    found, missing = {}, []
+    for target in targets:
+        before = len(found)
+        if os.path.isdir(target):
+            for directory, rel_dir, images in walk_images(target, include, exclude, workers, recursive):
+                prefix = rel_dir + '/' if rel_dir else ''
+                for name, _ in images:
+                    found.setdefault(os.path.join(directory, name), (directory, os.path.join(target, prefix + name), name))
+        else:
+            matches = glob.glob(target, recursive=True) if glob.has_magic(target) else [target]
+            for match in matches:
+                if not (os.path.isfile(match) and is_image(match)): continue
+                if not path_selected(match.replace(os.sep, '/'), include, exclude): continue
+                full = os.path.abspath(match)
+                found.setdefault(full, (os.path.dirname(full), match, os.path.basename(full)))
+        if len(found) == before: missing.append(target)
+    return [found[path] for path in sorted(found)], missing
+
+def json_argument(value):
+    # JSON given inline or, as @file, in a file
+    if value.startswith('@'):
+        try:
+            with open(value[1:], encoding='utf-8') as f: value = f.read()
+        except OSError as e:
+            raise ValueError(str(e))
+    return json.loads(value)
+
+def write_line(out, record):
+    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def cli_summary(command, progress, missing, errors, cancelled=None, **counts):
+    summary = dict({'command': command, 'files': progress.total, 'scanned': progress.done}, **counts)
+    summary.update(failed=progress.failed, missing=missing, errors=errors,
+                   cancelled=bool(cancelled and cancelled.is_set()), elapsed=progress.finish())
+    return summary
+
+def cli_cancel():
+    # Ctrl+C / SIGTERM stop new files from starting; what is in flight finishes and is committed
+    cancelled = threading.Event()
+
+    def stop(signum, frame):
+        if cancelled.is_set(): raise KeyboardInterrupt
+        cancelled.set()
+        sys.stderr.write('\nStopping after the files in flight (again to abort)\n')
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    return cancelled
+
+def cli_extract(args):
+    entries, missing = expand_targets(args.targets, args.recursive, args.include, args.exclude, args.workers)
+    shown = {os.path.join(directory, name): path for directory, path, name in entries}
+    progress, errors = Progress(len(entries), args.quiet), []
+    out = open(args.output, 'w', encoding='utf-8', newline='\n') if args.output else sys.stdout
+    try:
+        # Output follows completion order; every line names its file
+        for path, metadata, error in iter_metadata(list(shown), args.workers):
+            record = {'path': shown[path]}
+            if error:
+                errors.append({'path': shown[path], 'error': str(error)})
+                record['error'] = str(error)
+            else:
+                record['metadata'] = metadata
+                if args.fields:
+                    fields = parameter_fields(parse_parameters(metadata))
+                    record['fields'] = {key: sorted(value) if isinstance(value, frozenset) else value
+                                        for key, value in fields.items()}
+            write_line(out, record)
+            progress.step(failed=error)
+    finally:
+        if args.output: out.close()
+    # stdout carries the records, so the summary goes to stderr
+    summary = cli_summary('extract', progress, missing, errors)
+    sys.stderr.write(json.dumps(summary, ensure_ascii=False) + '\n')
+    return summary
+
+def cli_batch(args):
+    if args.command == 'replace':
+        if not args.find: raise ValueError('--find must not be empty')
+        iterate, params = iter_batch_replace, {'find_text': args.find, 'replace_text': args.replace}
+        preview = lambda metadata, new_metadata: preview_replace(args.find, args.replace, metadata, new_metadata)
+    else:
+        iterate = iter_batch_edit
+        params = {'operations': parse_edits(json_argument(args.operations)),
+                  'where': parse_where(json_argument(args.where or '[]'))}
+        preview = preview_edit
+    entries, missing = expand_targets(args.targets, args.recursive, args.include, args.exclude, args.workers)
+    progress, errors, found = Progress(len(entries), args.quiet), [], deque()
+
+    def record(path, name, metadata, new_metadata):
+        changes, before, after = preview(metadata, new_metadata)
+        found.append({'path': name, 'changes': changes, 'before': before, 'after': after})
+
+    cancelled = cli_cancel()
+    results = iterate(None, backup=args.backup, workers=args.workers, cancelled=cancelled,
+                      entries=iter_plan_entries(entries), dry_run=record if args.dry_run else None, **params)
+    for name, modified, error in results:
+        while found: write_line(sys.stdout, found.popleft())
+        if error: errors.append({'path': name, 'error': error})
+        if not args.dry_run and (modified or error): write_line(sys.stdout, {'path': name, 'modified': modified, 'error': error})
+        progress.step(modified, error)
+    summary = cli_summary(args.command, progress, missing, errors, cancelled, modified=progress.modified,
+                          dry_run=args.dry_run)
+    write_line(sys.stdout, summary)
+    return summary
+
+def cli_restore(args):
+    if args.undo is not None and args.undo < 1: raise ValueError('--undo must be positive')
+    entries, missing = expand_targets(args.targets, args.recursive, args.include, args.exclude, args.workers)
+    progress, errors = Progress(len(entries), args.quiet), []
+    restored = 0
+
+    def revert(entry):
+        # Same steps as /api/undo and /api/restore; False when there is nothing to go back to
+        path = os.path.join(entry[0], entry[2])
+        with PATH_LOCKS.hold(path):
+            st = os.stat(path)
+            metadata = undo_metadata(path, args.undo) if args.undo is not None else restore_original(path)
+        if metadata is None: return False
+        INDEX.update(path, metadata)
+        discard_renditions(path, st.st_size, st.st_mtime_ns)
+        return True
+
+    cancelled = cli_cancel()
+    pending = (entry for entry in entries if not cancelled.is_set())
+    for (_, name, _), done, error in run_parallel(revert, pending, args.workers):
+        if error: errors.append({'path': name, 'error': str(error)})
+        if done or error: write_line(sys.stdout, {'path': name, 'restored': bool(done), 'error': error and str(error)})
+        restored += bool(done)
+        progress.step(done, error)
+    summary = cli_summary('restore', progress, missing, errors, cancelled, restored=restored,
+                          skipped=progress.done - restored - progress.failed)
+    write_line(sys.stdout, summary)
+    return summary
+
+def add_target_arguments(parser):
+    parser.add_argument('targets', nargs='+', help="image files, folders or globs ('**' for any depth)")
+    parser.add_argument('-r', '--recursive', action='store_true', help='include subfolders of folder targets')
+    parser.add_argument('--include', type=parse_globs, help='comma-separated globs images must match')
+    parser.add_argument('--exclude', type=parse_globs, help='comma-separated globs of images and folders to skip')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='file I/O threads (default METADATA_EDITOR_WORKERS or 4x CPUs)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='no progress on stderr')
+
+def add_backup_argument(parser):
+    parser.add_argument('--backup', type=lambda value: False if value == 'none' else value,
+                        choices=BACKUP_MODES + (False,), default=True, metavar='{%s,none}' % ','.join(BACKUP_MODES),
+                        help='how originals are kept (default METADATA_EDITOR_BACKUP or journal)')
+    parser.add_argument('--dry-run', action='store_true', help='only list the files that would change')
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0].startswith('-') and argv[0] not in ('-h', '--help'):
+        argv = ['serve'] + argv  # the web UI is the default command
+    parser = argparse.ArgumentParser(prog='metadata_editor.py', description='A1111 Metadata Editor')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help='run the web UI (default)')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on (0.0.0.0 for the LAN)')
+    serve_parser.add_argument('--port', type=int, default=5000)
+    serve_parser.add_argument('--threads', type=int, default=SERVER_THREADS,
+                              help='threads for interactive requests (default %(default)s)')
+    serve_parser.add_argument('--long-threads', type=int, default=SERVER_LONG_THREADS,
+                              help='threads for event streams, batches and bulk reads (default %(default)s)')
+    serve_parser.add_argument('--workers', type=int, default=None,
+                              help='file I/O threads per batch (default METADATA_EDITOR_WORKERS or 4x CPUs)')
+    serve_parser.add_argument('--timeout', type=float, default=SERVER_TIMEOUT,
+                              help='seconds a connection may stall (default %(default)s)')
+    serve_parser.add_argument('--grace', type=float, default=SERVER_GRACE,
+                              help='seconds running requests get on shutdown (default %(default)s)')
+    serve_parser.add_argument('--dev', action='store_true', help="Flask's debug server with the reloader")
+
+    extract_parser = commands.add_parser('extract', help='print metadata as NDJSON')
+    add_target_arguments(extract_parser)
+    extract_parser.add_argument('-o', '--output', help='write the records to a file instead of stdout')
+    extract_parser.add_argument('--fields', action='store_true', help='add the parsed parameter fields')
+    replace_parser = commands.add_parser('replace', help='find/replace text in metadata')
+    add_target_arguments(replace_parser)
+    replace_parser.add_argument('--find', required=True)
+    replace_parser.add_argument('--replace', required=True)
+    add_backup_argument(replace_parser)
+    edit_parser = commands.add_parser('edit', help='structured field edits (see /api/batch-edit)')
+    add_target_arguments(edit_parser)
+    edit_parser.add_argument('--operations', required=True, help='JSON list of operations, or @file')
+    edit_parser.add_argument('--where', help='JSON list of conditions, or @file')
+    add_backup_argument(edit_parser)
+    restore_parser = commands.add_parser('restore', help='put back the originals from backups')
+    add_target_arguments(restore_parser)
+    restore_parser.add_argument('--undo', type=int, default=None, metavar='STEPS',
+                                help='undo the last STEPS journaled edits instead of restoring the original')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        global BATCH_WORKERS
+        if args.workers: BATCH_WORKERS = args.workers
+        if args.dev:
+            app.run(debug=True, host=args.host, port=args.port)
+        else:
+            serve(args.host, args.port, args.threads, args.long_threads, args.timeout, args.grace)
+        return 0
+    run = {'extract': cli_extract, 'replace': cli_batch, 'edit': cli_batch, 'restore': cli_restore}[args.command]
+    try:
+        summary = run(args)
+    except ValueError as e:
+        parser.error(str(e))  # bad --find/--operations/--where; exits with 2
+    except BrokenPipeError:
+        # Reader went away (e.g. | head); writes already made were committed on the way out
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    return 1 if summary['failed'] or summary['missing'] or summary['cancelled'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import os
+import sys
+import struct
+import tempfile
+import zlib
+
+import pytest
+
+# The index, rendition cache and lock files live in a throwaway directory, never in the user's data dir
+STATE_DIR = tempfile.mkdtemp(prefix='metadata-editor-tests-')
+os.environ['METADATA_EDITOR_INDEX'] = os.path.join(STATE_DIR, 'index.sqlite3')
+os.environ['METADATA_EDITOR_CACHE'] = os.path.join(STATE_DIR, 'cache')
+os.environ['METADATA_EDITOR_LOCKS'] = os.path.join(STATE_DIR, 'locks')
+os.environ['METADATA_EDITOR_PREWARM'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metadata_editor as me
+
+
+def png_bytes(text=None, chunk_type='tEXt'):
+    # 1x1 grey PNG, with a 'parameters' chunk ahead of IDAT when text is given
+    ihdr = me.make_chunk('IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0))
+    idat = me.make_chunk('IDAT', zlib.compress(b'\x00\x80'))
+    chunks = [ihdr]
+    if text is not None:
+        if chunk_type == 'tEXt':
+            chunks.append(me.make_chunk('tEXt', b'parameters\x00' + text.encode('latin-1')))
+        else:
+            chunks.append(me.make_chunk('iTXt', b'parameters\x00\x00\x00\x00\x00' + text.encode('utf-8')))
+    return me.PNG_SIGNATURE + b''.join(chunks) + idat + me.make_chunk('IEND', b'')
+
+
+@pytest.fixture
+def make_png(tmp_path):
+    def make(name, text=None, chunk_type='tEXt'):
+        path = tmp_path / name
+        path.write_bytes(png_bytes(text, chunk_type))
+        return str(path)
+    return make
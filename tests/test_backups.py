@@ -0,0 +1,51 @@
+import os
+
+import metadata_editor as me
+from conftest import STATE_DIR
+
+ORIGINAL = 'кошка, 1girl\nNegative prompt: lowres\nSteps: 20, Sampler: Euler a, Seed: 1'
+
+
+def parameters_type(path):
+    with open(path, 'rb') as f:
+        return me.png_parameters_type(f)
+
+
+def test_journal_restore_keeps_non_latin1_original(make_png):
+    path = make_png('a.png', ORIGINAL, 'iTXt')
+    me.save_metadata_text(path, 'dog\nSteps: 20', 'journal')
+    me.save_metadata_text(path, 'cat\nSteps: 20', 'journal')
+    assert me.extract_metadata(path) == 'cat\nSteps: 20'
+    assert parameters_type(path) == 'iTXt'
+
+    assert me.restore_original(path) == ORIGINAL
+    assert me.extract_metadata(path) == ORIGINAL
+    assert not me.has_backup(path)
+
+
+def test_journal_undo_of_non_latin1_edit(make_png):
+    path = make_png('b.png', 'dog\nSteps: 20')
+    me.save_metadata_text(path, ORIGINAL, 'journal')
+    assert me.extract_metadata(path) == ORIGINAL  # no longer fits tEXt: written as iTXt
+    me.save_metadata_text(path, 'dog, собака\nSteps: 20', 'journal')
+
+    client = me.app.test_client()
+    assert client.post('/api/undo', json={'path': path}).json['metadata'] == ORIGINAL
+    assert me.extract_metadata(path) == ORIGINAL
+    assert client.post('/api/undo', json={'path': path}).json['metadata'] == 'dog\nSteps: 20'
+    assert me.extract_metadata(path) == 'dog\nSteps: 20'
+    assert client.get('/api/metadata', query_string={'path': path}).json['metadata'] == 'dog\nSteps: 20'
+
+
+def test_latin1_text_stays_text_chunk(make_png):
+    path = make_png('c.png', 'dog\nSteps: 20')
+    me.save_metadata_text(path, 'café\nSteps: 20', 'journal')
+    assert parameters_type(path) == 'tEXt'
+    assert me.restore_original(path) == 'dog\nSteps: 20'
+
+
+def test_locks_stay_out_of_image_folders(make_png, tmp_path):
+    path = make_png('d.png', 'dog\nSteps: 20')
+    me.save_metadata_text(path, 'cat\nSteps: 20', 'copy')
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['d.png', 'd.png.backup']
+    assert me.LOCK_DIR.startswith(STATE_DIR) and os.listdir(me.LOCK_DIR)
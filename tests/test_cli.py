@@ -0,0 +1,66 @@
+import json
+import signal
+import threading
+
+import pytest
+
+import metadata_editor as me
+
+
+@pytest.fixture(autouse=True)
+def signals():
+    # The commands take over SIGINT/SIGTERM for their cancellation; pytest gets them back
+    saved = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+    yield
+    for signum, handler in saved.items(): signal.signal(signum, handler)
+
+
+def records(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_extract(make_png, tmp_path, capsys):
+    make_png('a.png', 'dog')
+    assert me.main(['extract', '-q', str(tmp_path)]) == 0
+    assert [record.get('metadata') for record in records(capsys)] == ['dog']
+    assert me.main(['extract', '-q', str(tmp_path / 'missing.png')]) == 1
+    (tmp_path / 'broken.png').write_bytes(b'not a png')
+    assert me.main(['extract', '-q', str(tmp_path / 'broken.png')]) == 1
+    assert 'error' in records(capsys)[0]
+
+
+def test_replace_and_restore(make_png, tmp_path, capsys):
+    path = make_png('a.png', 'dog, 1girl')
+    make_png('b.png', 'cat')
+    assert me.main(['replace', '-q', '--dry-run', '--find', 'dog', '--replace', 'wolf', str(tmp_path)]) == 0
+    assert records(capsys)[-1]['modified'] == 1
+    assert me.extract_metadata(path) == 'dog, 1girl'
+    assert me.main(['replace', '-q', '--find', 'dog', '--replace', 'wolf', str(tmp_path)]) == 0
+    assert me.extract_metadata(path) == 'wolf, 1girl'
+    assert me.main(['restore', '-q', '--undo', '1', path]) == 0
+    assert me.extract_metadata(path) == 'dog, 1girl'
+    capsys.readouterr()
+    assert me.main(['replace', '-q', '--find', 'dog', '--replace', 'wolf', path, str(tmp_path / 'c.png')]) == 1
+    assert records(capsys)[-1]['missing'] == [str(tmp_path / 'c.png')]
+
+
+def test_cancelled_run_fails(make_png, tmp_path, monkeypatch):
+    make_png('a.png', 'dog')
+    cancelled = threading.Event()
+    cancelled.set()
+    monkeypatch.setattr(me, 'cli_cancel', lambda: cancelled)
+    assert me.main(['replace', '-q', '--find', 'dog', '--replace', 'wolf', str(tmp_path)]) == 1
+    assert me.extract_metadata(str(tmp_path / 'a.png')) == 'dog'
+
+
+@pytest.mark.parametrize('argv', [
+    ['replace', '--find', '', '--replace', 'x'],
+    ['edit', '--operations', '[{"op": "nonsense"}]'],
+    ['edit', '--operations', 'not json'],
+    ['restore', '--undo', '0'],
+    ['replace', '--find', 'x', '--replace', 'y', '--backup', 'tape'],
+])
+def test_usage_errors_exit_with_2(make_png, argv):
+    with pytest.raises(SystemExit) as e:
+        me.main(argv + [make_png('a.png', 'dog')])
+    assert e.value.code == 2
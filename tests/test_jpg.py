@@ -0,0 +1,140 @@
+import os
+import struct
+
+import metadata_editor as me
+
+JFIF = me.make_jpeg_segment(me.JPEG_APP0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+XMP = me.make_jpeg_segment(me.JPEG_APP1, b'http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>')
+
+
+def exif_tiff(value, endian='>', trailer=b''):
+    # IFD0 -> Exif IFD -> UserComment, the value inline when it fits in the entry (4 bytes or less)
+    head = (b'II*\x00' if endian == '<' else b'MM\x00*') + struct.pack(endian + 'I', 8)
+    ifd0 = struct.pack(endian + 'HHHII', 1, me.EXIF_IFD_POINTER, 4, 1, 26) + struct.pack(endian + 'I', 0)
+    inline = len(value) <= 4
+    field = value.ljust(4, b'\x00') if inline else struct.pack(endian + 'I', 44)
+    exif_ifd = struct.pack(endian + 'HHHI', 1, me.EXIF_USER_COMMENT, 7, len(value)) + field + struct.pack(endian + 'I', 0)
+    return head + ifd0 + exif_ifd + (b'' if inline else value) + trailer
+
+
+def exif_segment(tiff):
+    return me.make_jpeg_segment(me.JPEG_APP1, me.EXIF_HEADER + tiff)
+
+
+def jpeg_bytes(*segments):
+    # SOI, the given segments, a quantisation table and a scan that the parser must never read
+    dqt = me.make_jpeg_segment(0xDB, b'\x00' + bytes(64))
+    sos = me.make_jpeg_segment(me.JPEG_SOS, b'\x01\x01\x00\x00\x3f\x00')
+    return me.JPEG_SOI + b''.join(segments) + dqt + sos + b'\x12\xff\x00\x34' + b'\xff\xd9'
+
+
+def make_jpg(tmp_path, *segments):
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(jpeg_bytes(*segments))
+    return str(path)
+
+
+def markers(path):
+    with open(path, 'rb') as f:
+        return [marker for marker, _, _ in me.scan_jpeg_segments(f)]
+
+
+def unicode(text):
+    return me.USER_COMMENT_UNICODE + text.encode('utf-16be')
+
+
+def test_scan_stops_at_the_scan_data(tmp_path):
+    path = make_jpg(tmp_path, JFIF, XMP)
+    with open(path, 'rb') as f:
+        segments = list(me.scan_jpeg_segments(f))
+    assert [marker for marker, _, _ in segments] == [me.JPEG_APP0, me.JPEG_APP1, 0xDB]
+    assert segments[0][1] == 2
+    assert segments[1][1] == 2 + len(JFIF)
+    assert segments[1][2] == len(XMP) - 2
+
+
+def test_xmp_before_exif(tmp_path):
+    path = make_jpg(tmp_path, JFIF, XMP, exif_segment(exif_tiff(unicode('Steps: 20'))))
+    assert me.extract_metadata(path) == 'Steps: 20'
+    me.write_metadata(path, 'Steps: 30, Sampler: Euler a, CFG scale: 7', False)
+    assert me.extract_metadata(path) == 'Steps: 30, Sampler: Euler a, CFG scale: 7'
+    data = open(path, 'rb').read()
+    assert data.index(XMP) == 2 + len(JFIF)  # left where it was, untouched
+    assert markers(path) == [me.JPEG_APP0, me.JPEG_APP1, me.JPEG_APP1, 0xDB]
+
+
+def test_ascii_and_unicode_prefixes(tmp_path):
+    assert me.decode_user_comment(b'ASCII\x00\x00\x00Steps: 20\x00\x00') == 'Steps: 20'
+    assert me.decode_user_comment(unicode('Шаги: 20')) == 'Шаги: 20'
+    assert me.decode_user_comment(me.USER_COMMENT_UNICODE + '\ufeffÜber'.encode('utf-16-le')) == 'Über'
+    path = make_jpg(tmp_path, exif_segment(exif_tiff(b'ASCII\x00\x00\x00old ascii text')))
+    assert me.extract_metadata(path) == 'old ascii text'
+    me.write_metadata(path, 'новый текст', False)  # always written back as UNICODE
+    assert me.extract_metadata(path) == 'новый текст'
+
+
+def test_find_user_comment_in_both_byte_orders():
+    for endian in '<>':
+        tiff = exif_tiff(unicode('abc'), endian)
+        found = me.find_user_comment(tiff)
+        assert found[0] == endian
+        assert found[2:] == (len(unicode('abc')), 44)
+    tiff = me.make_exif_tiff(b'')[:26] + struct.pack('>HI', 0, 0)  # Exif IFD without UserComment
+    assert me.find_user_comment(tiff) is None
+
+
+def test_inline_value_is_moved_out(tmp_path):
+    tiff = exif_tiff(b'ab', '<')
+    endian, entry, count, value_offset = me.find_user_comment(tiff)
+    assert (count, value_offset) == (2, entry + 8)
+    value = unicode('Steps: 20')
+    new = me.set_user_comment(tiff, value)
+    assert new[:len(tiff)] == tiff[:entry + 4] + struct.pack('<II', len(value), len(tiff)) + tiff[entry + 12:]
+    assert me.find_user_comment(new) == ('<', entry, len(value), len(tiff))
+    path = make_jpg(tmp_path, exif_segment(tiff))
+    me.write_metadata(path, 'Steps: 20', False)
+    assert me.extract_metadata(path) == 'Steps: 20'
+
+
+def test_shorter_value_is_overwritten_in_place(tmp_path):
+    tiff = exif_tiff(unicode('Steps: 20, Sampler: Euler a'), trailer=b'MAKERNOTE')
+    new = me.set_user_comment(tiff, unicode('Steps: 5'))
+    assert len(new) == len(tiff)
+    assert me.find_user_comment(new)[2:] == (len(unicode('Steps: 5')), 44)
+    assert new.endswith(b'\x00' * 38 + b'MAKERNOTE')
+    path = make_jpg(tmp_path, exif_segment(tiff))
+    size, inode = os.path.getsize(path), os.stat(path).st_ino
+    me.write_metadata(path, 'Steps: 5', False)
+    assert me.extract_metadata(path) == 'Steps: 5'
+    assert (os.path.getsize(path), os.stat(path).st_ino) == (size, inode)  # patched, not rewritten
+
+
+def test_longer_value_is_appended(tmp_path):
+    tiff = exif_tiff(unicode('Steps: 20'), trailer=b'MAKERNOTE')
+    value = unicode('Steps: 20, Sampler: Euler a, CFG scale: 7')
+    new = me.set_user_comment(tiff, value)
+    assert me.find_user_comment(new)[2:] == (len(value), len(tiff) + 1)  # word aligned
+    assert new[44:44 + len(unicode('Steps: 20'))] == b'\x00' * len(unicode('Steps: 20'))
+    assert new[len(tiff) - 9:len(tiff)] == b'MAKERNOTE'
+    # A value already at the end of the block just grows there
+    tail = exif_tiff(unicode('Steps: 20'))
+    assert me.find_user_comment(me.set_user_comment(tail, value))[2:] == (len(value), 44)
+    path = make_jpg(tmp_path, exif_segment(tiff))
+    me.write_metadata(path, 'Steps: 20, Sampler: Euler a, CFG scale: 7', False)
+    assert me.extract_metadata(path) == 'Steps: 20, Sampler: Euler a, CFG scale: 7'
+    assert open(path, 'rb').read().endswith(b'\x12\xff\x00\x34\xff\xd9')
+
+
+def test_files_without_exif(tmp_path):
+    path = make_jpg(tmp_path, JFIF, XMP)
+    assert me.extract_metadata(path) == ''
+    me.write_metadata(path, 'Steps: 20', False)
+    assert me.extract_metadata(path) == 'Steps: 20'
+    assert markers(path) == [me.JPEG_APP0, me.JPEG_APP1, me.JPEG_APP1, 0xDB]
+    assert open(path, 'rb').read()[2 + len(JFIF):].startswith(b'\xff\xe1')  # right after JFIF
+    bare = tmp_path / 'bare.jpg'
+    bare.write_bytes(jpeg_bytes())
+    assert me.extract_metadata(str(bare)) == ''
+    me.write_metadata(str(bare), 'Steps: 20', False)
+    assert me.extract_metadata(str(bare)) == 'Steps: 20'
+    assert markers(str(bare)) == [me.JPEG_APP1, 0xDB]
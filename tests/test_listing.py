@@ -0,0 +1,74 @@
+import os
+import time
+
+import metadata_editor as me
+from conftest import png_bytes
+
+
+def add(folder, *names, mtime=None):
+    for name in names:
+        path = folder / name
+        path.write_bytes(png_bytes())
+        if mtime is not None: os.utime(str(path), ns=(mtime, mtime))
+
+
+def pages(folder, limit, between=None, **kwargs):
+    # Every page's names, calling between(page number) after each page
+    seen, cursor, number = [], None, 0
+    while True:
+        key = me.decode_cursor(cursor) if cursor else None  # as /api/list takes it
+        page, total, cursor = me.list_folder(str(folder), cursor=key, limit=limit, **kwargs)
+        seen.append([name for name, _ in page])
+        number += 1
+        if cursor is None: return seen
+        if between: between(number)
+
+
+def test_files_added_or_removed_between_pages(tmp_path):
+    add(tmp_path, *['%02d.png' % i for i in range(0, 20, 2)])
+
+    def change(number):
+        if number == 1:
+            add(tmp_path, '01.png', '09.png')  # one behind the cursor, one ahead of it
+            os.remove(str(tmp_path / '06.png'))
+    seen = pages(tmp_path, 3, change)
+    assert seen[0] == ['00.png', '02.png', '04.png']
+    names = sum(seen, [])
+    assert names == ['00.png', '02.png', '04.png', '08.png', '09.png', '10.png', '12.png',
+                     '14.png', '16.png', '18.png']
+
+
+def test_descending_pages_by_mtime(tmp_path):
+    base = time.time_ns() - 3600 * 10**9
+    for i in range(7):
+        add(tmp_path, '%d.png' % (6 - i), mtime=base + i * 10**9)  # older names are newer files
+
+    def change(number):
+        if number == 1:
+            add(tmp_path, 'old.png', mtime=base - 10**9)
+            add(tmp_path, 'new.png', mtime=base + 100 * 10**9)  # sorts before the cursor: not shown
+    seen = pages(tmp_path, 3, change, sort='mtime', descending=True)
+    assert seen[0] == ['0.png', '1.png', '2.png']
+    assert sum(seen, []) == ['0.png', '1.png', '2.png', '3.png', '4.png', '5.png', '6.png', 'old.png']
+
+
+def test_equal_keys_are_split_by_name(tmp_path):
+    mtime = time.time_ns() - 3600 * 10**9
+    add(tmp_path, *['%d.png' % i for i in range(5)], mtime=mtime)
+    assert sum(pages(tmp_path, 2, sort='mtime'), []) == ['%d.png' % i for i in range(5)]
+
+
+def test_snapshot_of_a_fresh_directory_is_not_reused(tmp_path):
+    add(tmp_path, 'a.png')
+    now = time.time_ns()
+    os.utime(str(tmp_path), ns=(now, now))
+    assert me.scan_images(str(tmp_path)) == [('a.png', False)]
+    add(tmp_path, 'b.png')
+    os.utime(str(tmp_path), ns=(now, now))  # a coarse clock: same mtime after the change
+    assert me.scan_images(str(tmp_path)) == [('a.png', False), ('b.png', False)]
+    old = now - 3600 * 10**9
+    os.utime(str(tmp_path), ns=(old, old))
+    me.scan_images(str(tmp_path))
+    add(tmp_path, 'c.png')
+    os.utime(str(tmp_path), ns=(old, old))
+    assert len(me.scan_images(str(tmp_path))) == 2  # settled mtime: the snapshot answers
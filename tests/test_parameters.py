@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+import metadata_editor as me
+
+PARAMS = 'Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x768'
+
+
+@pytest.mark.parametrize('text', [
+    '1girl, solo\nNegative prompt: lowres\n' + PARAMS,
+    '\nNegative prompt: lowres\n' + PARAMS,  # empty prompt
+    '\n' + PARAMS,  # empty prompt, no negative prompt
+    PARAMS,  # parameters only
+    '1girl, solo\n' + PARAMS,  # no negative prompt
+    'masterpiece,\n1girl,\n\nsolo\nNegative prompt: lowres,\nbad hands\n' + PARAMS,  # multi-line prompts
+    'Negative prompt: lowres\n' + PARAMS,
+    '1girl, solo',
+    '',
+])
+def test_parse_format_round_trip(text):
+    assert me.format_parameters(me.parse_parameters(text)) == text
+
+
+def test_empty_prompt_fields():
+    parsed = me.parse_parameters('\n' + PARAMS)
+    assert parsed['prompt'] == '' and parsed['negative_prompt'] is None
+    assert parsed['params']['Steps'] == '20'
+
+
+def test_edit_changing_nothing_leaves_empty_prompt_file_alone(make_png):
+    path = make_png('a.png', '\nNegative prompt: lowres\n' + PARAMS)
+    operations = me.parse_edits([{'op': 'set', 'field': 'Steps', 'value': 20}])
+    assert list(me.iter_batch_edit(None, operations, entries=me.iter_plan_entries(
+        [(os.path.dirname(path), 'a.png', 'a.png')]))) == [('a.png', False, None)]
+
+
+@pytest.mark.parametrize('prompt, name, expected', [
+    ('masterpiece, <lora:foo:0.8>, 1girl', 'foo', 'masterpiece, 1girl'),
+    ('masterpiece <lora:foo:0.8> 1girl', 'foo', 'masterpiece 1girl'),
+    ('<lora:foo:0.8>, 1girl', 'foo', '1girl'),
+    ('1girl, <lora:foo:0.8>', 'foo', '1girl'),
+    ('1girl <lora:foo:0.8>, solo', 'foo', '1girl, solo'),
+    ('1girl, <lora:a:1> <lora:b:1>, solo', None, '1girl, solo'),
+    ('1girl, <lora:a:1>, <lora:b:1>', None, '1girl'),
+    ('1girl, <lora:a:1>,\nsolo, <lora:b:1> smile', None, '1girl\nsolo, smile'),
+    ('1girl, <lora:a:1>, <lora:b:1>, solo', 'a', '1girl, <lora:b:1>, solo'),
+    ('1girl, solo', 'a', '1girl, solo'),
+])
+def test_remove_lora_tags_tidies_separators(prompt, name, expected):
+    assert me.remove_lora_tags(prompt, name) == expected
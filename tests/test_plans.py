@@ -0,0 +1,56 @@
+import json
+import os
+
+import metadata_editor as me
+
+
+def dry_run(client, route, body):
+    lines = [json.loads(line) for line in client.post(route, json=body).data.splitlines()]
+    return lines[:-1], lines[-1]
+
+
+def test_real_run_reuses_the_dry_run_plan(make_png, tmp_path, monkeypatch):
+    paths = {name: make_png(name + '.png', text) for name, text in
+             [('a', 'dog, 1girl'), ('b', 'dog, cat'), ('c', 'bird'), ('d', 'dog')]}
+    client = me.app.test_client()
+    found, summary = dry_run(client, '/api/batch-replace/dry-run',
+                             {'folder': str(tmp_path), 'find': 'dog', 'replace': 'wolf'})
+    assert sorted(item['name'] for item in found) == ['a.png', 'b.png', 'd.png']
+    assert (summary['files'], summary['scanned']) == (3, 4)
+    assert me.extract_metadata(paths['a']) == 'dog, 1girl'  # nothing written
+
+    me.write_metadata(paths['b'], 'cat only', False)  # changed since: planned again from the file
+    os.remove(paths['d'])  # deleted since: skipped
+    make_png('e.png', 'dog')  # new since: not part of the plan
+
+    reads = []
+    extract = me.extract_metadata
+    monkeypatch.setattr(me, 'extract_metadata', lambda path: reads.append(os.path.basename(path)) or extract(path))
+    monkeypatch.setattr(me, 'scan_dir', None)  # the folder is not listed again
+    result = client.post('/api/batch-replace', json={'plan': summary['plan'], 'backup': False}).json
+    assert result == {'modified': 1, 'errors': []}
+    assert reads == ['b.png']  # the unchanged files were planned from the index
+    monkeypatch.undo()
+    assert me.extract_metadata(paths['a']) == 'wolf, 1girl'
+    assert me.extract_metadata(paths['b']) == 'cat only'
+    assert me.extract_metadata(str(tmp_path / 'e.png')) == 'dog'
+
+
+def test_changed_file_still_matching_is_replanned(make_png, tmp_path):
+    path = make_png('a.png', 'dog, 1girl')
+    client = me.app.test_client()
+    _, summary = dry_run(client, '/api/batch-replace/dry-run',
+                         {'folder': str(tmp_path), 'find': 'dog', 'replace': 'wolf'})
+    me.write_metadata(path, 'dog, 2girls', False)
+    result = client.post('/api/batch-replace', json={'plan': summary['plan'], 'backup': False}).json
+    assert result == {'modified': 1, 'errors': []}
+    assert me.extract_metadata(path) == 'wolf, 2girls'  # not the text planned at the dry run
+
+
+def test_plan_only_serves_its_own_kind(make_png, tmp_path):
+    make_png('a.png', 'dog')
+    client = me.app.test_client()
+    _, summary = dry_run(client, '/api/batch-replace/dry-run',
+                         {'folder': str(tmp_path), 'find': 'dog', 'replace': 'wolf'})
+    assert 'error' in client.post('/api/batch-edit', json={'plan': summary['plan']}).json
+    assert 'error' in client.post('/api/batch-replace', json={'plan': 'no such plan'}).json
@@ -0,0 +1,46 @@
+import struct
+import zlib
+
+import metadata_editor as me
+
+
+def chunk_types(path):
+    with open(path, 'rb') as f:
+        return [chunk_type for chunk_type, _, _ in me.scan_png_chunks(f)]
+
+
+def late_png(path, *texts):
+    # 'parameters' chunks after the pixel data, where A1111 never puts them but other tools may
+    ihdr = me.make_chunk('IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0))
+    idat = me.make_chunk('IDAT', zlib.compress(b'\x00\x80'))
+    late = [me.make_chunk('tEXt', b'parameters\x00' + text.encode('latin-1')) for text in texts]
+    path.write_bytes(me.PNG_SIGNATURE + ihdr + idat + b''.join(late) + me.make_chunk('IEND', b''))
+    return str(path)
+
+
+def test_parameters_after_idat_is_read_and_replaced_in_place(tmp_path):
+    path = late_png(tmp_path / 'late.png', 'late text')
+    assert me.extract_metadata(path) == 'late text'
+    me.write_metadata(path, 'new text', False)
+    assert me.extract_metadata(path) == 'new text'
+    assert chunk_types(path) == ['IHDR', 'IDAT', 'tEXt', me.PNG_PAD_CHUNK]
+    me.write_metadata(path, 'newer', False)  # fits the old chunk: patched where it is
+    assert me.extract_metadata(path) == 'newer'
+    assert chunk_types(path).count('tEXt') == 1
+
+
+def test_duplicates_collapse_into_the_first(tmp_path):
+    path = late_png(tmp_path / 'dup.png', 'first', 'second')
+    assert me.extract_metadata(path) == 'first'
+    me.write_metadata(path, 'edited', False)
+    assert me.extract_metadata(path) == 'edited'
+    assert chunk_types(path).count('tEXt') == 1
+
+
+def test_new_chunk_goes_before_idat(make_png):
+    path = make_png('bare.png')
+    assert me.extract_metadata(path) == ''
+    me.write_metadata(path, 'Steps: 20', False)
+    assert me.extract_metadata(path) == 'Steps: 20'
+    types = chunk_types(path)
+    assert types.index('tEXt') < types.index('IDAT')
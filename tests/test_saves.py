@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import metadata_editor as me
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def rewrites(monkeypatch):
+    # Texts passed to write_metadata, i.e. one entry per rewrite of a file
+    written = []
+    write = me.write_metadata
+
+    def counting(path, metadata_text, *args, **kwargs):
+        written.append(metadata_text)
+        return write(path, metadata_text, *args, **kwargs)
+    monkeypatch.setattr(me, 'write_metadata', counting)
+    return written
+
+
+def test_path_locks_are_reentrant_and_exclusive(tmp_path):
+    path, order = str(tmp_path / 'a.png'), []
+    locks = me.PathLocks()
+
+    def other():
+        with locks.hold(path): order.append('other')
+    with locks.hold(path):
+        with locks.hold(path): order.append('nested')
+        thread = threading.Thread(target=other)
+        thread.start()
+        time.sleep(0.05)
+        order.append('released')
+    thread.join()
+    assert order == ['nested', 'released', 'other']
+
+
+@pytest.mark.skipif(me.fcntl is None, reason='no fcntl locks')
+def test_path_locks_cover_other_processes(tmp_path):
+    path = str(tmp_path / 'a.png')
+    script = 'import time, metadata_editor as me\nwith me.PATH_LOCKS.hold(%r): print(time.time())' % path
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with me.PATH_LOCKS.hold(path):
+        child = subprocess.Popen([sys.executable, '-c', script], cwd=root, stdout=subprocess.PIPE)
+        time.sleep(1.5)  # long enough for the child to import and reach the lock
+        released = time.time()
+    assert float(child.communicate(timeout=30)[0]) >= released
+
+
+def test_save_over_a_changed_file_conflicts(make_png, rewrites):
+    path = make_png('a.png', 'dog\nSteps: 20')
+    me.write_metadata(path, 'changed elsewhere', False)
+    with pytest.raises(me.SaveConflict) as e:
+        me.save_metadata_text(path, 'cat\nSteps: 20', False, base='dog\nSteps: 20')
+    assert e.value.metadata == 'changed elsewhere'
+    assert me.extract_metadata(path) == 'changed elsewhere'
+    me.save_metadata_text(path, 'cat\nSteps: 20', False, base='changed elsewhere')
+    assert me.extract_metadata(path) == 'cat\nSteps: 20'
+    assert rewrites == ['changed elsewhere', 'cat\nSteps: 20']
+
+
+def test_queued_saves_rewrite_once(make_png, rewrites):
+    path = os.path.abspath(make_png('a.png', 'dog'))
+    saves = [threading.Thread(target=me.save_metadata_text, args=(path, text, False, base))
+             for text, base in [('one', 'dog'), ('two', 'one'), ('three', None)]]
+    with me.PATH_LOCKS.hold(path):
+        saves[0].start()
+        wait_for(lambda: path in me.SAVES)
+        for save, text in zip(saves[1:], ['two', 'three']):
+            save.start()
+            wait_for(lambda: me.SAVES[path]['metadata'] == text)
+    for save in saves: save.join()
+    assert rewrites == ['three']
+    assert me.extract_metadata(path) == 'three'
+
+
+def test_save_right_after_a_rewrite_waits_for_later_ones(make_png, rewrites, monkeypatch):
+    monkeypatch.setattr(me, 'SAVE_DEBOUNCE', 0.5)
+    path = os.path.abspath(make_png('a.png', 'dog'))
+    me.save_metadata_text(path, 'one', False)
+    started = time.monotonic()
+    second = threading.Thread(target=me.save_metadata_text, args=(path, 'two', False))
+    second.start()
+    wait_for(lambda: path in me.SAVES)
+    me.save_metadata_text(path, 'three', False)  # joins the held save
+    second.join()
+    assert time.monotonic() - started >= 0.4
+    assert rewrites == ['one', 'three']
+    assert me.extract_metadata(path) == 'three'
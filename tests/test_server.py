@@ -0,0 +1,98 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import metadata_editor as me
+
+RELEASE = threading.Event()
+
+
+def app(environ, start_response):
+    # '/hold' blocks its pool thread until RELEASE is set; anything else answers with its path
+    if environ['PATH_INFO'] == '/hold': RELEASE.wait(10)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [environ['PATH_INFO'].encode('latin-1')]
+
+
+@pytest.fixture
+def server():
+    RELEASE.clear()
+    server = me.PooledWSGIServer('127.0.0.1', 0, app, threads=1, long_threads=1, timeout=0.5)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    RELEASE.set()
+    server.shutdown()
+    thread.join(5)
+    server.server_close()
+
+
+def connect(server):
+    sock = socket.create_connection(('127.0.0.1', server.server_port))
+    sock.settimeout(5)
+    return sock
+
+
+def read_all(sock):
+    data = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk: return data
+        data += chunk
+
+
+def get(server, path):
+    sock = connect(server)
+    sock.sendall(b'GET %s HTTP/1.0\r\n\r\n' % path.encode())
+    with sock: return read_all(sock).split(b'\r\n\r\n', 1)[1]
+
+
+def test_idle_and_partial_clients_hold_no_pool_thread(server):
+    idle = [connect(server) for _ in range(20)]
+    partial = [connect(server) for _ in range(5)]
+    for sock in partial: sock.sendall(b'GET /api/meta')
+    started = time.monotonic()
+    assert get(server, '/api/metadata') == b'/api/metadata'  # the single interactive thread is free
+    assert time.monotonic() - started < 0.4
+    partial[0].sendall(b'data?path=x HTTP/1.0\r\n\r\n')
+    assert read_all(partial[0]).endswith(b'/api/metadata')
+    for sock in idle + partial: sock.close()
+
+
+def test_silent_connections_are_closed_after_the_timeout(server):
+    idle, partial = connect(server), connect(server)
+    partial.sendall(b'GET /api/meta')
+    started = time.monotonic()
+    assert idle.recv(10) == b'' and partial.recv(10) == b''
+    assert 0.4 < time.monotonic() - started < 3
+    assert not server.parked
+    idle.close()
+    partial.close()
+
+
+def test_long_requests_have_their_own_pool(server):
+    held = threading.Thread(target=get, args=(server, '/hold'))
+    held.start()
+    time.sleep(0.1)
+    assert get(server, '/api/batch-replace') == b'/api/batch-replace'
+    RELEASE.set()
+    held.join(5)
+
+
+def test_shutdown_closes_parked_connections_and_lets_requests_finish(server):
+    results = []
+    held = threading.Thread(target=lambda: results.append(get(server, '/hold')))
+    held.start()
+    time.sleep(0.1)
+    idle = connect(server)
+    time.sleep(0.05)
+    server.shutdown()
+    assert idle.recv(10) == b''
+    assert not server.drain(0.1)  # '/hold' is still running
+    RELEASE.set()
+    assert server.drain(5)
+    held.join(5)
+    assert results == [b'/hold']
+    idle.close()
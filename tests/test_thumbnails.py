@@ -0,0 +1,25 @@
+import os
+import threading
+
+import metadata_editor as me
+
+
+def test_concurrent_renders_count_once(make_png, tmp_path):
+    path = make_png('a.png', 'Steps: 20')
+    (tmp_path / 'cache').mkdir()
+    cache = me.RenditionCache(str(tmp_path / 'cache'), 1 << 20)
+    cache.added(0)  # measure the (empty) cache up front, as a running server has
+    barrier = threading.Barrier(8)
+
+    def render(src, dst):
+        barrier.wait()  # every thread missed the cache and renders at once
+        with open(dst, 'wb') as f: f.write(b'x' * 1000)
+
+    threads = [threading.Thread(target=cache.get, args=(path, 'thumb:256', '.webp', render)) for _ in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert cache.total == sum(entry.stat().st_size for entry in cache.files()) == 1000
+
+    st = os.stat(path)
+    cache.discard(path, st.st_size, st.st_mtime_ns, 'thumb:256', '.webp')
+    assert cache.total == 0